@@ -0,0 +1,97 @@
+"""
+Local stand-in for the Baidu OCR API, so that BaiduOCR can be timed without the network or a key.
+
+Answers the token endpoint and any OCR endpoint with a fixed number of lines, after `latency`
+seconds. Every `error_every`-th OCR request gets a QPS limit error (code 18), which the client
+retries. With `expire_after`, each token only answers that many OCR requests, the next ones get
+an expired token error (code 111) until the client fetches a new one. Connections are kept
+alive, as with the real API.
+"""
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockOCRServer(object):
+
+    def __init__(self, latency=0.0, n_lines=20, error_every=0, expire_after=0):
+        self.latency = latency
+        self.n_lines = n_lines
+        self.error_every = error_every
+        self.expire_after = expire_after
+        self.requests = 0
+        self.tokens = 0
+        self._token_uses = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d/ocr/" % self._server.server_address[1]
+
+    @property
+    def token_url(self):
+        return "http://127.0.0.1:%d/token" % self._server.server_address[1]
+
+    def response(self, path):
+        if path.startswith("/token"):
+            with self._lock:
+                self.tokens += 1
+                self._token_uses = 0
+                return {"access_token": "mock%d" % self.tokens, "expires_in": 2592000}
+
+        token = parse_qs(urlsplit(path).query).get("access_token", [""])[0]
+        with self._lock:
+            self.requests += 1
+            n = self.requests
+            if self.expire_after:
+                if token != "mock%d" % self.tokens or self._token_uses >= self.expire_after:
+                    return {"error_code": 111, "error_msg": "Access token expired"}
+                self._token_uses += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_every and n % self.error_every == 0:
+            return {"error_code": 18, "error_msg": "Open api qps request limit reached"}
+
+        words = [{"words": "第%d行文字" % i, "location": {"top": 40 * i, "left": 10, "width": 300, "height": 30}}
+                 for i in range(self.n_lines)]
+        return {"words_result": words, "words_result_num": len(words)}
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are separate writes, without TCP_NODELAY they wait on delayed acks
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                body = json.dumps(mock.response(self.path)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
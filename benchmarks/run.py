@@ -0,0 +1,435 @@
+"""
+Benchmarks of the hot paths on synthetic inputs, with a comparison against a stored baseline.
+
+    python benchmarks/run.py                      run everything, write benchmarks/latest.json
+    python benchmarks/run.py --save-baseline      ... and store it as benchmarks/baseline.json
+    python benchmarks/run.py -k ocr -r 10         only the benchmarks matching "ocr", 10 repeats
+
+Each benchmark builds its inputs once (not timed), runs once to warm up, then `repeat` times.
+The median time is compared with the baseline: a benchmark slower than the baseline by more
+than the tolerance is a regression, and the exit status is 1. Benchmarks whose dependencies
+are missing (e.g. poppler for rendering) are skipped.
+Baselines are only comparable on the same machine.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+from collections import OrderedDict
+from optparse import OptionParser
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BENCH_DIR)
+sys.path.append(os.path.join(os.path.dirname(BENCH_DIR), "code"))
+
+import synthetic
+from mock_ocr import MockOCRServer
+
+BENCHMARKS = OrderedDict()
+
+
+class Skip(Exception):
+    pass
+
+
+def benchmark(name):
+    """ Registers setup(tmp_dir, scale, cleanup) -> (fn, number of items fn processes) """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def n(base, scale):
+    return max(1, int(base * scale))
+
+
+# Rendering
+
+@benchmark("render_pdf")
+def render_pdf(tmp_dir, scale, cleanup):
+    from cv.convert_pdf_to_jpg import convert_pdf_to_jpg
+
+    pages = n(4, scale)
+    pdf = synthetic.make_pdf(os.path.join(tmp_dir, "report.pdf"), n_pages=pages)
+    if shutil.which("pdftoppm") is None:
+        raise Skip("poppler (pdftoppm) is not installed")
+
+    def fn():
+        return convert_pdf_to_jpg(pdf, None, first_page_only=False, dpi=100, fmt="ppm")
+
+    return fn, pages
+
+
+# Layout
+
+@benchmark("batch_detect_stub")
+def batch_detect_stub(tmp_dir, scale, cleanup):
+    try:
+        from cv.parse_layout import LayoutBaseParser, detect_wrapper
+    except ImportError as e:
+        raise Skip(str(e))
+
+    class StubParser(LayoutBaseParser):
+        # Fixed boxes, so only reading, decoding, prefetching and batching are timed
+        @detect_wrapper
+        def detect(self, im, **kwargs):
+            return self.detect_batch([im])[0]
+
+        def detect_batch(self, ims, inputs=None, **kwargs):
+            return [[(0.1, 0.1, 0.9, 0.2, "TextRegion", 0.9), (0.1, 0.3, 0.9, 0.8, "TextRegion", 0.8)] for _ in ims]
+
+    img_dir = os.path.join(tmp_dir, "jpgs")
+    paths = synthetic.write_images(img_dir, n(32, scale))
+    parser = StubParser()
+
+    def fn():
+        return parser.batch_detect(img_dir, max_batch_size=8)
+
+    return fn, len(paths)
+
+
+# Evaluation
+
+@benchmark("iox_matrix")
+def iox_matrix(tmp_dir, scale, cleanup):
+    from cv.evaluate import iox_matrix
+
+    pages = n(200, scale)
+    preds = [synthetic.random_boxes(30, seed=i) for i in range(pages)]
+    gts = [synthetic.random_boxes(20, seed=10000 + i) for i in range(pages)]
+
+    def fn():
+        return [iox_matrix(p, g) for p, g in zip(preds, gts)]
+
+    return fn, pages
+
+
+@benchmark("cal_iox")
+def cal_iox(tmp_dir, scale, cleanup):
+    from cv.evaluate import cal_accumulated_iox, cal_max_iox
+
+    pages = n(50, scale)
+    preds = [synthetic.random_boxes(30, seed=i).tolist() for i in range(pages)]
+    gts = [synthetic.random_boxes(20, seed=10000 + i).tolist() for i in range(pages)]
+
+    def fn():
+        for pred, gt in zip(preds, gts):
+            for g in gt:
+                cal_max_iox(pred, g)
+                cal_accumulated_iox(pred, g)
+
+    return fn, pages * 20
+
+
+# Returns
+
+def price_setup(tmp_dir, scale):
+    # Shared by the returns benchmarks, written once
+    stock_dir = os.path.join(tmp_dir, "stock")
+    if not os.path.exists(stock_dir):
+        synthetic.write_prices(stock_dir, n_tickers=n(20, scale))
+    tickers = sorted(f.split(".")[0] for f in os.listdir(stock_dir))
+    return stock_dir, tickers, synthetic.trading_days(2500)
+
+
+@benchmark("event_returns_load")
+def event_returns_load(tmp_dir, scale, cleanup):
+    from NLP.performance import EventReturns
+
+    stock_dir, tickers, dates = price_setup(tmp_dir, scale)
+
+    def fn():
+        # Prices are read on first use
+        EventReturns(stock_dir).load(tickers)
+
+    return fn, len(tickers)
+
+
+@benchmark("event_returns")
+def event_returns(tmp_dir, scale, cleanup):
+    # EventReturns.returns on prices already loaded: the lookup of many events at once
+    from NLP.performance import FREQ_LIST, EventReturns
+
+    stock_dir, tickers, dates = price_setup(tmp_dir, scale)
+    engine = EventReturns(stock_dir)
+    rng = np.random.RandomState(0)
+    events = n(50000, scale)
+    ev_tickers = rng.choice(tickers, events)
+    ev_dates = rng.choice(dates, events)
+    engine.load(tickers)
+
+    def fn():
+        return engine.returns(ev_tickers, ev_dates, FREQ_LIST)
+
+    return fn, events
+
+
+@benchmark("calc_return")
+def calc_return(tmp_dir, scale, cleanup):
+    # performance.calc_return end to end, one event per call: reading the prices and the lookup
+    from NLP.performance import calc_return
+
+    stock_dir, tickers, dates = price_setup(tmp_dir, scale)
+    rng = np.random.RandomState(0)
+    events = n(200, scale)
+    ev_tickers = rng.choice(tickers, events)
+    ev_dates = rng.choice(dates[:-30], events)
+
+    def fn():
+        return [calc_return(t, d, 5, stock_dir=stock_dir) for t, d in zip(ev_tickers, ev_dates)]
+
+    return fn, events
+
+
+@benchmark("calc_corr")
+def calc_corr(tmp_dir, scale, cleanup):
+    from NLP import performance
+
+    stock_dir, tickers, dates = price_setup(tmp_dir, scale)
+    senti_dir = os.path.join(tmp_dir, "senti")
+    os.makedirs(senti_dir, exist_ok=True)
+    reports = n(2000, scale)
+    synthetic.sentiment_frame(tickers, dates, n_reports=reports).to_csv(
+        os.path.join(senti_dir, "sentiment_finbert_full_final.csv"), index=False)
+
+    old = performance.senti_dir
+    performance.senti_dir = senti_dir
+    cleanup.append(lambda: setattr(performance, "senti_dir", old))
+    engine = performance.EventReturns(stock_dir)
+
+    def fn():
+        return performance.calc_corr(engine=engine)
+
+    return fn, reports
+
+
+# Corpus cleaning and segmentation
+
+def corpus_setup(tmp_dir, scale):
+    path = os.path.join(tmp_dir, "corpus.txt")
+    if not os.path.exists(path):
+        synthetic.write_lines(path, synthetic.chinese_lines(n(2000, scale)))
+    return path, n(2000, scale)
+
+
+@benchmark("remove_en_blank")
+def remove_en_blank(tmp_dir, scale, cleanup):
+    from NLP.remove_en_blank import remove_en_blank
+
+    path, lines = corpus_setup(tmp_dir, scale)
+    return lambda: remove_en_blank(path, path + ".clean"), lines
+
+
+@benchmark("chinese_t2s")
+def chinese_t2s(tmp_dir, scale, cleanup):
+    try:
+        from NLP.chinese_t2s import zh_t2s
+    except ImportError as e:
+        raise Skip(str(e))
+
+    path, lines = corpus_setup(tmp_dir, scale)
+    return lambda: zh_t2s(path, path + ".s"), lines
+
+
+@benchmark("seg_with_jieba")
+def seg_with_jieba(tmp_dir, scale, cleanup):
+    from NLP.corpus_zhwiki_seg import seg_with_jieba
+
+    path, lines = corpus_setup(tmp_dir, scale)
+    return lambda: seg_with_jieba(path, path + ".seg"), lines
+
+
+@benchmark("segmenter_lexicon")
+def segmenter_lexicon(tmp_dir, scale, cleanup):
+    from NLP.segmenter import Segmenter
+
+    path, lines = corpus_setup(tmp_dir, scale)
+    with open(path, encoding="utf-8") as f:
+        texts = f.read().splitlines()
+    segmenter = Segmenter(synthetic.TERMS, cache_dir=os.path.join(tmp_dir, "jieba"))
+    segmenter.tokenizer
+
+    return lambda: [segmenter.seg_line(t) for t in texts], lines
+
+
+@benchmark("zhwiki_process_chunk")
+def zhwiki_process_chunk(tmp_dir, scale, cleanup):
+    # t2s, english / blank removal and segmentation of one chunk, as in the worker processes
+    try:
+        from NLP import zhwiki_pipeline
+    except ImportError as e:
+        raise Skip(str(e))
+    from NLP.segmenter import Segmenter
+
+    path, lines = corpus_setup(tmp_dir, scale)
+    with open(path, encoding="utf-8") as f:
+        chunk = [line.split(" ") for line in f.read().splitlines()]
+    zhwiki_pipeline.init_worker(Segmenter(cache_dir=os.path.join(tmp_dir, "jieba")))
+
+    return lambda: zhwiki_pipeline.process_chunk(chunk), lines
+
+
+# OCR
+
+def ocr_setup(cleanup, **kwargs):
+    from cv.OCR import BaiduOCR
+
+    server = MockOCRServer(**kwargs).start()
+    cleanup.append(server.stop)
+    ocr = BaiduOCR("key", "secret", base_url=server.base_url, token_url=server.token_url, n_workers=8)
+    cleanup.append(ocr.pool.close)
+
+    _, im = synthetic.cv2.imencode(".jpg", synthetic.page_image(h=700, w=500))
+    return ocr, im.tobytes()
+
+
+@benchmark("baidu_ocr_mock")
+def baidu_ocr_mock(tmp_dir, scale, cleanup):
+    requests = n(200, scale)
+    ocr, im = ocr_setup(cleanup, latency=0.005)
+    return lambda: ocr.batch_query([im] * requests, raise_errors=True), requests
+
+
+@benchmark("baidu_ocr_mock_retry")
+def baidu_ocr_mock_retry(tmp_dir, scale, cleanup):
+    # Every 10th request hits the QPS limit and is retried after a backoff
+    requests = n(200, scale)
+    ocr, im = ocr_setup(cleanup, latency=0.005, error_every=10)
+    return lambda: ocr.batch_query([im] * requests, raise_errors=True), requests
+
+
+# Caches
+
+@benchmark("sqlite_cache")
+def sqlite_cache(tmp_dir, scale, cleanup):
+    # One small put and read at a time into a cache holding many entries, as OCR and translation do
+    from common.sqlite_cache import SQLiteCache
+
+    cache = SQLiteCache(os.path.join(tmp_dir, "cache.sqlite"))
+    cleanup.append(cache.close)
+    cache.put_many([(f"old{i}", b"x" * 512) for i in range(n(100000, scale))])
+    ops = n(500, scale)
+
+    def fn():
+        for i in range(ops):
+            cache.put(f"new{i}", b"y" * 512)
+            cache.get_many([f"old{i}", f"new{i}", "missing"])
+
+    return fn, ops
+
+
+def run_one(name, setup, tmp_dir, scale, repeat):
+    cleanup = []
+    try:
+        try:
+            fn, items = setup(tmp_dir, scale, cleanup)
+        except Skip as e:
+            return {"skipped": str(e)}
+
+        fn()
+        times = []
+        for _ in range(repeat):
+            gc.collect()
+            t_start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t_start)
+    finally:
+        for f in reversed(cleanup):
+            f()
+
+    median = float(np.median(times))
+    return {"median_s": median, "min_s": min(times), "max_s": max(times), "repeat": repeat, "items": items,
+            "items_per_s": items / median if median else None}
+
+
+def meta(scale, repeat):
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                             text=True).stdout.strip()
+    except OSError:
+        rev = None
+    return {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "git": rev, "python": platform.python_version(),
+            "platform": platform.platform(), "machine": platform.node(), "cpu_count": os.cpu_count(),
+            "numpy": np.__version__, "scale": scale, "repeat": repeat}
+
+
+def compare(results, baseline, tolerance):
+    """ {name: (ratio of the median to the baseline median, status)} of the benchmarks in both """
+    out = {}
+    for name, r in results.items():
+        b = baseline.get(name)
+        if "median_s" not in r or not b or "median_s" not in b:
+            continue
+        ratio = r["median_s"] / b["median_s"]
+        status = "regression" if ratio > 1 + tolerance else "faster" if ratio < 1 - tolerance else "ok"
+        out[name] = (ratio, status)
+    return out
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-o', '--output', dest='output', default=os.path.join(BENCH_DIR, 'latest.json'))
+    parser.add_option('-b', '--baseline', dest='baseline', default=os.path.join(BENCH_DIR, 'baseline.json'))
+    parser.add_option('--save-baseline', dest='save_baseline', action='store_true', default=False)
+    parser.add_option('-k', dest='pattern', default=None, help='only benchmarks whose name contains this')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5)
+    parser.add_option('-s', '--scale', dest='scale', type='float', default=1.0, help='multiplies the input sizes')
+    parser.add_option('-t', '--tolerance', dest='tolerance', type='float', default=0.2,
+                      help='slowdown over the baseline reported as a regression')
+    (options, args) = parser.parse_args()
+
+    # Progress bars and the modules' own logs would only add noise to the timings
+    os.environ.setdefault("TQDM_DISABLE", "1")
+    logging.disable(logging.WARNING)
+    np.random.seed(0)
+
+    names = [name for name in BENCHMARKS if options.pattern is None or options.pattern in name]
+    results = OrderedDict()
+    tmp_dir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        for name in names:
+            results[name] = run_one(name, BENCHMARKS[name], tmp_dir, options.scale, options.repeat)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(options.baseline) and not options.save_baseline:
+        with open(options.baseline) as f:
+            baseline_doc = json.load(f)
+        if baseline_doc["meta"].get("scale") != options.scale:
+            print(f"Warning: baseline scale {baseline_doc['meta'].get('scale')} != {options.scale}, not compared")
+        else:
+            baseline = baseline_doc["results"]
+
+    comparison = compare(results, baseline, options.tolerance)
+    doc = {"meta": meta(options.scale, options.repeat), "results": results,
+           "comparison": {name: {"ratio": ratio, "status": status} for name, (ratio, status) in comparison.items()}}
+
+    for path in [options.output] + ([options.baseline] if options.save_baseline else []):
+        with open(path, "w") as f:
+            json.dump(doc, f, indent=2)
+
+    print(f"{'benchmark':24s} {'median':>10s} {'items/s':>12s} {'vs base':>9s}")
+    for name, r in results.items():
+        if "skipped" in r:
+            print(f"{name:24s} skipped: {r['skipped']}")
+            continue
+        ratio, status = comparison.get(name, (None, ""))
+        vs = f"{ratio:8.2f}x" if ratio is not None else ""
+        print(f"{name:24s} {r['median_s'] * 1000:8.1f}ms {r['items_per_s']:12.1f} {vs:>9s} {status}")
+
+    regressions = [name for name, (_, status) in comparison.items() if status == "regression"]
+    if regressions:
+        print(f"Regressions over {options.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+    if not baseline and not options.save_baseline:
+        print(f"No baseline at {options.baseline}, store one with --save-baseline")
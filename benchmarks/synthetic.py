@@ -0,0 +1,153 @@
+"""
+Synthetic inputs of the benchmarks, generated offline from a seed: pdf reports, page images,
+layout boxes, Wind-like price files, FinBERT-like sentence scores and Chinese text.
+"""
+import os
+
+import cv2
+import numpy as np
+import pandas as pd
+
+WORDS = ["lorem", "ipsum", "revenue", "margin", "growth", "guidance", "earnings", "rating", "target", "price",
+         "quarter", "demand", "capacity", "dividend", "valuation", "outlook"]
+
+# Simplified characters and finance words, with some traditional ones for t2s
+CHARS = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经"
+TERMS = ["营业收入", "归母净利润", "同比增长", "毛利率", "市盈率", "买入评级", "不及预期", "超预期", "风险提示", "现金流",
+         "净资产", "资产负债率", "业绩", "估值", "增持", "减持", "下调", "上调", "景气度", "市场份额"]
+TRADITIONAL = "國經濟發東業產積極預們時會"
+
+
+def make_pdf(path, n_pages=4, n_lines=40, seed=0):
+    """ A minimal pdf of n_pages pages of Helvetica text and boxes, written without any pdf library """
+    rng = np.random.RandomState(seed)
+
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for p in range(n_pages):
+        ops = []
+        # A column of text lines and a few filled rectangles, like a report page
+        for i in range(n_lines):
+            text = " ".join(rng.choice(WORDS, 8))
+            ops.append(f"BT /F1 10 Tf 60 {780 - i * 18} Td ({text}) Tj ET")
+        for _ in range(3):
+            x, y = rng.randint(300, 500), rng.randint(60, 700)
+            ops.append(f"0.5 g {x} {y} {rng.randint(40, 90)} {rng.randint(20, 80)} re f")
+        stream = "\n".join(ops).encode("latin-1")
+
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+                        "/Contents %d 0 R >>" % content_id).encode("latin-1"))
+        kids.append(len(objects))
+
+    objects[1] = ("<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{k} 0 R" for k in kids), n_pages)).encode()
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for off in offsets:
+        out += b"%010d 00000 n \n" % off
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+
+    with open(path, "wb") as f:
+        f.write(out)
+    return path
+
+
+def page_image(h=1400, w=1000, n_blocks=12, seed=0):
+    # White page with grey text-like blocks, BGR
+    rng = np.random.RandomState(seed)
+    im = np.full((h, w, 3), 255, dtype=np.uint8)
+    for _ in range(n_blocks):
+        l, t = rng.randint(0, w - 200), rng.randint(0, h - 100)
+        r, b = l + rng.randint(100, 200), t + rng.randint(20, 100)
+        im[t:b, l:r] = rng.randint(0, 160, size=(b - t, r - l, 1))
+    return im
+
+
+def write_images(img_dir, n, seed=0, **kwargs):
+    os.makedirs(img_dir, exist_ok=True)
+    paths = []
+    for i in range(n):
+        path = os.path.join(img_dir, f"bench-2021010{i % 10}-{i}.jpg")
+        cv2.imwrite(path, page_image(seed=seed + i, **kwargs))
+        paths.append(path)
+    return paths
+
+
+def random_boxes(n, seed=0, h=1400, w=1000):
+    """ n x 4 int array of (l, t, r, b) """
+    rng = np.random.RandomState(seed)
+    l = rng.randint(0, w - 50, n)
+    t = rng.randint(0, h - 20, n)
+    r = np.minimum(l + rng.randint(20, 400, n), w)
+    b = np.minimum(t + rng.randint(10, 120, n), h)
+    return np.stack([l, t, r, b], axis=1)
+
+
+def trading_days(n_days, start="2011-01-04"):
+    return np.array(pd.bdate_range(start, periods=n_days).strftime("%Y%m%d").astype(np.int64))
+
+
+def write_prices(stock_dir, n_tickers=20, n_days=2500, seed=0):
+    """ Wind-like csv files (utf-8 with BOM, source footer) of random walks, returns the tickers """
+    os.makedirs(stock_dir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    dates = trading_days(n_days)
+
+    tickers = []
+    for k in range(n_tickers):
+        ticker = "%06d" % (k + 1)
+        close = 10 * np.exp(np.cumsum(rng.normal(0, 0.02, n_days)))
+        df = pd.DataFrame({"代码": f"{ticker}.SZ", "简称": f"股票{k}", "日期": dates, "收盘价(元)": close.round(2)})
+        path = os.path.join(stock_dir, f"{ticker}.SZ.csv")
+        df.to_csv(path, index=False, encoding="utf-8-sig")
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("数据来源: Wind\n")
+        tickers.append(ticker)
+
+    return tickers, dates
+
+
+def sentiment_frame(tickers, dates, n_reports=2000, n_sentences=20, seed=0):
+    """ Sentence scores in the layout of sentiment_finbert_full_final.csv """
+    rng = np.random.RandomState(seed)
+    files = [f"{rng.choice(tickers)}-{rng.choice(dates)}-{i}.txt" for i in range(n_reports)]
+    return pd.DataFrame({
+        "file_name": np.repeat(files, n_sentences),
+        "sentence_id": np.tile(np.arange(n_sentences), n_reports),
+        "sentiment_score": rng.uniform(-1, 1, n_reports * n_sentences),
+    })
+
+
+def chinese_lines(n_lines, n_tokens=40, seed=0, english=0.1, traditional=0.05):
+    """ Lines of random characters and finance terms, with english words, blanks and traditional characters """
+    rng = np.random.RandomState(seed)
+    lines = []
+    for _ in range(n_lines):
+        parts = []
+        for _ in range(n_tokens):
+            x = rng.rand()
+            if x < english:
+                parts.append(" " + rng.choice(WORDS) + " ")
+            elif x < english + traditional:
+                parts.append(rng.choice(list(TRADITIONAL)))
+            elif x < 0.5:
+                parts.append(rng.choice(TERMS))
+            else:
+                parts.append("".join(rng.choice(list(CHARS), rng.randint(1, 4))))
+        lines.append("".join(parts) + "。")
+    return lines
+
+
+def write_lines(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("".join(line + "\n" for line in lines))
+    return path
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput, latency and accuracy of the FinBERT variants on CPU.
+
+The labelled sentences of data/label/label_final.csv are translated with translation.py (the
+sentence cache makes reruns free) and scored by each variant: fp32, int8, and with
+--n-layers / --distilled the layer-pruned and distilled models, each in fp32 and int8.
+For each variant we report sentences/s of batched scoring, p50 / p99 latency of single
+sentences and macro-F1 against the labels.
+"""
+import os
+import sys
+import time
+import logging
+from optparse import OptionParser
+
+import numpy as np
+import pandas as pd
+import torch
+
+from finbert_infer import FinBertScorer, LABELS
+from translation import BatchTranslator
+
+logger = logging.getLogger(__name__)
+
+# Labels of label_final.csv
+LABEL_MAP = {1: 'positive', -1: 'negative', 0: 'neutral'}
+
+
+def macro_f1(y_true, y_pred, labels=LABELS):
+    y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+    f1 = []
+    for c in labels:
+        tp = np.sum((y_pred == c) & (y_true == c))
+        fp = np.sum((y_pred == c) & (y_true != c))
+        fn = np.sum((y_pred != c) & (y_true == c))
+        f1.append(2 * tp / (2 * tp + fp + fn) if tp + fp + fn else 0.0)
+    return float(np.mean(f1))
+
+
+def load_labelled(label_path, translator):
+    df = pd.read_csv(label_path, encoding="utf-8-sig")
+    df["label"] = df["label"].map(LABEL_MAP)
+    df["text_en"] = [translator.translate(t) for t in df["text"]]
+    return df
+
+
+def benchmark(scorer, sentences, labels, n_latency=200, n_warmup=5):
+    # Batched throughput and accuracy over all sentences, latency over single sentences
+    for s in sentences[:n_warmup]:
+        scorer.score([s])
+
+    t_start = time.perf_counter()
+    probs = scorer.score(sentences)
+    seconds = time.perf_counter() - t_start
+
+    latency = []
+    for s in sentences[:n_latency]:
+        t = time.perf_counter()
+        scorer.score([s])
+        latency.append(time.perf_counter() - t)
+
+    return {
+        "sentences/s": len(sentences) / seconds,
+        "p50_ms": 1000 * float(np.percentile(latency, 50)),
+        "p99_ms": 1000 * float(np.percentile(latency, 99)),
+        "macro_f1": macro_f1(labels, np.array(LABELS)[probs.argmax(axis=1)]),
+    }
+
+
+def variants(options):
+    # (name, model path, n_layers), each run in fp32 and int8
+    out = [("finbert", options.model_path, None)]
+    if options.n_layers:
+        out.append((f"finbert-{options.n_layers}L", options.model_path, options.n_layers))
+    if options.distilled:
+        out.append(("distilled", options.distilled, None))
+    return out
+
+
+if __name__ == '__main__':
+    program = os.path.basename(sys.argv[0])
+    logger = logging.getLogger(program)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = OptionParser()
+    parser.add_option('-l', '--labels', dest='label_path', default='../../data/label/label_final.csv')
+    parser.add_option('-m', '--model', dest='model_path', default='models/classifier_model/finbert-sentiment')
+    parser.add_option('--n-layers', dest='n_layers', type='int', default=6, help='layer-pruned variant, 0 to skip')
+    parser.add_option('--distilled', dest='distilled', default=None, help='path of a distilled classifier')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int', default=64)
+    parser.add_option('--threads', dest='threads', type='int', default=None, help='torch intra-op threads')
+    parser.add_option('--n-latency', dest='n_latency', type='int', default=200)
+    parser.add_option('--cache', dest='cache', default='../../data/cache/translation.sqlite', help='sentence cache of the translations')
+    parser.add_option('-o', '--output', dest='output_file', default=None, help='csv of the results')
+    (options, args) = parser.parse_args()
+
+    if options.threads:
+        torch.set_num_threads(options.threads)
+
+    os.makedirs(os.path.dirname(options.cache), exist_ok=True)
+    df = load_labelled(options.label_path, BatchTranslator(cache=options.cache))
+    sentences, labels = df["text_en"].tolist(), df["label"].values
+    logger.info('{} labelled sentences, {} torch threads'.format(len(sentences), torch.get_num_threads()))
+
+    rows = []
+    for name, path, n_layers in variants(options):
+        for int8 in (False, True):
+            scorer = FinBertScorer(path, batch_size=options.batch_size, device="cpu", int8=int8, n_layers=n_layers)
+            row = {"model": name, "precision": "int8" if int8 else "fp32"}
+            row.update(benchmark(scorer, sentences, labels, n_latency=options.n_latency))
+            logger.info(row)
+            rows.append(row)
+            del scorer
+
+    results = pd.DataFrame(rows)
+    print(results.to_string(index=False, float_format="%.3f"))
+    if options.output_file:
+        results.to_csv(options.output_file, index=False)
@@ -3,6 +3,9 @@ import logging
 from optparse import OptionParser
 from opencc import OpenCC
 
+logger = logging.getLogger(__name__)
+
+
 def zh_t2s(infile, outfile):
     '''convert the traditional Chinese of infile into the simplified Chinese of outfile'''
 
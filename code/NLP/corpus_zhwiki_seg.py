@@ -3,6 +3,9 @@ import logging
 from optparse import OptionParser
 import jieba
 
+logger = logging.getLogger(__name__)
+
+
 def seg_with_jieba(infile, outfile):
     '''segment the input file with jieba'''
     with open(infile, 'r', encoding='utf-8') as fin, open(outfile, 'w', encoding='utf-8') as fout:
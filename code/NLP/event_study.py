@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Event study of report sentiment against subsequent returns.
+
+For every report (ticker, date, sentiment_score) we compute, for each horizon of FREQ_LIST:
+    return_<h>      close-to-close return over h trading days from the report date
+    abnormal_<h>    the same minus the return of a benchmark over the same calendar window
+    rolling_<h>     correlation of sentiment and abnormal_<h> over the ticker's last `window` reports
+Tickers are split across a process pool, each worker loads its own prices (from a price store
+or the csv exports) and runs one vectorized kernel per ticker. The per-date information
+coefficients, per-period correlations and the correlation matrices of the notebook heatmaps are
+computed from the resulting frame.
+"""
+import os
+from concurrent import futures
+
+import numpy as np
+import pandas as pd
+
+from performance import FREQ_LIST, load_prices
+from price_store import PriceStore
+
+_loaders = {}
+
+
+def price_loader(source):
+    # ticker -> (dates, close) or None, from a price store directory or a directory of csv exports
+    if source not in _loaders:
+        if any(name.endswith(".csv") for name in os.listdir(source)):
+            _loaders[source] = lambda ticker: load_prices(ticker, source)
+        else:
+            _loaders[source] = PriceStore(source).prices
+    return _loaders[source]
+
+
+def report_sentiment(senti_df):
+    # Mean sentiment of each report, with the ticker and date taken from its file name
+    df = senti_df.groupby("file_name", as_index=False)["sentiment_score"].mean()
+    parts = df["file_name"].str.split('-', expand=True)
+    df["ticker"] = parts[0]
+    df["date"] = parts[1].astype(np.int64)
+    return df[["ticker", "date", "sentiment_score"]]
+
+
+def _daily_returns(source, tickers):
+    load = price_loader(source)
+    out = []
+    for t in tickers:
+        prices = load(t)
+        if prices is None or len(prices[0]) < 2:
+            continue
+        dates, close = np.asarray(prices[0], dtype=np.int64), np.asarray(prices[1], dtype=np.float64)
+        out.append(pd.Series(close[1:] / close[:-1] - 1, index=dates[1:]))
+    return out
+
+
+def equal_weight_index(source, tickers, n_workers=None, chunk_size=64):
+    """ (dates, level) of the equal-weighted, daily rebalanced index of tickers """
+    tickers = sorted(set(tickers))
+    chunks = [tickers[i: i + chunk_size] for i in range(0, len(tickers), chunk_size)]
+    with futures.ProcessPoolExecutor(n_workers) as executor:
+        series = [s for out in executor.map(_daily_returns, [source] * len(chunks), chunks) for s in out]
+
+    if not series:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    rets = pd.concat(series).groupby(level=0).mean().sort_index()
+    return rets.index.values.astype(np.int64), np.cumprod(1 + rets.values)
+
+
+def level_on(dates, level, at):
+    # Benchmark level on the last benchmark date on or before each date of `at` (NaN before its start)
+    i = np.searchsorted(dates, at, side="right") - 1
+    out = level[np.maximum(i, 0)].astype(np.float64)
+    out[i < 0] = np.nan
+    return out
+
+
+def ticker_kernel(dates, close, event_dates, scores, freq, bench=None, window=20, min_periods=5):
+    """ Returns, abnormal returns and rolling correlations of the events of one ticker.
+
+    event_dates must be sorted. Returns three (n events, n horizons) arrays.
+    """
+    n, h = len(event_dates), len(freq)
+    raw = np.full((n, h), np.nan)
+
+    if len(dates):
+        idx = np.searchsorted(dates, event_dates, side="left")
+        target = idx[:, None] + freq[None, :]
+        valid = target < len(dates)
+        base = close[np.minimum(idx, len(dates) - 1)]
+        raw[valid] = close[target[valid]] / np.broadcast_to(base[:, None], target.shape)[valid] - 1
+
+        if bench is not None:
+            # Benchmark over the same calendar window as the stock
+            start = level_on(bench[0], bench[1], dates[np.minimum(idx, len(dates) - 1)])
+            end = np.full((n, h), np.nan)
+            end[valid] = level_on(bench[0], bench[1], dates[target[valid]])
+            abnormal = raw - (end / start[:, None] - 1)
+        else:
+            abnormal = raw.copy()
+    else:
+        abnormal = raw.copy()
+
+    rolling = pd.DataFrame(abnormal).rolling(window, min_periods=min_periods).corr(pd.Series(scores)).values
+    return raw, abnormal, rolling
+
+
+def _ticker_chunk(source, events, freq, bench, window, min_periods):
+    # events: [(ticker, sorted dates, scores)]
+    load = price_loader(source)
+    out = []
+    for ticker, event_dates, scores in events:
+        prices = load(ticker)
+        if prices is None:
+            dates, close = np.zeros(0, dtype=np.int64), np.zeros(0)
+        else:
+            dates, close = np.asarray(prices[0], dtype=np.int64), np.asarray(prices[1], dtype=np.float64)
+        out.append(ticker_kernel(dates, close, event_dates, scores, freq, bench, window, min_periods))
+    return out
+
+
+class EventStudy(object):
+    """ Multi-horizon event study over a price source (price store or csv directory).
+
+    benchmark: "equal" for the equal-weighted index of the tickers in the reports, a ticker or
+    symbol of the source (e.g. an index), a (dates, level) pair, or None for raw returns only.
+    """
+
+    def __init__(self, source, freq_list=FREQ_LIST, benchmark="equal", window=20, min_periods=5, n_workers=None,
+                 chunk_size=64):
+        self.source = source
+        self.freq = np.asarray(freq_list, dtype=np.int64)
+        self.benchmark = benchmark
+        self.window = window
+        self.min_periods = min_periods
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+
+    def benchmark_series(self, tickers):
+        if self.benchmark is None:
+            return None
+        if isinstance(self.benchmark, str) and self.benchmark == "equal":
+            return equal_weight_index(self.source, tickers, self.n_workers, self.chunk_size)
+        if isinstance(self.benchmark, str):
+            prices = price_loader(self.source)(self.benchmark)
+            if prices is None:
+                raise ValueError(f"Benchmark {self.benchmark} is not in {self.source}")
+            dates, level = prices
+            return np.asarray(dates, dtype=np.int64), np.asarray(level, dtype=np.float64)
+        return np.asarray(self.benchmark[0], dtype=np.int64), np.asarray(self.benchmark[1], dtype=np.float64)
+
+    def run(self, reports):
+        """ reports: DataFrame with ticker, date and sentiment_score (see report_sentiment).
+
+        Returns the reports sorted by ticker and date with the return_, abnormal_ and rolling_
+        columns of every horizon.
+        """
+        df = reports.sort_values(["ticker", "date"]).reset_index(drop=True)
+        df["ticker"] = df["ticker"].astype(str)
+        dates = df["date"].values.astype(np.int64)
+        scores = df["sentiment_score"].values.astype(np.float64)
+
+        tickers, starts = np.unique(df["ticker"].values, return_index=True)
+        bounds = list(starts) + [len(df)]
+        events = [(t, dates[bounds[i]: bounds[i + 1]], scores[bounds[i]: bounds[i + 1]]) for i, t in enumerate(tickers)]
+        bench = self.benchmark_series(tickers)
+
+        chunks = [events[i: i + self.chunk_size] for i in range(0, len(events), self.chunk_size)]
+        with futures.ProcessPoolExecutor(self.n_workers) as executor:
+            jobs = [executor.submit(_ticker_chunk, self.source, c, self.freq, bench, self.window, self.min_periods)
+                    for c in chunks]
+            results = [r for job in jobs for r in job.result()]
+
+        for k, name in enumerate(["return", "abnormal", "rolling"]):
+            arr = np.concatenate([r[k] for r in results]) if results else np.zeros((0, len(self.freq)))
+            for j, f in enumerate(self.freq):
+                df[f"{name}_{f}"] = arr[:, j]
+        return df
+
+
+def return_columns(results, kind="return"):
+    return [c for c in results.columns if c.startswith(kind + "_")]
+
+
+def information_coefficients(results, kind="abnormal", min_count=5):
+    """ Spearman correlation between sentiment and each horizon across the reports of each date.
+
+    For each horizon, reports whose return is not known yet are dropped first, then dates with
+    fewer than min_count reports left. Index: date, columns: horizons.
+    """
+    cols = return_columns(results, kind)
+    out = {}
+    for c in cols:
+        df = results[["date", "sentiment_score", c]].dropna()
+        df = df[df.groupby("date")["date"].transform("size") >= min_count]
+
+        # Pearson correlation of the ranks within each date, among the reports kept for this horizon
+        r = df.groupby("date")[["sentiment_score", c]].rank()
+        r["date"] = df["date"].values
+        g = r.groupby("date")
+        x = r["sentiment_score"] - g["sentiment_score"].transform("mean")
+        y = r[c] - g[c].transform("mean")
+        num = (x * y).groupby(r["date"]).sum()
+        den = np.sqrt((x * x).groupby(r["date"]).sum() * (y * y).groupby(r["date"]).sum())
+        out[c] = num / den.replace(0, np.nan)
+    return pd.DataFrame(out)
+
+
+def period_corr(results, period="Y", kind="return"):
+    """ Correlation of sentiment with each horizon per period ("Y" years, "Q" quarters, "M" months) """
+    cols = return_columns(results, kind)
+    when = pd.to_datetime(results["date"].astype(str), format="%Y%m%d").dt.to_period(period)
+    return results[["sentiment_score"] + cols].groupby(when).corr().xs("sentiment_score", level=1)[cols]
+
+
+def corr_matrix(results, start=None, end=None, kind="return"):
+    """ Correlation matrix of sentiment and the horizons of `kind`, the notebook heatmaps """
+    mask = np.ones(len(results), dtype=bool)
+    if start is not None:
+        mask &= results["date"].values >= start
+    if end is not None:
+        mask &= results["date"].values < end
+    return results.loc[mask, ["sentiment_score"] + return_columns(results, kind)].corr()
+
+
+if __name__ == "__main__":
+    senti_path = '../../results/sentiment_analysis/sentiment_finbert_sentences.csv'
+    source = '../../data/prices' if os.path.isdir('../../data/prices') else '../../data/stock'
+    output_dir = '../../results/event_study'
+    os.makedirs(output_dir, exist_ok=True)
+
+    senti_df = pd.read_parquet(senti_path) if senti_path.endswith(".parquet") else pd.read_csv(senti_path)
+    results = EventStudy(source).run(report_sentiment(senti_df))
+
+    results.to_csv(os.path.join(output_dir, "events.csv"), index=False)
+    information_coefficients(results).to_csv(os.path.join(output_dir, "ic.csv"))
+    period_corr(results).to_csv(os.path.join(output_dir, "corr_by_year.csv"))
+    corr_matrix(results).to_csv(os.path.join(output_dir, "corr.csv"))
+    print(f"{len(results)} reports, {results['ticker'].nunique()} tickers -> {output_dir}")
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental store of report sentiment and subsequent returns, keyed by (ticker, report date).
+
+    files       one row per ingested report (file_name), so a report is never counted twice
+    features    per (ticker, date): number of reports, sum of their mean sentence scores, and
+                return_<h> for each horizon, NULL until the h trading days after the date exist
+    missing_tickers  tickers the price data did not have at the last update
+
+New sentiment rows only touch the features of their (ticker, date). update_returns only looks
+at rows with a missing horizon, and only computes the horizons which have matured since, the
+others are never recomputed. Rows of missing tickers are skipped until a retry_missing update.
+The primary key serves a ticker's time series, an index on date serves the cross-section of a date.
+"""
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from performance import FREQ_LIST, EventReturns
+
+
+class FeatureStore(object):
+
+    def __init__(self, path, freq_list=FREQ_LIST, timeout=60):
+        self.path = path
+        self.freq_list = list(freq_list)
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS files "
+                              "(file_name TEXT PRIMARY KEY, ticker TEXT, date INTEGER, n_sentences INTEGER, score REAL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS features "
+                              "(ticker TEXT, date INTEGER, n_reports INTEGER, score_sum REAL, "
+                              "PRIMARY KEY (ticker, date)) WITHOUT ROWID")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS features_date ON features (date)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS missing_tickers (ticker TEXT PRIMARY KEY)")
+
+            # Horizons added after the store was created get a new column
+            existing = {row[1] for row in self.conn.execute("PRAGMA table_info(features)")}
+            for col in self.return_columns:
+                if col not in existing:
+                    self.conn.execute(f"ALTER TABLE features ADD COLUMN {col} REAL")
+
+    @property
+    def return_columns(self):
+        return ["return_%d" % f for f in self.freq_list]
+
+    def ingest(self, senti_df):
+        """ Add sentence scores (file_name, sentiment_score rows), reports already in the store are skipped.
+
+        Returns the number of new reports.
+        """
+        reports = senti_df.groupby("file_name")["sentiment_score"].agg(["mean", "size"])
+
+        n = 0
+        with self.conn:
+            for file_name, (mean, size) in reports.iterrows():
+                ticker, date = file_name.split('-')[:2]
+                cur = self.conn.execute("INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?)",
+                                        (file_name, ticker, int(date), int(size), float(mean)))
+                if cur.rowcount == 0:
+                    continue
+
+                self.conn.execute(
+                    "INSERT INTO features (ticker, date, n_reports, score_sum) VALUES (?, ?, 1, ?) "
+                    "ON CONFLICT (ticker, date) DO UPDATE SET "
+                    "n_reports = n_reports + 1, score_sum = score_sum + excluded.score_sum",
+                    (ticker, int(date), float(mean)))
+                n += 1
+
+        return n
+
+    def update_returns(self, engine=None, retry_missing=False):
+        """ Fill the horizons which have matured since the last update.
+
+        engine: performance.EventReturns (e.g. over a PriceStore), with fresh prices.
+        Tickers without prices are recorded and their rows skipped by later updates, unless
+        retry_missing (e.g. after adding tickers to the price data).
+        Returns the number of values filled.
+        """
+        engine = engine or EventReturns()
+        cols = self.return_columns
+        sql = "SELECT ticker, date, %s FROM features WHERE (%s)" % (", ".join(cols),
+                                                                    " OR ".join(f"{c} IS NULL" for c in cols))
+        if not retry_missing:
+            sql += " AND ticker NOT IN (SELECT ticker FROM missing_tickers)"
+        pending = self.conn.execute(sql).fetchall()
+        if not pending:
+            return 0
+
+        tickers = [r[0] for r in pending]
+        dates = [r[1] for r in pending]
+        current = np.array([r[2:] for r in pending], dtype=np.float64)
+
+        # Missing horizons whose h trading days after the date are in the data, the returns are
+        # only computed for the rows with at least one
+        matured = engine.days_after(tickers, dates)[:, None] >= np.array(self.freq_list)[None, :]
+        todo = np.isnan(current) & matured
+        rows = np.flatnonzero(todo.any(axis=1))
+        rets = np.full(current.shape, np.nan)
+        if len(rows):
+            rets[rows] = engine.returns([tickers[i] for i in rows], [dates[i] for i in rows], self.freq_list)
+
+        new = todo & ~np.isnan(rets)
+        updates = []
+        for j, col in enumerate(cols):
+            idx = np.flatnonzero(new[:, j])
+            updates.append((col, [(float(rets[i, j]), tickers[i], dates[i]) for i in idx]))
+
+        unique = sorted(set(tickers))
+        missing = [(t,) for t, last in zip(unique, engine.last_dates(unique)) if last == 0]
+
+        with self.conn:
+            for col, rows in updates:
+                self.conn.executemany(f"UPDATE features SET {col} = ? WHERE ticker = ? AND date = ?", rows)
+            if retry_missing:
+                self.conn.execute("DELETE FROM missing_tickers")
+            self.conn.executemany("INSERT OR IGNORE INTO missing_tickers VALUES (?)", missing)
+
+        return int(new.sum())
+
+    def _query(self, where="", params=()):
+        cols = ", ".join(self.return_columns)
+        sql = (f"SELECT ticker, date, score_sum / n_reports AS sentiment_score, n_reports, {cols} "
+               f"FROM features {where}")
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def ticker_series(self, ticker, start=None, end=None):
+        # Rows of one ticker ordered by date, served by the primary key
+        return self._query("WHERE ticker = ? AND date >= ? AND date < ? ORDER BY date",
+                           (ticker, start or 0, end or 99999999))
+
+    def cross_section(self, date):
+        # All tickers with reports on a date, served by the date index
+        return self._query("WHERE date = ? ORDER BY ticker", (int(date),))
+
+    def frame(self):
+        # Everything, in the layout of calc_corr
+        return self._query("ORDER BY ticker, date")
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    from event_study import price_loader
+
+    senti_path = '../../results/sentiment_analysis/sentiment_finbert_sentences.csv'
+    source = '../../data/prices' if os.path.isdir('../../data/prices') else '../../data/stock'
+
+    store = FeatureStore('../../data/features.sqlite')
+    senti_df = pd.read_parquet(senti_path) if senti_path.endswith(".parquet") else pd.read_csv(senti_path)
+    n_reports = store.ingest(senti_df)
+    n_values = store.update_returns(EventReturns(loader=price_loader(source)))
+    print(f"{n_reports} new reports, {n_values} returns filled")
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Sentence-level FinBERT scoring of the translated reports.
+
+Every sentence of every report is scored (not only the first line), in large batches of
+sentences of similar token length so that padding stays small. Results are written as they
+come to a csv (or parquet) file with the columns of sentiment_finbert.csv:
+file_name, sentence_id, logit, prediction, sentiment_score.
+"""
+import os
+import sys
+import time
+import importlib.util
+import logging
+from optparse import OptionParser
+
+import numpy as np
+import pandas as pd
+import torch
+from nltk.tokenize import sent_tokenize
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import metrics
+
+logger = logging.getLogger(__name__)
+
+# Same labels and order as finbert.predict
+LABELS = ['positive', 'negative', 'neutral']
+
+
+def read_sentences(path):
+    with open(path, encoding="utf8") as f:
+        return sent_tokenize(f.read())
+
+
+def iter_sentences(source_dir):
+    # Yields (file_name, sentence index in the file, sentence) over all txt files of source_dir
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        for subfile in sorted(filenames):
+            if subfile[-3:] != "txt":
+                continue
+            for i, sentence in enumerate(read_sentences(os.path.join(dirpath, subfile))):
+                yield subfile, i, sentence
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def prune_layers(model, n_layers):
+    # Keep n_layers of the encoder layers, spread evenly over the depth (first and last included)
+    encoder = model.base_model.encoder
+    keep = np.linspace(0, len(encoder.layer) - 1, n_layers).round().astype(int)
+    encoder.layer = torch.nn.ModuleList([encoder.layer[i] for i in keep])
+    model.config.num_hidden_layers = n_layers
+    return model
+
+
+def quantize(model):
+    # int8 weights for the Linear layers, activations quantized on the fly (CPU only)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class FinBertScorer(object):
+    """ Batched FinBERT classifier.
+
+    Sentences are tokenized once, sorted by token length and cut into batches, so each batch is
+    only padded to its own longest sentence. Probabilities are returned in the input order.
+
+    For CPU boxes, the model can be cut to n_layers encoder layers and / or dynamically quantized
+    to int8. A distilled model is used by pointing model_path to it.
+    """
+
+    def __init__(self, model_path, tokenizer="bert-base-uncased", max_seq_length=64, batch_size=128,
+                 device=None, model=None, int8=False, n_layers=None):
+        self.device = torch.device("cpu" if int8 else device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+        model = model or AutoModelForSequenceClassification.from_pretrained(model_path, num_labels=3)
+        model.eval()
+        if n_layers:
+            model = prune_layers(model, n_layers)
+        if int8:
+            model = quantize(model)
+        self.model = model.to(self.device)
+        self.model_path = model_path
+        self.int8 = int8
+        self.n_layers = n_layers
+        self.max_seq_length = max_seq_length
+        self.batch_size = batch_size
+
+    def tokenize(self, sentences):
+        return self.tokenizer(list(sentences), truncation=True, max_length=self.max_seq_length)["input_ids"]
+
+    def forward(self, input_ids):
+        # Softmax probabilities of one batch of token ids, padded to its longest sequence
+        batch = self.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+        with torch.inference_mode():
+            logits = self.model(input_ids=batch["input_ids"].to(self.device),
+                                attention_mask=batch["attention_mask"].to(self.device))[0]
+        return softmax(logits.float().cpu().numpy())
+
+    def score(self, sentences):
+        # (N, 3) probabilities of positive / negative / neutral
+        ids = self.tokenize(sentences)
+        order = np.argsort([len(x) for x in ids], kind="stable")
+
+        probs = np.zeros((len(ids), len(LABELS)), dtype=np.float32)
+        for i in range(0, len(order), self.batch_size):
+            idx = order[i: i + self.batch_size]
+            with metrics.timer("score", n=len(idx)):
+                probs[idx] = self.forward([ids[j] for j in idx])
+
+        return probs
+
+
+def to_frame(keys, probs):
+    # keys: [(file_name, sentence_id)], same columns as finbert.predict without the sentence
+    return pd.DataFrame({
+        "file_name": [k[0] for k in keys],
+        "sentence_id": np.array([k[1] for k in keys], dtype=np.int32),
+        "logit": list(probs),
+        "prediction": np.array(LABELS)[probs.argmax(axis=1)],
+        "sentiment_score": probs[:, 0] - probs[:, 1],
+    })
+
+
+class ResultWriter(object):
+    """ Incremental output, one parquet row group (or csv chunk) per write. """
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        self._writer = None
+        self._header = True
+
+        # Checked here, before scoring, rather than at the first write
+        if self.parquet and importlib.util.find_spec("pyarrow") is None:
+            raise ImportError(f"{path}: parquet output needs pyarrow, install it or write a .csv file")
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            df = df.assign(logit=[x.tolist() for x in df["logit"]])
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        else:
+            # logit is written like numpy prints it, as in sentiment_finbert.csv
+            df.to_csv(self.path, mode="w" if self._header else "a", header=self._header, index=False)
+            self._header = False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def score_corpus(source_dir, output_path, scorer, window=8192):
+    """ Score every sentence of the txt files under source_dir and write them to output_path.
+
+    Sentences are read `window` at a time, which bounds memory and the span of the length sort.
+    Returns the number of sentences scored.
+    """
+    writer = ResultWriter(output_path)
+    n, t_start = 0, time.time()
+
+    def flush(items):
+        probs = scorer.score([s for _, _, s in items])
+        writer.write(to_frame([(f, i) for f, i, _ in items], probs))
+
+    items = []
+    try:
+        for item in iter_sentences(source_dir):
+            items.append(item)
+            if len(items) == window:
+                flush(items)
+                n += len(items)
+                items = []
+                logger.info('scored {} sentences, {:.1f} sentences/s'.format(n, n / (time.time() - t_start)))
+        if items:
+            flush(items)
+            n += len(items)
+    finally:
+        writer.close()
+
+    logger.info('scored {} sentences in {:.1f}s'.format(n, time.time() - t_start))
+    return n
+
+
+if __name__ == '__main__':
+    program = os.path.basename(sys.argv[0])
+    logger = logging.getLogger(program)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    logger.info('running ' + program + ' : FinBERT sentiment of the translated reports')
+
+    parser = OptionParser()
+    parser.add_option('-i', '--input', dest='input_dir', default='../../results/translation', help='translated txt files')
+    # Not sentiment_finbert.csv, the scores of the earlier runs kept in the repository
+    parser.add_option('-o', '--output', dest='output_file',
+                      default='../../results/sentiment_analysis/sentiment_finbert_sentences.csv',
+                      help='.csv or .parquet output (needs pyarrow)')
+    parser.add_option('-m', '--model', dest='model_path', default='models/classifier_model/finbert-sentiment',
+                      help='fine-tuned FinBERT classifier')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int', default=128)
+    parser.add_option('-w', '--window', dest='window', type='int', default=8192, help='sentences sorted per window')
+    parser.add_option('--max-seq-length', dest='max_seq_length', type='int', default=64)
+    parser.add_option('--device', dest='device', default=None)
+    parser.add_option('--int8', dest='int8', action='store_true', default=False, help='dynamic int8 quantization (CPU)')
+    parser.add_option('--n-layers', dest='n_layers', type='int', default=None, help='keep this many encoder layers')
+    parser.add_option('--memo', dest='memo', default=None, help='sqlite file of the sentence scores memo')
+    parser.add_option('--metrics-dir', dest='metrics_dir', default='../../results/metrics/finbert',
+                      help='metrics.prom and summary.json of the run')
+    (options, args) = parser.parse_args()
+    metrics.configure(options.metrics_dir)
+
+    # Fails now rather than after scoring if the output format can not be written
+    ResultWriter(options.output_file)
+
+    scorer = FinBertScorer(options.model_path, max_seq_length=options.max_seq_length, batch_size=options.batch_size,
+                           device=options.device, int8=options.int8, n_layers=options.n_layers)
+    if options.memo:
+        from sentiment_memo import SentimentMemo
+        scorer = SentimentMemo(scorer, options.memo)
+
+    score_corpus(options.input_dir, options.output_file, scorer, window=options.window)
+
+    if options.memo:
+        logger.info(scorer.report())
+    logger.info('metrics written to {}'.format(metrics.export(options.metrics_dir)))
@@ -0,0 +1,212 @@
+"""
+Lexicon sentiment of raw Chinese text, without segmentation or translation.
+
+The 积极 / 消极 words of label_word.csv (weights +1 / -1, or given per word) and the negation cues
+are compiled into one Aho-Corasick automaton, and a text is scored in a single pass over its
+characters. Overlapping matches are resolved to the longest one, so 不及预期 is one negative word
+and not the cue 不 followed by 预期. A cue right before a word (at most `window` characters in
+between) flips its sign.
+
+    score = (positive - negative) / (positive + negative), 0 without any match
+
+A cheap first-pass signal ahead of translation and FinBERT, and a baseline for event_study.
+"""
+import os, sys
+import re
+import time
+import logging
+from collections import deque
+from multiprocessing import Pool
+from optparse import OptionParser
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+NEGATIONS = ['不', '没', '没有', '未', '无', '非', '并非', '不再', '未能', '难以', '无法', '尚未', '否认', '避免']
+
+NEGATION = None  # weight of the cue patterns
+
+
+class Automaton(object):
+    """ Aho-Corasick automaton over patterns with a value each.
+
+    Transitions are completed into a DFA over the characters of the patterns, characters outside
+    of them go back to the root, so scanning is one dict lookup per character.
+    """
+
+    def __init__(self, patterns):
+        # patterns: {pattern: value}
+        self.patterns = list(patterns)
+        self.values = [patterns[p] for p in self.patterns]
+
+        goto = [{}]
+        out = [-1]  # index of the pattern ending at the node
+        for k, p in enumerate(self.patterns):
+            node = 0
+            for ch in p:
+                if ch not in goto[node]:
+                    goto.append({})
+                    out.append(-1)
+                    goto[node][ch] = len(goto) - 1
+                node = goto[node][ch]
+            out[node] = k
+
+        # Breadth-first: failure links, longest output through the suffixes, and the DFA
+        fail = [0] * len(goto)
+        self.delta = [dict(g) for g in goto]
+        self.longest = list(out)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            f = fail[node]
+            if self.longest[node] < 0:
+                self.longest[node] = self.longest[f]
+            for ch, nxt in self.delta[f].items():
+                self.delta[node].setdefault(ch, nxt)
+            for ch, child in goto[node].items():
+                fail[child] = self.delta[f].get(ch, 0)
+                queue.append(child)
+
+        self.lengths = [len(p) for p in self.patterns]
+        alphabet = set(ch for p in self.patterns for ch in p)
+        self._runs = re.compile('[%s]+' % ''.join(re.escape(ch) for ch in sorted(alphabet))) if alphabet else None
+
+    def matches(self, text):
+        """ Non-overlapping matches (start, end, pattern index), longest first on overlaps """
+        if self._runs is None:
+            return []
+
+        delta, longest, lengths = self.delta, self.longest, self.lengths
+        found = []
+        # Characters outside the patterns reset to the root, only runs of pattern characters are scanned
+        for run in self._runs.finditer(text):
+            node = 0
+            offset = run.start()
+            for i, ch in enumerate(run.group(), offset + 1):
+                node = delta[node].get(ch, 0)
+                k = longest[node]
+                if k < 0:
+                    continue
+
+                start = i - lengths[k]
+                # A longer match swallows the ones it overlaps, a shorter one is dropped
+                while found and found[-1][1] > start and lengths[found[-1][2]] < lengths[k]:
+                    found.pop()
+                if found and found[-1][1] > start:
+                    continue
+                found.append((start, i, k))
+
+        return found
+
+
+def load_weights(label_path, weights_path=None):
+    '''{word: weight}, +1 for 积极 and -1 for 消极, overridden by a word,weight csv'''
+    df = pd.read_csv(label_path, encoding='utf-8-sig')
+    weights = {}
+    for w in df['积极'].dropna().astype(str):
+        weights[w.strip()] = 1.0
+    for w in df['消极'].dropna().astype(str):
+        weights[w.strip()] = -1.0
+
+    if weights_path:
+        extra = pd.read_csv(weights_path, encoding='utf-8-sig')
+        weights.update(zip(extra['word'].astype(str).str.strip(), extra['weight'].astype(float)))
+
+    return {w: v for w, v in weights.items() if w}
+
+
+class LexiconScorer(object):
+
+    def __init__(self, weights, negations=NEGATIONS, window=2):
+        patterns = {n: NEGATION for n in negations}
+        # A word which is also listed as a cue is a word
+        patterns.update(weights)
+        self.automaton = Automaton(patterns)
+        self.window = window
+
+    def score(self, text):
+        values = self.automaton.values
+        pos = neg = 0.0
+        n_pos = n_neg = n_negated = 0
+        cue_end = -self.window - 1
+
+        for start, end, k in self.automaton.matches(text):
+            v = values[k]
+            if v is NEGATION:
+                cue_end = end
+                continue
+
+            if start - cue_end <= self.window:
+                v = -v
+                n_negated += 1
+            if v > 0:
+                pos += v
+                n_pos += 1
+            elif v < 0:
+                neg -= v
+                n_neg += 1
+
+        return {
+            "sentiment_score": (pos - neg) / (pos + neg) if pos + neg else 0.0,
+            "n_pos": n_pos,
+            "n_neg": n_neg,
+            "n_negated": n_negated,
+            "n_chars": len(text),
+        }
+
+
+_scorer = None
+
+
+def init_worker(scorer):
+    global _scorer
+    _scorer = scorer
+
+
+def _score_file(path):
+    with open(path, encoding='utf-8') as f:
+        return _scorer.score(f.read())
+
+
+def score_files(paths, scorer, n_workers=None, chunksize=64):
+    '''scores of many files, in order, over a process pool (n_workers=1 scores in this process)'''
+    if n_workers == 1:
+        init_worker(scorer)
+        return [_score_file(p) for p in paths]
+
+    with Pool(n_workers, initializer=init_worker, initargs=(scorer,)) as pool:
+        return pool.map(_score_file, paths, chunksize=chunksize)
+
+
+def score_dir(source_dir, scorer, n_workers=None):
+    '''one row per txt file of source_dir (e.g. results/OCR), with the columns used by event_study'''
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames) if f[-3:] == 'txt')
+
+    df = pd.DataFrame(score_files(paths, scorer, n_workers))
+    df.insert(0, "file_name", [os.path.basename(p) for p in paths])
+    return df
+
+
+if __name__ == '__main__':
+    program = os.path.basename(sys.argv[0])
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger(program)
+    logger.info('running ' + program + ': lexicon sentiment of the OCR text')
+
+    parser = OptionParser()
+    parser.add_option('-i', '--input', dest='input_dir', default='../../results/OCR', help='directory of txt files')
+    parser.add_option('-o', '--output', dest='output_file', default='../../results/sentiment_analysis/sentiment_lexicon.csv')
+    parser.add_option('-l', '--labels', dest='label_path', default='../../data/label/label_word.csv')
+    parser.add_option('--weights', dest='weights_path', default=None, help='csv of word,weight overriding the labels')
+    parser.add_option('--window', dest='window', type='int', default=2, help='max characters between a cue and its word')
+    parser.add_option('-w', '--workers', dest='n_workers', type='int', default=None)
+    (options, args) = parser.parse_args()
+
+    scorer = LexiconScorer(load_weights(options.label_path, options.weights_path), window=options.window)
+    t_start = time.time()
+    df = score_dir(options.input_dir, scorer, options.n_workers)
+    df.to_csv(options.output_file, index=False)
+    logger.info('scored {} files in {:.2f}s'.format(len(df), time.time() - t_start))
@@ -4,42 +4,128 @@ import pandas as pd
 import os
 import numpy as np
 
+from price_store import symbol
+
 stock_dir = '/Users/zengxin/Study/Econ2355/data'
 senti_dir = '/Users/zengxin/Study/Econ2355/result'
 
+FREQ_LIST = [1, 5, 10, 20, 30, 60, 100, 200]
+
+
+def price_path(ticker, stock_dir=stock_dir):
+    return os.path.join(stock_dir, "%s.csv" % symbol(ticker))
 
-def calc_return(ticker, date, freq=5):
-    # preprocess for different exchange markets in China
-    if ticker[:1] == "6":
-        file_dir = os.path.join(stock_dir, "%s.SH.csv" % ticker)
-    else:
-        file_dir = os.path.join(stock_dir, "%s.SZ.csv" % ticker)
+
+def load_prices(ticker, stock_dir=stock_dir):
+    # (dates as int yyyymmdd, close prices) of a ticker, or None without its file
+    file_dir = price_path(ticker, stock_dir)
     if not os.path.exists(file_dir):
-        return ticker
-    data = pd.read_csv(file_dir)
-    index_curr = np.argmax(data['日期'].values >= float(date))
-    if index_curr + freq >= data.shape[0]:
-        return ticker
-    ret = (data['收盘价(元)'].values[index_curr+freq] - data['收盘价(元)'].values[index_curr]) / \
-          data['收盘价(元)'].values[index_curr]
-    return ret
+        return None
+    data = pd.read_csv(file_dir, usecols=['日期', '收盘价(元)'], encoding='utf-8-sig')
+    # drops the "数据来源: Wind" footer
+    data = data.dropna()
+    data = data.sort_values('日期')
+    return data['日期'].values.astype(np.int64), data['收盘价(元)'].values.astype(np.float64)
+
+
+class EventReturns(object):
+    """ Returns after events (ticker, date) for many horizons at once.
+
+    Each ticker's prices are loaded once. All tickers are concatenated into one sorted array
+    keyed by (ticker id, date), so the first trading day on or after every event is found by a
+    single np.searchsorted, and the returns of all events and horizons are one array operation.
+    Missing tickers and horizons past the end of the data give NaN.
+    """
+
+    def __init__(self, stock_dir=stock_dir, loader=None):
+        # loader: ticker -> (dates, close) or None, e.g. PriceStore(root).prices instead of the csv files
+        self.loader = loader or (lambda ticker: load_prices(ticker, stock_dir))
+        self.tickers = {}
+        self._dates = []
+        self._close = []
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._prices = np.zeros(0)
+        self._ends = np.zeros(0, dtype=np.int64)
+
+    def load(self, tickers):
+        new = [t for t in dict.fromkeys(tickers) if t not in self.tickers]
+        if not new:
+            return
+
+        for t in new:
+            prices = self.loader(t)
+            if prices is None:
+                prices = (np.zeros(0, dtype=np.int64), np.zeros(0))
+            self.tickers[t] = len(self._dates)
+            self._dates.append(prices[0])
+            self._close.append(prices[1])
+
+        # Dates are yyyymmdd < 10**8, so ticker id * 10**8 + date keeps tickers apart and sorted
+        ids = np.repeat(np.arange(len(self._dates), dtype=np.int64), [len(d) for d in self._dates])
+        self._keys = ids * 10 ** 8 + np.concatenate(self._dates).astype(np.int64)
+        self._prices = np.concatenate(self._close)
+        self._ends = np.cumsum([len(d) for d in self._dates])
 
+    def _locate(self, tickers, dates):
+        # Index of the first trading day on or after each event, and the end of its ticker's prices
+        tickers = np.asarray(tickers).astype(str)
+        dates = np.asarray(dates).astype(np.int64)
+        self.load(tickers)
 
-def calc_corr(freq_list=[1, 5, 10, 20, 30, 60, 100, 200]):
+        ids = np.array([self.tickers[t] for t in tickers], dtype=np.int64)
+        idx = np.searchsorted(self._keys, ids * 10 ** 8 + dates, side='left')
+        end = self._ends[ids] if len(ids) else np.zeros(0, dtype=np.int64)
+        return idx, end
+
+    def days_after(self, tickers, dates):
+        """ Trading days in the data after the base day of each event, -1 without a base day.
+
+        The returns of the horizons up to that number have matured.
+        """
+        idx, end = self._locate(tickers, dates)
+        return end - idx - 1
+
+    def last_dates(self, tickers):
+        # Last trading date of each ticker, 0 for the tickers without prices
+        self.load(tickers)
+        last = {t: int(self._dates[i][-1]) if len(self._dates[i]) else 0 for t, i in self.tickers.items()}
+        return np.array([last[t] for t in tickers], dtype=np.int64)
+
+    def returns(self, tickers, dates, freq_list=FREQ_LIST):
+        """ (n events, n horizons) array of close-to-close returns over freq trading days.
+
+        The base price is the close of the first trading day on or after the event date.
+        """
+        freq = np.asarray(freq_list, dtype=np.int64)
+        idx, end = self._locate(tickers, dates)
+
+        target = idx[:, None] + freq[None, :]
+        valid = target < end[:, None]
+        base = self._prices[np.minimum(idx, len(self._prices) - 1)] if len(self._prices) else np.zeros(len(idx))
+        out = np.full(target.shape, np.nan)
+        out[valid] = self._prices[target[valid]] / np.broadcast_to(base[:, None], target.shape)[valid] - 1
+        return out
+
+
+def calc_return(ticker, date, freq=5, stock_dir=stock_dir):
+    # Single event, NaN when the ticker or the horizon is not in the data
+    return EventReturns(stock_dir).returns([ticker], [int(date)], [freq])[0, 0]
+
+
+def calc_corr(freq_list=FREQ_LIST, engine=None):
     #senti_df = pd.read_csv(os.path.join(senti_dir, "sentiment_finbert_full_final.csv"), index_col="Unnamed: 0")
     senti_df = pd.read_csv(os.path.join(senti_dir, "sentiment_finbert_full_final.csv"))
-    senti_df = senti_df.groupby(["file_name"]).mean()
+    senti_df = senti_df.groupby(["file_name"]).mean(numeric_only=True)
     senti_df = senti_df.reset_index()
     senti_df[["ticker", "date", "redun"]] = senti_df["file_name"].str.split('-', expand=True)
     senti_df = senti_df.drop(["redun", "file_name"], axis=1)
-    for freq in freq_list:
-        senti_df["return_" + str(freq)] = np.nan
-        for i in range(senti_df.shape[0]):
-            ret = calc_return(senti_df["ticker"].values[i], senti_df["date"].values[i], freq)
-            if type(ret) is not str:
-                senti_df.loc[i, "return_" + str(freq)] = ret
+
+    engine = engine or EventReturns()
+    rets = engine.returns(senti_df["ticker"].values, senti_df["date"].values.astype(np.int64), freq_list)
+    for j, freq in enumerate(freq_list):
+        senti_df["return_" + str(freq)] = rets[:, j]
     return senti_df
 
 
 if __name__ == "__main__":
-    calc_corr().to_csv('/Users/zengxin/Study/Econ2355/result/corr_3.csv')
\ No newline at end of file
+    calc_corr().to_csv('/Users/zengxin/Study/Econ2355/result/corr_3.csv')
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar binary store of the daily stock data of data/stock, one directory per ticker.
+
+    <code>.<exchange>/meta.json    number of rows, columns and their dtypes
+    <code>.<exchange>/<column>     one raw little-endian array per column
+
+Dates are int32 (yyyymmdd), everything else float64 with NaN for 'N/A'. Columns are
+memory-mapped on first access, so opening a ticker only reads its meta.json. New trading days
+are appended in place, meta.json is rewritten last and acts as the commit (as in the layout
+store): rows past its count are the leftovers of an interrupted append and are overwritten.
+"""
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+# Columns of the Wind csv exports, in their order
+CSV_COLUMNS = {
+    '日期': 'date',
+    '前收盘价(元)': 'pre_close',
+    '开盘价(元)': 'open',
+    '最高价(元)': 'high',
+    '最低价(元)': 'low',
+    '收盘价(元)': 'close',
+    '成交量(股)': 'volume',
+    '成交金额(元)': 'amount',
+    '涨跌(元)': 'change',
+    '涨跌幅(%)': 'pct_change',
+    '换手率(%)': 'turnover',
+    'A股流通市值(元)': 'a_float_mv',
+    'B股流通市值(元)': 'b_float_mv',
+    '总市值(元)': 'total_mv',
+    'A股流通股本(股)': 'a_float_shares',
+    'B股流通股本(股)': 'b_float_shares',
+    '总股本(股)': 'total_shares',
+    '市盈率': 'pe',
+    '市净率': 'pb',
+    '市销率': 'ps',
+    '市现率': 'pcf',
+}
+
+DATE_DTYPE = np.dtype('<i4')
+VALUE_DTYPE = np.dtype('<f8')
+
+
+def exchange(ticker):
+    # Shanghai codes start with 6, the others are listed in Shenzhen
+    return "SH" if ticker[:1] == "6" else "SZ"
+
+
+def symbol(ticker):
+    # "000001" -> "000001.SZ", full symbols are kept as they are
+    return ticker if "." in ticker else "%s.%s" % (ticker, exchange(ticker))
+
+
+def read_csv(path):
+    # Wind exports are utf-8 with a BOM, older ones are GBK
+    try:
+        data = pd.read_csv(path, encoding='utf-8-sig', na_values=['N/A'])
+    except UnicodeDecodeError:
+        data = pd.read_csv(path, encoding='gbk', na_values=['N/A'])
+
+    # drops the "数据来源: Wind" footer
+    data = data.dropna(subset=['日期'])
+    data = data.rename(columns=CSV_COLUMNS)[list(CSV_COLUMNS.values())]
+    return data.sort_values('date')
+
+
+class TickerData(object):
+    """ Columns of one ticker, mapped lazily. """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self._columns = {}
+
+    def __len__(self):
+        return self.meta["n_rows"]
+
+    @property
+    def columns(self):
+        return list(self.meta["columns"])
+
+    def column(self, name):
+        if name not in self._columns:
+            dtype = np.dtype(self.meta["columns"][name])
+            n = self.meta["n_rows"]
+            if n == 0:
+                self._columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                self._columns[name] = np.memmap(os.path.join(self.root, name), dtype=dtype, mode="r", shape=(n,))
+        return self._columns[name]
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    @property
+    def last_date(self):
+        return self.meta["last_date"]
+
+
+class PriceStore(object):
+
+    def __init__(self, root, mode="r"):
+        # mode "r" opens an existing store read-only, "a" also creates it and allows appends
+        if not os.path.isdir(root):
+            if mode != "a":
+                raise FileNotFoundError(f"No price store in {root}")
+            os.makedirs(root)
+
+        self.root = root
+        self.mode = mode
+        self._tickers = {}
+
+    def symbols(self):
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.exists(os.path.join(self.root, name, "meta.json")))
+
+    def __contains__(self, ticker):
+        return os.path.exists(os.path.join(self.root, symbol(ticker), "meta.json"))
+
+    def ticker(self, ticker):
+        # TickerData of a code ("000001") or a symbol ("000001.SZ"), None if it is not in the store
+        s = symbol(ticker)
+        if s not in self._tickers:
+            if s not in self:
+                return None
+            self._tickers[s] = TickerData(os.path.join(self.root, s))
+        return self._tickers[s]
+
+    def column(self, ticker, name):
+        data = self.ticker(ticker)
+        return None if data is None else data.column(name)
+
+    def prices(self, ticker, name="close"):
+        # (dates, prices) of a ticker or None, the loader of performance.EventReturns
+        data = self.ticker(ticker)
+        if data is None:
+            return None
+        return data.column("date"), data.column(name)
+
+    def append(self, ticker, data):
+        """ Append the rows of a DataFrame (columns named as in CSV_COLUMNS) after the last stored date.
+
+        Rows on or before the last stored date are skipped, so a whole updated export can be passed.
+        Returns the number of rows appended.
+        """
+        if self.mode != "a":
+            raise IOError("Price store is opened read-only")
+
+        s = symbol(ticker)
+        root = os.path.join(self.root, s)
+        current = self.ticker(s)
+        if current is None:
+            os.makedirs(root, exist_ok=True)
+            meta = {"version": 1, "symbol": s, "n_rows": 0, "last_date": 0,
+                    "columns": {name: (DATE_DTYPE if name == "date" else VALUE_DTYPE).str
+                                for name in CSV_COLUMNS.values()}}
+        else:
+            meta = current.meta
+
+        data = data[data["date"].astype(np.int64) > meta["last_date"]]
+        if len(data) == 0:
+            return 0
+
+        n_rows = meta["n_rows"]
+        for name, dtype in meta["columns"].items():
+            dtype = np.dtype(dtype)
+            arr = data[name].to_numpy(dtype=dtype) if name in data else np.full(len(data), np.nan, dtype=dtype)
+            # Drop whatever an interrupted append left after the committed rows, then append
+            with open(os.path.join(root, name), "ab") as f:
+                f.truncate(n_rows * dtype.itemsize)
+                f.write(arr.tobytes())
+
+        meta = dict(meta, n_rows=n_rows + len(data), last_date=int(data["date"].max()))
+        tmp = os.path.join(root, "meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(root, "meta.json"))
+
+        self._tickers[s] = TickerData(root)
+        return len(data)
+
+    def ingest_csv(self, path):
+        # Ticker is taken from the file name, e.g. 000001.SZ.csv
+        return self.append(os.path.basename(path)[:-len(".csv")], read_csv(path))
+
+    def ingest_dir(self, stock_dir):
+        n = {}
+        for name in sorted(os.listdir(stock_dir)):
+            if name.endswith(".csv"):
+                n[name[:-len(".csv")]] = self.ingest_csv(os.path.join(stock_dir, name))
+        return n
+
+
+if __name__ == '__main__':
+    # Ingest or update the store from the csv exports, only new trading days are written
+    stock_dir = '../../data/stock'
+    store_dir = '../../data/prices'
+
+    store = PriceStore(store_dir, mode="a")
+    for s, n in store.ingest_dir(stock_dir).items():
+        print(f"{s}: {n} new rows, {len(store.ticker(s))} in total")
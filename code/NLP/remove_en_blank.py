@@ -3,6 +3,8 @@ import logging
 from optparse import OptionParser
 import re
 
+logger = logging.getLogger(__name__)
+
 
 def remove_en_blank(infile,outfile):
     '''remove the english word and blank from infile, and write into outfile'''
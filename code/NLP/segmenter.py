@@ -0,0 +1,183 @@
+"""
+jieba segmentation with a financial lexicon, for the zhwiki corpus and the OCR output.
+
+The dictionary is jieba's main dictionary plus the words of label_word.csv and the finance term
+list. jieba caches the prefix dictionary of the main one itself (in cache_dir when given, else the
+temp dir), the lexicon words are added on top. Worker pools are started after the dictionary is
+loaded in the parent, so forked workers inherit it and start at once, spawned workers load
+jieba's cache and add the words again.
+"""
+import os, sys
+import time
+import logging
+from multiprocessing import Pool
+from optparse import OptionParser
+
+import jieba
+import yaml
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+MODES = ('default', 'search', 'full')
+
+
+def load_lexicon(label_path=None, terms_path=None):
+    '''words of the 积极 / 消极 columns of label_word.csv and of a term list (one per line)'''
+    words = []
+    if label_path:
+        df = pd.read_csv(label_path, encoding='utf-8-sig')
+        for col in df.columns:
+            words.extend(w.strip() for w in df[col].dropna().astype(str))
+    if terms_path:
+        with open(terms_path, encoding='utf-8') as f:
+            words.extend(line.strip() for line in f)
+    return sorted(set(w for w in words if w))
+
+
+def lexicon_config(config_path='../config.yaml'):
+    '''label words, finance terms and dictionary cache dir of the NLP section of config.yaml, relative to ROOT.
+    Nones without a config file or key'''
+    if not os.path.exists(config_path):
+        return None, None, None
+    with open(config_path) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    nlp = config.get('NLP') or {}
+    paths = [nlp.get(k) for k in ('LabelWords', 'FinanceTerms', 'SegCacheDir')]
+    return tuple(None if p is None else os.path.join(config['ROOT'], p) for p in paths)
+
+
+class Segmenter(object):
+    """ jieba Tokenizer with a user lexicon, picklable so it can be sent to worker processes.
+
+    mode: 'default' (jieba.cut), 'search' (cut_for_search) or 'full' (cut_all).
+    """
+
+    def __init__(self, lexicon=(), cache_dir=None, dictionary=None, mode='default', hmm=True):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode}, one of {MODES}")
+
+        self.lexicon = sorted(set(lexicon))
+        self.cache_dir = cache_dir
+        # main dictionary, jieba's dict.txt by default
+        self.dictionary = dictionary
+        self.mode = mode
+        self.hmm = hmm
+        self._tk = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tk'] = None
+        return state
+
+    @property
+    def tokenizer(self):
+        if self._tk is None:
+            self._tk = self._load()
+        return self._tk
+
+    def _load(self):
+        t_start = time.time()
+        tk = jieba.Tokenizer(self.dictionary)
+        if self.cache_dir:
+            # where jieba keeps its cache of the main dictionary
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tk.tmp_dir = self.cache_dir
+
+        tk.initialize()
+        for w in self.lexicon:
+            tk.add_word(w)
+        logger.debug('loaded the dictionary and {} words in {:.3f}s'.format(len(self.lexicon), time.time() - t_start))
+        return tk
+
+    def cut(self, text):
+        tk = self.tokenizer
+        if self.mode == 'search':
+            return list(tk.cut_for_search(text, HMM=self.hmm))
+        return list(tk.cut(text, cut_all=self.mode == 'full', HMM=self.hmm))
+
+    def seg_line(self, line):
+        return ' '.join(self.cut(line))
+
+
+_segmenter = None
+
+
+def init_worker(segmenter):
+    global _segmenter
+    _segmenter = segmenter
+    _segmenter.tokenizer
+
+
+def _seg_lines(lines):
+    return [_segmenter.seg_line(line) for line in lines]
+
+
+def segment_batch(texts, segmenter, n_workers=None, chunk_size=256):
+    '''segment texts in worker processes, results in the order of texts'''
+    texts = list(texts)
+    if n_workers == 1:
+        return [segmenter.seg_line(t) for t in texts]
+
+    # load the dictionary once here, forked workers inherit it
+    segmenter.tokenizer
+    chunks = [texts[i: i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    with Pool(n_workers, initializer=init_worker, initargs=(segmenter,)) as pool:
+        return [line for out in pool.imap(_seg_lines, chunks) for line in out]
+
+
+def segment_dir(source_dir, target_dir, segmenter, n_workers=None):
+    '''segment every txt file of source_dir (e.g. results/OCR) line by line into target_dir'''
+    jobs = []
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        for subfile in sorted(filenames):
+            if subfile[-3:] == 'txt':
+                jobs.append(os.path.relpath(os.path.join(dirpath, subfile), source_dir))
+
+    lines, owners = [], []
+    for k, rel in enumerate(jobs):
+        with open(os.path.join(source_dir, rel), encoding='utf-8') as f:
+            for line in f:
+                lines.append(line.rstrip('\n'))
+                owners.append(k)
+
+    out = segment_batch(lines, segmenter, n_workers)
+
+    per_file = [[] for _ in jobs]
+    for k, line in zip(owners, out):
+        per_file[k].append(line)
+    for rel, seg in zip(jobs, per_file):
+        out_file = os.path.join(target_dir, rel)
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        with open(out_file, 'w', encoding='utf-8') as f:
+            f.write(''.join(line + '\n' for line in seg))
+    return len(jobs)
+
+
+if __name__ == '__main__':
+    program = os.path.basename(sys.argv[0])
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger(program)
+    logger.info('running ' + program + ': segmentation with the financial lexicon')
+
+    parser = OptionParser()
+    parser.add_option('-i', '--input', dest='input_dir', default='../../results/OCR', help='directory of txt files')
+    parser.add_option('-o', '--output', dest='output_dir', default='../../results/OCR_seg', help='segmented files')
+    parser.add_option('--config', dest='config_path', default='../config.yaml', help='NLP section: lexicon and cache paths')
+    parser.add_option('-l', '--labels', dest='label_path', default=None, help='default: NLP.LabelWords')
+    parser.add_option('-t', '--terms', dest='terms_path', default=None, help='default: NLP.FinanceTerms')
+    parser.add_option('-c', '--cache-dir', dest='cache_dir', default=None, help='default: NLP.SegCacheDir')
+    parser.add_option('-m', '--mode', dest='mode', default='default', help='default, search or full')
+    parser.add_option('-w', '--workers', dest='n_workers', type='int', default=None)
+    (options, args) = parser.parse_args()
+
+    # Options first, then the config, then the paths of the repository
+    label_path, terms_path, cache_dir = lexicon_config(options.config_path)
+    options.label_path = options.label_path or label_path or '../../data/label/label_word.csv'
+    options.terms_path = options.terms_path or terms_path or '../../data/label/finance_terms.txt'
+    options.cache_dir = options.cache_dir or cache_dir or '../../data/cache/jieba'
+
+    segmenter = Segmenter(load_lexicon(options.label_path, options.terms_path), cache_dir=options.cache_dir,
+                          mode=options.mode)
+    n = segment_dir(options.input_dir, options.output_dir, segmenter, options.n_workers)
+    logger.info('segmented {} files into {}'.format(n, options.output_dir))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import hashlib
+import unicodedata
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.sqlite_cache import SQLiteCache
+
+
+def normalize_sentence(sentence):
+    # Full-width forms, case and runs of blanks do not change the sentiment
+    return " ".join(unicodedata.normalize("NFKC", sentence).casefold().split())
+
+
+def model_version(scorer):
+    """ Identifies the scores of a FinBertScorer: model files (name, size, mtime) and the variant. """
+    files = []
+    path = scorer.model_path
+    if path and os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            st = os.stat(os.path.join(path, name))
+            files.append(f"{name}:{st.st_size}:{st.st_mtime_ns}")
+
+    desc = f"{path}|{'|'.join(files)}|{scorer.max_seq_length}|{scorer.int8}|{scorer.n_layers}"
+    return hashlib.sha1(desc.encode("utf-8")).hexdigest()[:16]
+
+
+class SentimentMemo(object):
+    """ Sentence scores memoized by normalized sentence, in front of a FinBertScorer.
+
+    Research reports repeat rating boilerplate, disclaimers and forecast templates word for word,
+    those are only run through the model once. Probabilities are stored as float32 in a
+    SQLiteCache shared by processes, keyed by the model version. Has the `score` method of the
+    scorer, so it can be used in its place.
+    """
+
+    def __init__(self, scorer, path, max_bytes=1 << 30, version=None):
+        self.scorer = scorer
+        self.cache = SQLiteCache(path, max_bytes=max_bytes) if isinstance(path, str) else path
+        self.version = version or model_version(scorer)
+        self.n_sentences = 0
+        self.n_forward = 0
+
+    def key(self, sentence):
+        h = hashlib.sha1(normalize_sentence(sentence).encode("utf-8")).hexdigest()
+        return f"finbert:{self.version}:{h}"
+
+    def score(self, sentences):
+        keys = [self.key(s) for s in sentences]
+        unique = list(dict.fromkeys(keys))
+
+        probs = {k: np.frombuffer(v, dtype=np.float32) for k, v in zip(unique, self.cache.get_many(unique))
+                 if v is not None}
+
+        # One forward pass per new sentence, repeats within the batch included
+        todo = {}
+        for k, s in zip(keys, sentences):
+            if k not in probs:
+                todo.setdefault(k, s)
+
+        if todo:
+            new = self.scorer.score(list(todo.values())).astype(np.float32)
+            self.cache.put_many([(k, p.tobytes()) for k, p in zip(todo, new)])
+            probs.update(zip(todo, new))
+
+        self.n_sentences += len(sentences)
+        self.n_forward += len(todo)
+
+        if not keys:
+            return np.zeros((0, 3), dtype=np.float32)
+        return np.stack([probs[k] for k in keys])
+
+    @property
+    def dedup_ratio(self):
+        # Share of the sentences which did not go through the model
+        return 1 - self.n_forward / self.n_sentences if self.n_sentences else 0.0
+
+    def report(self):
+        return '{} sentences, {} forward passes, dedup ratio {:.1%}'.format(
+            self.n_sentences, self.n_forward, self.dedup_ratio)
@@ -1,33 +1,210 @@
 # -*- coding: utf-8 -*-
 
-from googletrans import Translator
 import os
+import re
+import sys
+import time
+import hashlib
+import threading
+from concurrent import futures
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import metrics
+from common.ratelimit import RateLimiter, backoff
+from common.sqlite_cache import SQLiteCache
 
-def translate_batch(source_dir, target_dir):
+# A sentence ends after these, the punctuation stays with its sentence
+SENTENCE_RE = re.compile(r'[^。！？；!?]*[。！？；!?]+|[^。！？；!?]+')
+CLAUSE_RE = re.compile(r'[^，,、]*[，,、]+|[^，,、]+')
+
+
+def split_sentences(text):
+    return [s.strip() for s in SENTENCE_RE.findall(text) if s.strip()]
+
+
+def chunk_sentences(sentences, max_chars):
+    """ Group sentences into chunks of at most max_chars (sentences are joined by a newline).
+
+    A sentence longer than max_chars is split at commas, and hard-split if it still does not fit.
+    """
+    pieces = []
+    for s in sentences:
+        if len(s) <= max_chars:
+            pieces.append(s)
+            continue
+
+        for clause in CLAUSE_RE.findall(s):
+            pieces.extend(clause[i: i + max_chars] for i in range(0, len(clause), max_chars))
+
+    chunks, current, size = [], [], 0
+    for p in pieces:
+        if current and size + len(p) + 1 > max_chars:
+            chunks.append(current)
+            current, size = [], 0
+        current.append(p)
+        size += len(p) + 1
+
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+class GoogleBackend(object):
+    # googletrans, one Translator per thread as it keeps its own http session
+    name = "google"
+    max_chars = 4500
+
+    def __init__(self):
+        # Imported here so that the module works without googletrans, e.g. with a StubBackend
+        from googletrans import Translator
+
+        self._translator_cls = Translator
+        self._local = threading.local()
+
+    def translate(self, text, src, dest):
+        if not hasattr(self._local, "translator"):
+            self._local.translator = self._translator_cls()
+        return self._local.translator.translate(text, src=src, dest=dest).text
+
+
+class StubBackend(object):
+    # Local stand-in for tests and dry runs, fn maps a chunk of text to its "translation"
+    name = "stub"
+    max_chars = 4500
+
+    def __init__(self, fn=None):
+        self.fn = fn or (lambda text: text)
+        self.calls = 0
+
+    def translate(self, text, src, dest):
+        self.calls += 1
+        return "\n".join(self.fn(line) for line in text.split("\n"))
+
+
+class BatchTranslator(object):
+    """ Translate texts sentence by sentence, with a sentence cache shared between reports.
+
+    Sentences which are not cached are grouped into chunks under the size limit of the backend,
+    and chunks are sent concurrently under a rate limit, with retries.
+    """
+
+    def __init__(self, backend=None, cache=None, src="zh-cn", dest="en", n_workers=4, qps=None,
+                 max_retries=3):
+        self.backend = backend or GoogleBackend()
+        # A SQLiteCache or the path of its file
+        self.cache = SQLiteCache(cache) if isinstance(cache, str) else cache
+        self.src = src
+        self.dest = dest
+        self.max_retries = max_retries
+        self.limiter = RateLimiter(qps) if qps else None
+        self.executor = futures.ThreadPoolExecutor(n_workers)
+
+    def _key(self, sentence):
+        h = hashlib.sha1(sentence.encode("utf-8")).hexdigest()
+        return f"{self.backend.name}:{self.src}:{self.dest}:{h}"
+
+    def _call(self, text):
+        for attempt in range(self.max_retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                with metrics.timer("translate"):
+                    return self.backend.translate(text, self.src, self.dest)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                metrics.count("retries_total", stage="translate", cause=type(e).__name__)
+                time.sleep(backoff(attempt))
+
+    def _translate_chunk(self, chunk):
+        # One request for the whole chunk, one per sentence if the lines do not come back aligned
+        out = self._call("\n".join(chunk)).split("\n")
+        if len(out) == len(chunk):
+            return [s.strip() for s in out]
+        return [self._call(s).strip() for s in chunk]
+
+    def translate_sentences(self, sentences):
+        unique = list(dict.fromkeys(sentences))
+        translated = {}
+
+        if self.cache is not None:
+            cached = self.cache.get_many([self._key(s) for s in unique])
+            translated = {s: v.decode("utf-8") for s, v in zip(unique, cached) if v is not None}
+
+        todo = [s for s in unique if s not in translated]
+        chunks = chunk_sentences(todo, self.backend.max_chars)
+        new = {}
+        for chunk, out in zip(chunks, self.executor.map(self._translate_chunk, chunks)):
+            new.update(zip(chunk, out))
+
+        # Sentences hard-split by chunk_sentences come back in pieces
+        for s in todo:
+            if s not in new:
+                pieces = [p for c in chunk_sentences([s], self.backend.max_chars) for p in c]
+                new[s] = " ".join(new[p] for p in pieces)
+
+        if self.cache is not None and new:
+            self.cache.put_many([(self._key(s), new[s].encode("utf-8")) for s in todo])
+
+        translated.update(new)
+        return [translated[s] for s in sentences]
+
+    def translate(self, text):
+        # Lines are kept, the sentences of a line are joined by a space
+        lines = [split_sentences(line) for line in text.split("\n")]
+        out = iter(self.translate_sentences([s for line in lines for s in line]))
+        return "\n".join(" ".join(next(out) for _ in line) for line in lines)
+
+    def translate_file(self, in_path, out_path):
+        with open(in_path, encoding="utf8") as f:
+            inp = f.read()
+
+        oup = self.translate(inp) if inp.strip() else ""
+
+        # Written to a temporary file first, so that an existing output is always complete
+        tmp = out_path + ".tmp"
+        with open(tmp, "w", encoding="utf8") as f:
+            f.write(oup)
+        os.replace(tmp, out_path)
+
+
+def translate_batch(source_dir, target_dir, translator=None, n_files=4):
+    translator = translator or BatchTranslator()
+
+    jobs = []
     for dirpath, dirnames, filenames in os.walk(source_dir):
+        out_dir = os.path.join(target_dir, os.path.relpath(dirpath, source_dir))
         for subfile in filenames:
-            file_name = os.path.join(source_dir, subfile)
-            if file_name[-3:] != "txt":
+            if subfile[-3:] != "txt":
                 continue
-            out_file = os.path.join(target_dir, subfile)
+            out_file = os.path.join(out_dir, subfile)
             if os.path.exists(out_file):
                 continue
-            print(file_name)
-            with open(file_name, encoding="utf8") as f:
-                inp = f.readlines()
-            if inp:
-                inp = "".join(inp)
-                translator = Translator()
-                oup = translator.translate(inp, src='zh-cn').text
-            else:
-                oup = ""
-            text_file = open(out_file, "w")
-            n = text_file.write(oup)
-            text_file.close()
+            os.makedirs(out_dir, exist_ok=True)
+            jobs.append((os.path.join(dirpath, subfile), out_file))
+
+    print(f"Translating {len(jobs)} files to {target_dir}...")
+    t_start = time.time()
+
+    def fn(job):
+        try:
+            translator.translate_file(*job)
+        except Exception as e:
+            metrics.record_error("translate", e, job[0])
+
+    with futures.ThreadPoolExecutor(n_files) as executor:
+        for i, _ in enumerate(executor.map(fn, jobs)):
+            if (i + 1) % 100 == 0:
+                print(f"{i + 1}/{len(jobs)} files, {(i + 1) / (time.time() - t_start):.2f} files/s")
+
+    if translator.cache is not None:
+        print(f"Sentence cache: {translator.cache.hits} hits, {translator.cache.misses} misses.")
 
 
 if __name__ == "__main__":
+    from googletrans import Translator
+
     # test for translator API
     translator = Translator()
     print(translator.translate('全年销售额同増89%至5028.5亿,超额完成销售目标,克尔瑞排名第五。公司2020年全年实现签约金额5028.5亿元,同比增长8.9%;签约面积3409.2万平方米,同比增长9.2%,销售规模位列行业第五;销售均价47497元/平方米,同比降低03%'
@@ -39,4 +216,5 @@ if __name__ == "__main__":
     # conduct translation in batch for all our files
     source_dir = '/Users/zengxin/Study/Econ2355/OCR'
     target_dir = '/Users/zengxin/Study/Econ2355/OCR_English'
-    translate_batch(source_dir, target_dir)
\ No newline at end of file
+    translate_batch(source_dir, target_dir,
+                    BatchTranslator(cache=os.path.join(target_dir, ".sentences.sqlite"), qps=5))
@@ -0,0 +1,177 @@
+"""
+Single pass over the zhwiki dump: parse, traditional to simplified, remove english and blanks,
+segment with jieba. Replaces running parse_zhwiki_corpus, chinese_t2s, remove_en_blank and
+corpus_zhwiki_seg one after the other with an intermediate file between each.
+
+Articles are sent to worker processes in chunks, at most `max_inflight` chunks are in flight so
+memory stays bounded, and chunks are written in order. After each chunk the output is flushed
+and a checkpoint records it, an interrupted run restarts after the last complete chunk.
+"""
+import os, sys
+import re
+import json
+import time
+import logging
+from collections import deque
+from multiprocessing import Pool
+from optparse import OptionParser
+
+from opencc import OpenCC
+
+from segmenter import Segmenter, load_lexicon, lexicon_config
+
+logger = logging.getLogger(__name__)
+
+relu = re.compile(r'[ a-zA-Z]')  # delete english char and blank
+
+_cc = None
+_segmenter = None
+
+
+def init_worker(segmenter):
+    global _cc, _segmenter
+    _cc = OpenCC('t2s')
+    _segmenter = segmenter
+    _segmenter.tokenizer
+
+
+def process_article(tokens):
+    # same steps as the separate scripts, for one article given as the tokens of WikiCorpus
+    line = _cc.convert(' '.join(tokens))
+    line = relu.sub('', line)
+    return _segmenter.seg_line(line)
+
+
+def process_chunk(chunk):
+    return ''.join(process_article(tokens) + '\n' for tokens in chunk)
+
+
+def iter_wiki(infile):
+    from gensim.corpora import WikiCorpus
+
+    wiki = WikiCorpus(infile, lemmatize=False, dictionary={})  # gensim中的维基百科处理类WikiCorpus
+    return wiki.get_texts()
+
+
+def iter_chunks(texts, chunk_size):
+    chunk = []
+    for tokens in texts:
+        chunk.append(tokens)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Checkpoint(object):
+    """ Chunks written so far and the size of the output file after them. """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {"chunks": 0, "articles": 0, "offset": 0, "chunk_size": None}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def save(self, **state):
+        self.state.update(state)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+
+def run_pipeline(texts, outfile, n_workers=None, chunk_size=1000, max_inflight=None, log_every=10, segmenter=None):
+    """ Process texts (token lists, as WikiCorpus.get_texts) into outfile, one segmented article per line.
+
+    segmenter: a segmenter.Segmenter, plain jieba by default.
+    Resumes from outfile.ckpt when it exists. Returns the number of articles written.
+    """
+    n_workers = n_workers or os.cpu_count()
+    segmenter = segmenter or Segmenter()
+    # loaded before the pool starts, forked workers inherit it
+    segmenter.tokenizer
+    max_inflight = max_inflight or 2 * n_workers
+
+    ckpt = Checkpoint(outfile + '.ckpt')
+    done = ckpt.state["chunks"]
+    if done:
+        chunk_size = ckpt.state["chunk_size"]
+        logger.info('resuming after {} chunks ({} articles)'.format(done, ckpt.state["articles"]))
+
+    fout = open(outfile, 'a', encoding='utf-8')
+    # drop whatever an interrupted run wrote after the last checkpoint
+    fout.truncate(ckpt.state["offset"])
+    fout.seek(ckpt.state["offset"])
+
+    n_articles, n_chunks = ckpt.state["articles"], done
+    t_start, n_start = time.time(), n_articles
+
+    def write(chunk_len, text):
+        nonlocal n_articles, n_chunks
+        fout.write(text)
+        fout.flush()
+        os.fsync(fout.fileno())
+        n_articles += chunk_len
+        n_chunks += 1
+        ckpt.save(chunks=n_chunks, articles=n_articles, offset=fout.tell(), chunk_size=chunk_size)
+
+        if n_chunks % log_every == 0:
+            rate = (n_articles - n_start) / (time.time() - t_start)
+            logger.info('Saved {} articles, {:.0f} articles/s, {:.1f} MB'.format(n_articles, rate, fout.tell() / 2 ** 20))
+
+    try:
+        with Pool(n_workers, initializer=init_worker, initargs=(segmenter,)) as pool:
+            inflight = deque()
+            for i, chunk in enumerate(iter_chunks(texts, chunk_size)):
+                # chunks before the checkpoint still have to be read to move past them
+                if i < done:
+                    continue
+
+                inflight.append((len(chunk), pool.apply_async(process_chunk, (chunk,))))
+                if len(inflight) >= max_inflight:
+                    n, res = inflight.popleft()
+                    write(n, res.get())
+
+            while inflight:
+                n, res = inflight.popleft()
+                write(n, res.get())
+    finally:
+        fout.close()
+
+    logger.info('Finished {} articles in {:.0f}s'.format(n_articles, time.time() - t_start))
+    return n_articles
+
+
+if __name__ == '__main__':
+    program = os.path.basename(sys.argv[0])
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger(program)
+    logger.info('running ' + program + ': parse, t2s, remove english and blank, segment the chinese corpus')
+
+    # parse the parameters
+    parser = OptionParser()
+    parser.add_option('-i', '--input', dest='infile', default='zhwiki-latest-pages-articles.xml.bz2', help='input: Wiki corpus')
+    parser.add_option('-o', '--output', dest='outfile', default='corpus.zhwiki.segwithb.txt', help='output file segmented')
+    parser.add_option('-w', '--workers', dest='n_workers', type='int', default=None)
+    parser.add_option('-c', '--chunk-size', dest='chunk_size', type='int', default=1000, help='articles per chunk')
+    parser.add_option('--config', dest='config_path', default='../config.yaml', help='NLP section: lexicon and cache paths')
+    parser.add_option('-l', '--labels', dest='label_path', default=None, help='label_word.csv, added to the jieba dictionary (default: NLP.LabelWords)')
+    parser.add_option('-t', '--terms', dest='terms_path', default=None, help='finance term list, added to the jieba dictionary (default: NLP.FinanceTerms)')
+    parser.add_option('--seg-cache', dest='cache_dir', default=None, help='cache directory of the jieba dictionary (default: NLP.SegCacheDir)')
+    (options, args) = parser.parse_args()
+
+    # Without options or config.yaml, plain jieba without the lexicon
+    label_path, terms_path, cache_dir = lexicon_config(options.config_path)
+    options.label_path = options.label_path or label_path
+    options.terms_path = options.terms_path or terms_path
+    options.cache_dir = options.cache_dir or cache_dir
+
+    segmenter = Segmenter(load_lexicon(options.label_path, options.terms_path), cache_dir=options.cache_dir)
+
+    try:
+        run_pipeline(iter_wiki(options.infile), options.outfile, n_workers=options.n_workers, chunk_size=options.chunk_size,
+                     segmenter=segmenter)
+    except Exception as err:
+        logger.info(err)
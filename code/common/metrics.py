@@ -0,0 +1,313 @@
+"""
+Counters, gauges and latency histograms of the processing stages, and errors by cause.
+
+    with metrics.timer("detect"):                   stage_seconds{stage} and stage_items_total{stage}
+    metrics.record_error("render", e, pdf_path)     errors_total{stage, cause}, the path is kept too
+    metrics.count("retries_total", stage="ocr", cause="429")
+
+Every process has its own registry. With a metrics directory (metrics.configure(dir), or the
+METRICS_DIR environment variable, inherited by worker processes), flush() writes the registry of
+the process to metrics-<pid>.json there, and collect() merges the files of all processes, to be
+written as a Prometheus text file (write_prometheus) or a JSON run summary (write_summary),
+export() does both at the end of a run. Without one, the metrics stay in memory and flush()
+does nothing.
+"""
+import os
+import glob
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, float("inf"))
+
+HELP = {
+    "stage_seconds": "Latency of one call of the stage",
+    "stage_items_total": "Items (pages, requests, sentences...) completed by the stage",
+    "errors_total": "Errors by stage and cause",
+    "pages_total": "Pages rendered",
+    "retries_total": "Retried requests by stage and cause",
+    "documents_total": "Documents leaving a pipeline stage, by status",
+    "queue_depth": "Documents waiting in front of the stage",
+    "queue_depth_max": "Largest queue depth seen",
+    "workers": "Workers of the stage",
+    "worker_busy_seconds_total": "Time the workers of the stage spent working",
+    "run_seconds": "Wall time of the run",
+}
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry(object):
+    """ Metrics of one process: {name: (kind, {labels: value})}, errors and a sample of their paths.
+
+    Histogram values are [bucket counts..., sum, count]. Gauges of several processes are merged
+    by taking the largest value, counters and histograms are added.
+    """
+
+    def __init__(self, max_paths=1000):
+        self.max_paths = max_paths
+        self.reset()
+
+    def reset(self):
+        # Also called in a forked child, which must not count what its parent did
+        self._lock = threading.Lock()
+        self.metrics = {}
+        self.paths = {}
+
+    def _values(self, name, kind):
+        entry = self.metrics.get(name)
+        if entry is None:
+            entry = self.metrics[name] = (kind, {})
+        return entry[1]
+
+    def inc(self, name, n=1, **labels):
+        with self._lock:
+            values = self._values(name, "counter")
+            k = _key(labels)
+            values[k] = values.get(k, 0) + n
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values(name, "gauge")[_key(labels)] = value
+
+    def max(self, name, value, **labels):
+        with self._lock:
+            values = self._values(name, "gauge")
+            k = _key(labels)
+            values[k] = max(values.get(k, value), value)
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            values = self._values(name, "histogram")
+            k = _key(labels)
+            h = values.get(k)
+            if h is None:
+                h = values[k] = [0] * (len(BUCKETS) + 2)
+            for i, b in enumerate(BUCKETS):
+                if value <= b:
+                    h[i] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+
+    def error(self, stage, cause, path=None):
+        self.inc("errors_total", stage=stage, cause=cause)
+        if path is not None:
+            with self._lock:
+                paths = self.paths.setdefault(f"{stage}:{cause}", [])
+                if len(paths) < self.max_paths:
+                    paths.append(str(path))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "metrics": {name: [kind, [[dict(k), v if kind != "histogram" else list(v)] for k, v in values.items()]]
+                            for name, (kind, values) in self.metrics.items()},
+                "paths": {k: list(v) for k, v in self.paths.items()},
+            }
+
+    def merge(self, snapshot):
+        with self._lock:
+            for name, (kind, values) in snapshot["metrics"].items():
+                own = self._values(name, kind)
+                for labels, v in values:
+                    k = _key(labels)
+                    if k not in own:
+                        own[k] = list(v) if kind == "histogram" else v
+                    elif kind == "histogram":
+                        own[k] = [a + b for a, b in zip(own[k], v)]
+                    elif kind == "gauge":
+                        own[k] = max(own[k], v)
+                    else:
+                        own[k] += v
+
+            for k, paths in snapshot["paths"].items():
+                own = self.paths.setdefault(k, [])
+                own.extend(paths[:max(0, self.max_paths - len(own))])
+
+
+REGISTRY = Registry()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=REGISTRY.reset)
+
+
+def configure(metrics_dir, clear=True):
+    """ Directory of the per-process files, for this process and the worker processes it starts.
+
+    With clear, the files of a previous run are removed.
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    os.environ["METRICS_DIR"] = metrics_dir
+    if clear:
+        for p in glob.glob(os.path.join(metrics_dir, "metrics-*.json")):
+            os.remove(p)
+
+
+def flush(registry=REGISTRY):
+    metrics_dir = os.environ.get("METRICS_DIR")
+    if not metrics_dir:
+        return
+
+    path = os.path.join(metrics_dir, f"metrics-{os.getpid()}.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp, path)
+
+
+def collect(metrics_dir=None, registry=REGISTRY):
+    """ Registry merging this process and the files flushed by the other processes """
+    merged = Registry(registry.max_paths)
+    merged.merge(registry.snapshot())
+
+    metrics_dir = metrics_dir or os.environ.get("METRICS_DIR")
+    if metrics_dir:
+        for p in sorted(glob.glob(os.path.join(metrics_dir, "metrics-*.json"))):
+            if p.endswith(f"metrics-{os.getpid()}.json"):
+                continue
+            with open(p) as f:
+                merged.merge(json.load(f))
+    return merged
+
+
+def count(name, n=1, **labels):
+    REGISTRY.inc(name, n, **labels)
+
+
+def gauge(name, value, **labels):
+    REGISTRY.set(name, value, **labels)
+
+
+def record_error(stage, error, path=None, cause=None):
+    """ Count an error under its cause (the exception class name by default) and log it """
+    cause = cause or (error if isinstance(error, str) else type(error).__name__)
+    REGISTRY.error(stage, cause, path)
+    logger.warning(f"Error: {stage} {cause}: {error} {path if path is not None else ''}".rstrip())
+
+
+@contextmanager
+def timer(stage, n=1):
+    """ Latency of the block into stage_seconds, and n items into stage_items_total if it does not raise """
+    t_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe("stage_seconds", time.perf_counter() - t_start, stage=stage)
+    REGISTRY.inc("stage_items_total", n, stage=stage)
+
+
+def _labels(labels, extra=None):
+    items = sorted(labels.items()) + (extra or [])
+    if not items:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+
+def write_prometheus(path, registry=None, prefix="pd_"):
+    """ Prometheus text exposition format, e.g. for node_exporter's textfile collector """
+    registry = registry or collect()
+    lines = []
+    for name, (kind, values) in sorted(registry.metrics.items()):
+        full = prefix + name
+        lines.append(f"# HELP {full} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {full} {kind}")
+        for k, v in sorted(values.items()):
+            labels = dict(k)
+            if kind != "histogram":
+                lines.append(f"{full}{_labels(labels)} {v}")
+                continue
+
+            cum = 0
+            for b, n in zip(BUCKETS, v):
+                cum += n
+                le = "+Inf" if b == float("inf") else repr(b)
+                lines.append(f"{full}_bucket{_labels(labels, [('le', le)])} {cum}")
+            lines.append(f"{full}_sum{_labels(labels)} {v[-2]}")
+            lines.append(f"{full}_count{_labels(labels)} {v[-1]}")
+
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+
+def quantile(h, q):
+    # Upper bound of the bucket holding the q-quantile of histogram values h
+    total = h[-1]
+    if not total:
+        return None
+    cum = 0
+    for b, n in zip(BUCKETS, h):
+        cum += n
+        if cum >= q * total:
+            return b if b != float("inf") else None
+    return None
+
+
+def summary(registry=None):
+    """ Per stage: items, calls, latency (mean, p50, p95), errors by cause; queues and utilization
+    when they were recorded (pipeline.py); and the failing paths. """
+    registry = registry or collect()
+
+    def values(name):
+        return {dict(k).get("stage"): (dict(k), v) for k, v in registry.metrics.get(name, (None, {}))[1].items()}
+
+    stages = {}
+    for stage, (_, h) in values("stage_seconds").items():
+        stages.setdefault(stage, {}).update({
+            "calls": h[-1],
+            "seconds": round(h[-2], 3),
+            "mean_ms": round(1000 * h[-2] / h[-1], 2) if h[-1] else None,
+            "p50_ms": None if quantile(h, 0.5) is None else 1000 * quantile(h, 0.5),
+            "p95_ms": None if quantile(h, 0.95) is None else 1000 * quantile(h, 0.95),
+        })
+    for stage, (_, n) in values("stage_items_total").items():
+        stages.setdefault(stage, {})["items"] = n
+
+    for kind in ("errors_total", "retries_total", "documents_total"):
+        key = "status" if kind == "documents_total" else "cause"
+        for k, n in registry.metrics.get(kind, (None, {}))[1].items():
+            labels = dict(k)
+            stages.setdefault(labels["stage"], {}).setdefault(kind[:-6], {})[labels[key]] = n
+
+    run = registry.metrics.get("run_seconds", (None, {}))[1].get((), None)
+    busy = values("worker_busy_seconds_total")
+    for stage, (_, n) in values("workers").items():
+        s = stages.setdefault(stage, {})
+        s["workers"] = n
+        if run and stage in busy:
+            s["utilization"] = round(busy[stage][1] / (run * n), 3)
+    for stage, (_, n) in values("queue_depth_max").items():
+        stages.setdefault(stage, {})["queue_depth_max"] = n
+
+    dropped = sum(n for s in stages.values() for status, n in s.get("documents", {}).items() if status != "ok")
+    return {"run_seconds": run, "stages": stages, "documents_dropped": dropped, "error_paths": registry.paths}
+
+
+def write_summary(path, registry=None):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(summary(registry), f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def export(metrics_dir=None, registry=REGISTRY):
+    """ Flush this process, then write metrics.prom and summary.json of all processes to the metrics
+    directory. Returns the directory, None (and nothing is written) without one.
+    """
+    metrics_dir = metrics_dir or os.environ.get("METRICS_DIR")
+    if not metrics_dir:
+        return None
+
+    flush(registry)
+    merged = collect(metrics_dir, registry)
+    write_prometheus(os.path.join(metrics_dir, "metrics.prom"), merged)
+    write_summary(os.path.join(metrics_dir, "summary.json"), merged)
+    return metrics_dir
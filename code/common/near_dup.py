@@ -0,0 +1,242 @@
+"""
+Near-duplicate detection of Chinese text with MinHash and LSH banding.
+
+Texts are cut into character shingles (k consecutive characters, after NFKC and without blanks
+or punctuation), hashed with a vectorized rolling hash. MinHash signatures of a whole batch are
+computed at once with multiply-shift hash functions, and signatures are split into bands: texts
+sharing a band are candidates, and candidates whose estimated Jaccard similarity reaches the
+threshold are duplicates. Adding and querying cost is independent of the number of pairs.
+"""
+import os
+import re
+import unicodedata
+
+import numpy as np
+
+SKIP_RE = re.compile(r'[\s\W_]+', re.UNICODE)
+
+
+def normalize(text):
+    return SKIP_RE.sub('', unicodedata.normalize('NFKC', text)).casefold()
+
+
+def shingle_hashes(text, k=5):
+    """ Distinct 64-bit hashes of the character k-grams of a normalized text """
+    text = normalize(text)
+    if not text:
+        return np.zeros(0, dtype=np.uint64)
+
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype='<u4').astype(np.uint64)
+    if len(codes) < k:
+        k = len(codes)
+
+    # Polynomial hash of every window, wrapping mod 2**64
+    h = np.zeros(len(codes) - k + 1, dtype=np.uint64)
+    base = np.uint64(1099511628211)
+    for j in range(k):
+        h = h * base + codes[j: len(codes) - k + 1 + j]
+    return np.unique(h)
+
+
+class MinHasher(object):
+    """ n_perm multiply-shift hash functions, (a * x + b) >> 32 over the 32-bit folded shingle hash """
+
+    def __init__(self, n_perm=128, seed=1):
+        rng = np.random.RandomState(seed)
+        self.n_perm = n_perm
+        self.seed = seed
+        self.a = rng.randint(1, 2 ** 63, size=n_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.randint(0, 2 ** 63, size=n_perm, dtype=np.uint64)
+
+    def signatures(self, hash_sets, block=1 << 16):
+        """ (n texts, n_perm) uint32 signatures of lists of shingle hashes.
+
+        All shingles of the batch are hashed together, block rows at a time, and reduced per text.
+        A text without shingles gets all ones, which NearDupIndex never matches (see is_empty).
+        """
+        sig = np.full((len(hash_sets), self.n_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+        sizes = np.array([len(h) for h in hash_sets])
+        if sizes.sum() == 0:
+            return sig
+
+        x = np.concatenate([h for h in hash_sets if len(h)])
+        x = (x ^ (x >> np.uint64(32))) & np.uint64(0xFFFFFFFF)
+        owner = np.repeat(np.arange(len(hash_sets)), sizes)
+
+        for start in range(0, len(x), block):
+            xs, os_ = x[start: start + block], owner[start: start + block]
+            hv = ((xs[:, None] * self.a[None, :] + self.b[None, :]) >> np.uint64(32)).astype(np.uint32)
+            # rows of one text are contiguous, reduce each segment to its minimum
+            cuts = np.flatnonzero(np.r_[True, os_[1:] != os_[:-1]])
+            mins = np.minimum.reduceat(hv, cuts, axis=0)
+            ids = os_[cuts]
+            sig[ids] = np.minimum(sig[ids], mins)
+        return sig
+
+
+def is_empty(sig):
+    # Rows of the signatures of texts without shingles (empty, blank or punctuation only)
+    return (sig == np.iinfo(np.uint32).max).all(axis=1)
+
+
+class NearDupIndex(object):
+    """ LSH index of MinHash signatures, documents can be added at any time.
+
+    bands * rows = n_perm. With b bands of r rows, a pair of Jaccard similarity s becomes a
+    candidate with probability 1 - (1 - s**r)**b; the defaults (32 x 4) put the steep part of
+    that curve around 0.4-0.6 so candidates above threshold=0.8 are almost never missed.
+    Texts without shingles are kept but not put in buckets: they are nobody's duplicate.
+    """
+
+    def __init__(self, n_perm=128, bands=32, k=5, threshold=0.8, seed=1):
+        if n_perm % bands:
+            raise ValueError(f"n_perm ({n_perm}) must be a multiple of bands ({bands})")
+
+        self.hasher = MinHasher(n_perm, seed)
+        self.bands = bands
+        self.rows = n_perm // bands
+        self.k = k
+        self.threshold = threshold
+
+        self.keys = []
+        # Rows past len(keys) are free, the array doubles when it is full
+        self._sig = np.zeros((64, n_perm), dtype=np.uint32)
+        self._buckets = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def signatures(self):
+        return self._sig[:len(self.keys)]
+
+    def signature(self, texts):
+        return self.hasher.signatures([shingle_hashes(t, self.k) for t in texts])
+
+    def _band_keys(self, sig):
+        # (n, bands) keys, the bytes of each band
+        view = np.ascontiguousarray(sig).view(np.dtype((np.void, 4 * self.rows)))
+        return view.reshape(len(sig), self.bands)
+
+    def _candidates(self, band_keys):
+        out = set()
+        for b, key in enumerate(band_keys):
+            out.update(self._buckets[b].get(key.tobytes(), ()))
+        return out
+
+    def similarity(self, sig, ids):
+        # Estimated Jaccard similarity of one signature with the indexed documents ids
+        return (self.signatures[ids] == sig[None, :]).mean(axis=1)
+
+    def query_signatures(self, sig):
+        """ For each signature, [(key of an indexed document, estimated similarity)] above threshold """
+        results = []
+        for s, empty, keys in zip(sig, is_empty(sig), self._band_keys(sig)):
+            ids = np.array(sorted(self._candidates(keys)), dtype=np.int64)
+            if empty or len(ids) == 0:
+                results.append([])
+                continue
+            sim = self.similarity(s, ids)
+            keep = sim >= self.threshold
+            results.append([(self.keys[i], x) for i, x in zip(ids[keep].tolist(), sim[keep].tolist())])
+        return results
+
+    def query(self, texts):
+        return self.query_signatures(self.signature(texts))
+
+    def add_signatures(self, keys, sig):
+        start = len(self.keys)
+        if start + len(sig) > len(self._sig):
+            grown = np.zeros((max(2 * len(self._sig), start + len(sig)), self._sig.shape[1]), dtype=np.uint32)
+            grown[:start] = self._sig[:start]
+            self._sig = grown
+        self._sig[start: start + len(sig)] = sig
+
+        for i, (empty, band_keys) in enumerate(zip(is_empty(sig), self._band_keys(sig))):
+            if empty:
+                continue
+            for b, key in enumerate(band_keys):
+                self._buckets[b].setdefault(key.tobytes(), []).append(start + i)
+        self.keys.extend(keys)
+
+    def add(self, keys, texts, skip_duplicates=False):
+        """ Index texts under keys, returns the duplicates of each among the documents before it.
+
+        Documents of the same batch are checked against each other too. With skip_duplicates,
+        a text with a duplicate is not indexed.
+        Returns, for each text, [(key of an indexed document, estimated similarity)].
+        """
+        sig = self.signature(texts)
+        out = []
+        for key, s in zip(keys, sig):
+            dups = self.query_signatures(s[None, :])[0]
+            out.append(dups)
+            if not (skip_duplicates and dups):
+                self.add_signatures([key], s[None, :])
+        return out
+
+    def save(self, path):
+        np.savez_compressed(path, keys=np.array(self.keys, dtype=object), sig=self.signatures,
+                            params=np.array([self.hasher.n_perm, self.bands, self.k]), threshold=self.threshold,
+                            seed=self.hasher.seed)
+
+    @classmethod
+    def load(cls, path, seed=None):
+        # Signatures of another seed never match, a seed which differs from the saved one is an error.
+        # Files saved without their seed used the default one.
+        data = np.load(path, allow_pickle=True)
+        n_perm, bands, k = data["params"].tolist()
+        saved = int(data["seed"]) if "seed" in data.files else None
+        if seed is not None and saved is not None and seed != saved:
+            raise ValueError(f"{path} was built with seed {saved}, not {seed}")
+        seed = seed if seed is not None else (saved if saved is not None else 1)
+
+        index = cls(n_perm, bands, k, float(data["threshold"]), seed)
+        index.add_signatures(list(data["keys"]), data["sig"])
+        return index
+
+
+def unique_files(paths, index, encoding='utf-8'):
+    """ Files (e.g. OCR output) that are not near duplicates of a document of the index, or of an
+    earlier one of paths. They are added to the index under their base name, the duplicates are not,
+    so translation and scoring only run on the returned files.
+    Returns (unique paths, {duplicate path: key of the document it repeats}).
+    """
+    texts = []
+    for p in paths:
+        with open(p, encoding=encoding) as f:
+            texts.append(f.read())
+
+    keep, skipped = [], {}
+    keys = [os.path.basename(p) for p in paths]
+    for p, dups in zip(paths, index.add(keys, texts, skip_duplicates=True)):
+        if dups:
+            skipped[p] = max(dups, key=lambda d: d[1])[0]
+        else:
+            keep.append(p)
+    return keep, skipped
+
+
+def split_overlap(train_texts, test_texts, threshold=0.8, **kwargs):
+    """ Indices of the test texts with a near duplicate in the train texts """
+    index = NearDupIndex(threshold=threshold, **kwargs)
+    index.add_signatures(list(range(len(train_texts))), index.signature(train_texts))
+    return [i for i, dups in enumerate(index.query(test_texts)) if dups]
+
+
+if __name__ == '__main__':
+    import time
+    import pandas as pd
+
+    label_dir = '../../data/label'
+    final = pd.read_csv(f'{label_dir}/label_final.csv', encoding='utf-8-sig')
+    revise = pd.read_csv(f'{label_dir}/label_revise.csv', encoding='utf-8-sig')
+
+    t_start = time.time()
+    index = NearDupIndex()
+    dups = index.add(list(range(len(final))), final['text'].tolist())
+    n_dup = sum(1 for d in dups if d)
+    print(f"label_final: {n_dup} of {len(final)} sentences are near duplicates of an earlier one")
+
+    overlap = split_overlap(final['text'].tolist(), revise['text'].tolist())
+    print(f"label_revise: {len(overlap)} of {len(revise)} sentences are in label_final, {time.time() - t_start:.2f}s")
@@ -0,0 +1,201 @@
+import os
+import time
+import sqlite3
+import threading
+
+
+class SQLiteCache(object):
+    """ Size-bounded key/value cache in a single SQLite file.
+
+    Values are bytes, callers serialize them. The file can be shared by many processes (WAL
+    journal, each process opens its own connection) and the least recently used entries are
+    deleted once the total size goes over max_bytes. The total is kept in the stats table and
+    updated by the transactions which add or delete entries. Hit/miss counts are kept for this
+    instance and summed over all processes in the stats table.
+
+    Reads do not write: the access times of the entries read and the hit/miss counts are written
+    with the next put, or by a read at least sync_every seconds after the last write, or at close.
+    """
+
+    def __init__(self, path, max_bytes=1 << 30, timeout=60, sync_every=10.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.sync_every = sync_every
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._reset_pending()
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute("CREATE TABLE IF NOT EXISTS entries "
+                         "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, atime REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, count INTEGER)")
+            conn.execute("BEGIN IMMEDIATE")
+            # Files written before the total was kept
+            if conn.execute("SELECT count FROM stats WHERE name = 'bytes'").fetchone() is None:
+                conn.execute("INSERT INTO stats (name, count) SELECT 'bytes', COALESCE(SUM(size), 0) FROM entries")
+            conn.commit()
+
+    def _connect(self):
+        # A connection must not be shared with a forked child, reopen it in every new process
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            if self._pid not in (None, os.getpid()):
+                # Reads of the parent, it writes them itself
+                self._reset_pending()
+            self._pid = os.getpid()
+        return self._conn
+
+    def _reset_pending(self):
+        self._touched = {}
+        self._pending_hits = 0
+        self._pending_misses = 0
+        self._synced = time.time()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_lock=None, _conn=None, _pid=None, _touched={}, _pending_hits=0, _pending_misses=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+
+        with self._lock:
+            conn = self._connect()
+            found = {}
+            # Stay below SQLite's limit on the number of bound parameters
+            for i in range(0, len(keys), 500):
+                part = keys[i: i + 500]
+                rows = conn.execute(f"SELECT key, value FROM entries WHERE key IN ({','.join('?' * len(part))})",
+                                    part).fetchall()
+                found.update(rows)
+
+            now = time.time()
+            self._touched.update((k, now) for k in found)
+            n_hits = sum(k in found for k in keys)
+            self.hits += n_hits
+            self.misses += len(keys) - n_hits
+            self._pending_hits += n_hits
+            self._pending_misses += len(keys) - n_hits
+
+            if now - self._synced >= self.sync_every:
+                self._flush(conn)
+
+        return [found.get(k) for k in keys]
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        """ Writes all items, and evicts if needed, in one transaction """
+        if not items:
+            return
+
+        items = dict(items)
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                replaced = self._sizes(conn, list(items))
+                conn.executemany("INSERT OR REPLACE INTO entries (key, value, size, atime) VALUES (?, ?, ?, ?)",
+                                 [(k, sqlite3.Binary(v), len(v), now) for k, v in items.items()])
+                self._add_stats(conn, bytes=sum(map(len, items.values())) - replaced)
+                self._sync(conn)
+                self._evict(conn)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def _sizes(self, conn, keys):
+        # Total size of the entries of keys which exist
+        total = 0
+        for i in range(0, len(keys), 500):
+            part = keys[i: i + 500]
+            total += conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries "
+                                  f"WHERE key IN ({','.join('?' * len(part))})", part).fetchone()[0]
+        return total
+
+    def _add_stats(self, conn, **counts):
+        conn.executemany("INSERT INTO stats (name, count) VALUES (?, ?) "
+                         "ON CONFLICT(name) DO UPDATE SET count = count + excluded.count",
+                         [(name, n) for name, n in counts.items() if n])
+
+    def _sync(self, conn):
+        # Writes the access times and counts of the reads since the last sync, in the caller's transaction
+        if self._touched:
+            conn.executemany("UPDATE entries SET atime = ? WHERE key = ?", [(t, k) for k, t in self._touched.items()])
+        self._add_stats(conn, hits=self._pending_hits, misses=self._pending_misses)
+        self._reset_pending()
+
+    def _flush(self, conn):
+        # _sync in a transaction of its own
+        if self._touched or self._pending_hits or self._pending_misses:
+            conn.execute("BEGIN IMMEDIATE")
+            self._sync(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        if self.max_bytes is None:
+            return
+
+        total = conn.execute("SELECT count FROM stats WHERE name = 'bytes'").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Delete the oldest entries until the cache is 10% below its limit, to evict less often
+        excess = total - int(self.max_bytes * 0.9)
+        freed = 0
+        keys = []
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY atime"):
+            keys.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+
+        conn.executemany("DELETE FROM entries WHERE key = ?", keys)
+        self._add_stats(conn, evictions=len(keys), bytes=-freed)
+
+    def stats(self):
+        # Counts summed over every process which used this cache file
+        with self._lock:
+            conn = self._connect()
+            self._flush(conn)
+            stats = dict(conn.execute("SELECT name, count FROM stats").fetchall())
+            stats["entries"] = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+        return stats
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                try:
+                    self._flush(self._conn)
+                finally:
+                    self._conn.close()
+            self._conn = None
@@ -6,60 +6,299 @@ import ssl
 ssl._create_default_https_context = ssl._create_unverified_context
 
 import os
+import sys
 import json
+import time
+import queue
 import base64
+import hashlib
+import warnings
+import threading
+import http.client
+from concurrent import futures
 from urllib.request import urlopen
 from urllib.request import Request
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlsplit
 
 import yaml
 import cv2
+import numpy as np
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import metrics
+from common.ratelimit import RateLimiter, backoff
+from common.sqlite_cache import SQLiteCache
 
-class BaiduOCR(object):
-    # OCR_URL = "https://aip.baidubce.com/rest/2.0/ocr/v1/accurate_basic"
-    OCR_URL = "https://aip.baidubce.com/rest/2.0/ocr/v1/general_basic"
 
+class BaiduOCRError(Exception):
+
+    def __init__(self, code, msg):
+        super().__init__(f"{code}: {msg}")
+        self.code = code
+        self.msg = msg
+
+
+def encoded_size(im):
+    # Size of the image field as posted by BaiduOCR, base64 then url-encoded ("+", "/" and "="
+    # become 3 characters each), which is what the 4MB limit of the API applies to
+    b64 = base64.b64encode(im)
+    return len(b64) + 2 * (b64.count(b"+") + b64.count(b"/") + b64.count(b"="))
+
+
+class ConnectionPool(object):
+    """ Keep-alive HTTP(S) connections, reused by the threads of the client. """
+
+    def __init__(self, timeout=30, maxsize=32):
+        self.timeout = timeout
+        self._idle = {}
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def _idle_queue(self, key):
+        with self._lock:
+            return self._idle.setdefault(key, queue.LifoQueue(self._maxsize))
+
+    def post(self, url, body, headers):
+        # Returns (status, body bytes), a connection is only put back after a complete response
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+
+        idle = self._idle_queue(key)
+        try:
+            conn = idle.get_nowait()
+        except queue.Empty:
+            cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+            conn = cls(parts.netloc, timeout=self.timeout)
+
+        try:
+            conn.request("POST", path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            try:
+                idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+        return resp.status, data
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                while not idle.empty():
+                    idle.get_nowait().close()
+
+
+class BaiduOCR(object):
+    # The endpoint is appended, e.g. "general_basic" or "accurate_basic"
+    OCR_BASE_URL = "https://aip.baidubce.com/rest/2.0/ocr/v1/"
 
     TOKEN_URL = 'https://aip.baidubce.com/oauth/2.0/token'
 
-    def __init__(self, API_KEY=None, SECRET_KEY=None, token=None):
-        self.token = token or self.fetch_token(API_KEY, SECRET_KEY)
+    # https://cloud.baidu.com/doc/OCR/s/dk3h7y5vr
+    RETRY_CODES = {1, 2, 4, 18, 282000}  # Unknown / unavailable / cluster limit / QPS limit / internal
+    TOKEN_CODES = {110, 111}  # Access token invalid or expired
+    MAX_IMAGE_BYTES = 4 * 1024 * 1024  # Of the image after encoding, see encoded_size
+
+    def __init__(self, API_KEY=None, SECRET_KEY=None, token=None, endpoint="general_basic", base_url=None,
+                 token_url=None, qps=None, n_workers=8, max_retries=5, timeout=30, cache=None):
+        self.api_key = API_KEY
+        self.secret_key = SECRET_KEY
+        self.endpoint = endpoint
+        self.base_url = base_url or BaiduOCR.OCR_BASE_URL
+        self.token_url = token_url or BaiduOCR.TOKEN_URL
+        self.n_workers = n_workers
+        self.max_retries = max_retries
+
+        self.pool = ConnectionPool(timeout=timeout, maxsize=n_workers)
+        self.limiter = RateLimiter(qps) if qps else None
+        self._token_lock = threading.Lock()
+
+        # Responses keyed by image content and endpoint, a SQLiteCache or the path of its file
+        self.cache = SQLiteCache(cache) if isinstance(cache, str) else cache
+
+        self.token = token
+        self.token_expiry = float("inf")
+        if token is None:
+            self.refresh_token()
 
     @staticmethod
-    def fetch_token(API_KEY, SECRET_KEY):
+    def fetch_token(API_KEY, SECRET_KEY, token_url=None):
+        return BaiduOCR.fetch_token_response(API_KEY, SECRET_KEY, token_url)['access_token']
+
+    @staticmethod
+    def fetch_token_response(API_KEY, SECRET_KEY, token_url=None):
         params = {'grant_type': 'client_credentials',
                   'client_id': API_KEY,
                   'client_secret': SECRET_KEY}
 
         post_data = urlencode(params).encode('utf-8')
-        req = Request(BaiduOCR.TOKEN_URL, post_data)
+        req = Request(token_url or BaiduOCR.TOKEN_URL, post_data)
         f = urlopen(req, timeout=5)
         result_str = f.read().decode()
-        result = json.loads(result_str)
-        return result['access_token']
+        return json.loads(result_str)
 
-    @staticmethod
-    def request(token, im):
-        url = BaiduOCR.OCR_URL + "?access_token=" + token
-        data = urlencode({'image': base64.b64encode(im)}).encode('utf-8')
-        req = Request(url, data)
-        f = urlopen(req)
-        resp = json.loads(f.read().decode())
+    def refresh_token(self, stale=None):
+        # Only the first of several threads seeing the same stale token fetches a new one
+        with self._token_lock:
+            if stale is not None and self.token != stale:
+                return
 
-        try:
-            return [r["words"] for r in resp["words_result"]]
-        except:
-            print(resp)
+            if self.api_key is None:
+                raise BaiduOCRError(111, "Access token expired and no API key to refresh it")
+
+            result = BaiduOCR.fetch_token_response(self.api_key, self.secret_key, self.token_url)
+            expires_in = result.get('expires_in')
+            self.token = result['access_token']
+            # Refresh a minute early rather than sending requests with an expiring token
+            self.token_expiry = time.time() + expires_in - 60 if expires_in else float("inf")
+
+    def request(self, im, endpoint=None, params=None, raw=False):
+        """ OCR of encoded image bytes, returns the lines of words or, with raw, the whole response.
+
+        Rate limit and transient errors are retried with backoff, and the token is refreshed when
+        it expires. Other errors raise BaiduOCRError. With a cache, identical images sent to the
+        same endpoint with the same params are answered from it.
+        """
+        if isinstance(self, str):
+            # Called as BaiduOCR.request(token, im), the static method of earlier versions
+            warnings.warn(DEPRECATED_REQUEST, DeprecationWarning, stacklevel=2)
+            return _request_with_token(self, im)
 
-    def query_filepath(self, path):
+        endpoint = endpoint or self.endpoint
+
+        key, resp = None, None
+        if self.cache is not None:
+            key = f"{endpoint}:{urlencode(sorted((params or {}).items()))}:{hashlib.sha1(im).hexdigest()}"
+            cached = self.cache.get(key)
+            resp = None if cached is None else json.loads(cached)
+
+        if resp is None:
+            resp = self._post(im, endpoint, params)
+            if key is not None:
+                self.cache.put(key, json.dumps(resp, ensure_ascii=False).encode("utf-8"))
+
+        return resp if raw else [r["words"] for r in resp["words_result"]]
+
+    def _post(self, im, endpoint, params=None):
+        url = self.base_url + endpoint
+        fields = {'image': base64.b64encode(im)}
+        fields.update(params or {})
+        body = urlencode(fields).encode('utf-8')
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        for attempt in range(self.max_retries + 1):
+            if time.time() > self.token_expiry:
+                self.refresh_token(self.token)
+
+            if self.limiter is not None:
+                self.limiter.acquire()
+
+            token = self.token
+            last = attempt == self.max_retries
+
+            try:
+                with metrics.timer("ocr_request"):
+                    status, data = self.pool.post(url + "?access_token=" + token, body, headers)
+            except (OSError, http.client.HTTPException) as e:
+                if last:
+                    raise
+                metrics.count("retries_total", stage="ocr_request", cause=type(e).__name__)
+                time.sleep(backoff(attempt))
+                continue
+
+            if status == 429 or status >= 500:
+                if last:
+                    raise BaiduOCRError(status, data[:200].decode(errors="replace"))
+                metrics.count("retries_total", stage="ocr_request", cause=f"http_{status}")
+                time.sleep(backoff(attempt))
+                continue
+
+            try:
+                resp = json.loads(data.decode())
+            except ValueError:
+                # e.g. an html error page of a proxy or gateway
+                raise BaiduOCRError(status, f"invalid response: {data[:200].decode(errors='replace')}")
+            if not isinstance(resp, dict):
+                raise BaiduOCRError(status, f"invalid response: {data[:200].decode(errors='replace')}")
+
+            code = resp.get("error_code")
+            if code is None and status >= 400:
+                raise BaiduOCRError(status, data[:200].decode(errors="replace"))
+
+            if code is None:
+                return resp
+
+            if code in BaiduOCR.TOKEN_CODES and not last:
+                metrics.count("retries_total", stage="ocr_request", cause=f"code_{code}")
+                self.refresh_token(token)
+            elif code in BaiduOCR.RETRY_CODES and not last:
+                metrics.count("retries_total", stage="ocr_request", cause=f"code_{code}")
+                time.sleep(backoff(attempt))
+            else:
+                raise BaiduOCRError(code, resp.get("error_msg"))
+
+    def query_filepath(self, path, **kwargs):
         im = open(path, "rb").read()
-        return self.request(self.token, im)
+        return self.request(im, **kwargs)
 
-    def query_cv2im(self, im):
+    def query_cv2im(self, im, **kwargs):
         _, im_arr = cv2.imencode('.jpg', im)  # im_arr: image in Numpy one-dim array format.
         im_bytes = im_arr.tobytes()
-        return self.request(self.token, im_bytes)
+        return self.request(im_bytes, **kwargs)
+
+    def query(self, x, **kwargs):
+        # x: file path, cv2 image or encoded image bytes
+        if isinstance(x, str):
+            return self.query_filepath(x, **kwargs)
+        if isinstance(x, np.ndarray):
+            return self.query_cv2im(x, **kwargs)
+        return self.request(x, **kwargs)
+
+    def batch_query(self, items, raise_errors=False, **kwargs):
+        """ Query many paths / cv2 images concurrently, results are in the order of items.
+
+        A failed item gives None (and the error is counted in metrics) unless raise_errors.
+        """
+
+        def fn(x):
+            try:
+                return self.query(x, **kwargs)
+            except Exception as e:
+                if raise_errors:
+                    raise
+                metrics.record_error("ocr", e, x if isinstance(x, str) else type(x).__name__,
+                                     cause=f"code_{e.code}" if isinstance(e, BaiduOCRError) else None)
+
+        with futures.ThreadPoolExecutor(self.n_workers) as executor:
+            return list(executor.map(fn, items))
+
+
+DEPRECATED_REQUEST = "request(token, im) is deprecated, use BaiduOCR(token=token).request(im)"
+
+
+def _request_with_token(token, im):
+    ocr = BaiduOCR(token=token)
+    try:
+        return ocr.request(im)
+    finally:
+        ocr.pool.close()
+
+
+def request(token, im):
+    """ Deprecated: BaiduOCR.request used to be a static method taking (token, im), which still
+    works, as does this function. Use BaiduOCR(token=token).request(im). API errors now raise
+    BaiduOCRError instead of printing the response and returning None.
+    """
+    warnings.warn(DEPRECATED_REQUEST, DeprecationWarning, stacklevel=2)
+    return _request_with_token(token, im)
 
 
 if __name__ == '__main__':
@@ -69,7 +308,14 @@ if __name__ == '__main__':
     API_KEY = config["OCR"]["APIKey"]
     SECRET_KEY = config["OCR"]["SecretKey"]
 
-    b = BaiduOCR(API_KEY, SECRET_KEY)
+    cache_path = config["OCR"].get("CachePath")
+    if cache_path is not None:
+        cache_path = os.path.join(config["ROOT"], cache_path)
+
+    metrics_dir = os.path.join(config["ROOT"], config["OCR"].get("MetricsDir", "results/metrics/ocr"))
+    metrics.configure(metrics_dir)
+
+    b = BaiduOCR(API_KEY, SECRET_KEY, qps=config["OCR"].get("QPS"), cache=cache_path)
     # Or specify a token
     # b = BaiduOCR(None, None, token)
 
@@ -80,3 +326,10 @@ if __name__ == '__main__':
     # im = cv2.imread(path)
     # resp = b.query_cv2im(im)
     print(resp)
+
+    # Or many images at once, under the QPS limit of the account
+    # resps = b.batch_query([path, im])
+
+    if b.cache is not None:
+        print(f"OCR cache: {b.cache.hits} hits, {b.cache.misses} misses, all processes: {b.cache.stats()}")
+    print(f"Metrics written to {metrics.export(metrics_dir)}")
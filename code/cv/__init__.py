@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules in this folder import each other by name so that they can also be run as scripts from here
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -1,59 +1,176 @@
 import os
+import sys
+import json
 import time
 from concurrent import futures
 
 import yaml
+from tqdm import tqdm
 from pdf2image import convert_from_path
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import metrics
 
-def convert_pdf_to_jpg(pdf_path, output_dir=None, first_page_only=True, dpi=200, n_thread=2):
-    try:
-        images = convert_from_path(pdf_path, dpi=dpi,
-                                   thread_count=n_thread,
-                                   output_folder=None,
-                                   fmt="jpg")
-    except:
-        print(f"Error: {pdf_path}")
-        return None 
+
+def page_filename(pdf_path, page_index):
+    # page_index is 0-based within the whole document
+    filename = os.path.basename(pdf_path).replace(".pdf", "")
+    return f"{filename}-{page_index}.jpg"
 
 
+def convert_pdf_to_jpg(pdf_path, output_dir=None, first_page_only=True, dpi=200, n_thread=2,
+                       first_page=None, last_page=None, fmt="jpg"):
+    # Only the requested pages are rendered by poppler (-f/-l), pages are 1-based and inclusive.
+    # Use fmt="ppm" to get lossless pages when they are consumed in memory rather than from disk.
     if first_page_only:
-            images = images[:1]
+        first_page = first_page or 1
+        last_page = first_page
+
+    try:
+        with metrics.timer("render"):
+            images = convert_from_path(pdf_path, dpi=dpi,
+                                       thread_count=n_thread,
+                                       output_folder=None,
+                                       first_page=first_page,
+                                       last_page=last_page,
+                                       fmt=fmt)
+    except Exception as e:
+        metrics.record_error("render", e, pdf_path)
+        return None
+    metrics.count("pages_total", len(images), stage="render")
 
     if output_dir is not None:
-        filename = os.path.basename(pdf_path).replace(".pdf", "")
+        offset = (first_page or 1) - 1
 
         for i, x in enumerate(images):
-            x.save(os.path.join(output_dir, f"{filename}-{i}.jpg"))
+            x.save(os.path.join(output_dir, page_filename(pdf_path, offset + i)))
 
     return images
 
 
-def batch_convert_pdfs_to_jpgs(input_dir, output_dir, first_page_only=True, dpi=200, n_thread=1):
+class ConversionManifest(object):
+    """ Append-only record of converted pdfs, so that a rerun skips unchanged files.
+
+    Each line is a json object {path, mtime, size, options, pages}. A pdf is considered done if
+    its mtime, size and render options match the last record written for it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be truncated if the previous run was killed
+                        continue
+                    self.entries[entry["path"]] = entry
+
+        self._f = open(path, "a", encoding="utf-8")
+
+    @staticmethod
+    def signature(pdf_path):
+        st = os.stat(pdf_path)
+        return st.st_mtime_ns, st.st_size
+
+    def is_done(self, key, pdf_path, options):
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+
+        mtime, size = self.signature(pdf_path)
+        return entry["mtime"] == mtime and entry["size"] == size and entry["options"] == options
+
+    def mark_done(self, key, pdf_path, options, pages):
+        mtime, size = self.signature(pdf_path)
+        entry = {"path": key, "mtime": mtime, "size": size, "options": options, "pages": pages}
+        self.entries[key] = entry
+
+        self._f.write(json.dumps(entry) + "\n")
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+def _convert_job(pdf_path, out_folder, kwargs):
+    # Runs in a worker process, only the page count is sent back instead of the images
+    images = convert_pdf_to_jpg(pdf_path, out_folder, **kwargs)
+    metrics.flush()
+    return None if images is None else len(images)
+
+
+def batch_convert_pdfs_to_jpgs(input_dir, output_dir, first_page_only=True, dpi=200, n_thread=1,
+                               first_page=None, last_page=None, n_workers=None, max_inflight=None,
+                               manifest_path=None):
     t_start = time.time()
-    tot = 0
+    n_workers = n_workers or os.cpu_count()
+    max_inflight = max_inflight or 2 * n_workers
+
+    kwargs = dict(first_page_only=first_page_only, dpi=dpi, n_thread=n_thread,
+                  first_page=first_page, last_page=last_page)
+    options = {k: v for k, v in kwargs.items() if k != "n_thread"}
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = ConversionManifest(manifest_path or os.path.join(output_dir, ".manifest.jsonl"))
+
+    jobs = []
+    skipped = 0
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        out_folder = os.path.join(output_dir, os.path.relpath(dirpath, input_dir))
+        os.makedirs(out_folder, exist_ok=True)
+
+        for f in sorted(filter(lambda x: x.endswith(".pdf"), filenames)):
+            pdf_path = os.path.join(dirpath, f)
+            key = os.path.relpath(pdf_path, input_dir)
+            if manifest.is_done(key, pdf_path, options):
+                skipped += 1
+                continue
+
+            jobs.append((key, pdf_path, out_folder))
+
+    print(f"Converting {len(jobs)} pdfs to {output_dir}, {skipped} already done...")
 
-    with futures.ProcessPoolExecutor() as executor:
-        for dirpath, dirnames, filenames in os.walk(input_dir):
-            for dirname in dirnames:
-                os.makedirs(os.path.join(dirpath.replace(input_dir, output_dir), dirname), exist_ok=True)
+    tot_pages = 0
+    failed = 0
 
-            files = list(filter(lambda x: x.endswith(".pdf"), filenames))
-            if len(files) == 0:
+    def collect(done):
+        nonlocal tot_pages, failed
+        for fut in done:
+            key, pdf_path = pending.pop(fut)
+            pages = fut.result()
+            pbar.update(1)
+            if pages is None:
+                failed += 1
                 continue
 
-            out_folder = dirpath.replace(input_dir, output_dir)
-            print(f"Converting {len(files)} pdfs to {out_folder}...")
+            manifest.mark_done(key, pdf_path, options, pages)
+            tot_pages += pages
+
+    # Submit lazily so that at most max_inflight pdfs are queued at any time
+    pending = {}
+    with futures.ProcessPoolExecutor(n_workers) as executor, tqdm(total=len(jobs)) as pbar:
+        for key, pdf_path, out_folder in jobs:
+            if len(pending) >= max_inflight:
+                done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                collect(done)
+
+            fut = executor.submit(_convert_job, pdf_path, out_folder, kwargs)
+            pending[fut] = (key, pdf_path)
+
+        collect(futures.wait(pending).done)
 
-            for f in files:
-                executor.submit(convert_pdf_to_jpg(os.path.join(dirpath, f),
-                                                   out_folder,
-                                                   first_page_only=first_page_only,
-                                                   dpi=dpi, n_thread=n_thread))
+    manifest.close()
 
-            tot += len(files)
+    elapsed = time.time() - t_start
+    print(f"Collected {len(jobs) - failed} pdfs ({tot_pages} pages, {failed} failed) in {elapsed:.1f}s, "
+          f"{tot_pages / max(elapsed, 1e-9):.2f} pages/s.")
 
-    print(f"Collected {tot} pdfs in {time.time() - t_start}s.")
+    return {"pdfs": len(jobs) - failed, "pages": tot_pages, "skipped": skipped, "failed": failed,
+            "seconds": elapsed}
 
 
 if __name__ == '__main__':
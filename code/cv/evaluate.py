@@ -2,8 +2,8 @@ import os
 import pickle
 import glob
 import xml.etree.ElementTree as ET
+from concurrent import futures
 
-import cv2
 import numpy as np
 
 
@@ -117,3 +117,224 @@ def cal_accumulated_iox(pred, gt, if_ioa=False, offset=1, joint_thresh=0.2):
 
     a2 = count_area(pred[0], offset)
     return (ai / (a1 + a2 - ai)).item(), rect
+
+
+def iox_matrix(pred, gt, offset=0):
+    """ IoU and IoA (intersection over the gt area) of every pred box against every gt box.
+
+    pred: N x 4 and gt: M x 4 arrays of (l, t, r, b), returns two N x M arrays.
+    """
+    pred = np.asarray(pred, dtype=np.float64).reshape(-1, 4)
+    gt = np.asarray(gt, dtype=np.float64).reshape(-1, 4)
+
+    iw = np.minimum(pred[:, None, 2], gt[None, :, 2]) - np.maximum(pred[:, None, 0], gt[None, :, 0]) + offset
+    ih = np.minimum(pred[:, None, 3], gt[None, :, 3]) - np.maximum(pred[:, None, 1], gt[None, :, 1]) + offset
+    inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+
+    area_pred = (pred[:, 2] - pred[:, 0] + offset) * (pred[:, 3] - pred[:, 1] + offset)
+    area_gt = (gt[:, 2] - gt[:, 0] + offset) * (gt[:, 3] - gt[:, 1] + offset)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iou = inter / (area_pred[:, None] + area_gt[None, :] - inter)
+        ioa = inter / area_gt[None, :]
+
+    return np.nan_to_num(iou), np.nan_to_num(ioa)
+
+
+def _parse_label_job(xml_path):
+    st = os.stat(xml_path)
+    return xml_path, st.st_mtime_ns, st.st_size, parse_label_xml(xml_path)
+
+
+def load_labels(xml_paths, cache_path=None, n_workers=None):
+    """ Parse label xmls in parallel into {image name: [(cls, (l, t, r, b))]}.
+
+    With cache_path, parsed files are kept in a pickle and only new or modified xmls are parsed.
+    """
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cache = pickle.load(f)
+
+    todo = []
+    for p in xml_paths:
+        st = os.stat(p)
+        if p not in cache or cache[p][:2] != (st.st_mtime_ns, st.st_size):
+            todo.append(p)
+
+    if todo:
+        with futures.ProcessPoolExecutor(n_workers) as executor:
+            for p, mtime, size, parsed in executor.map(_parse_label_job, todo, chunksize=64):
+                cache[p] = (mtime, size, parsed)
+
+        if cache_path is not None:
+            with open(cache_path, "wb") as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return dict(cache[p][2] for p in xml_paths)
+
+
+def default_class_of(rtype):
+    # Predicted types of the public models, mapped to the classes of our labels
+    s = str(rtype).lower()
+    return "title" if "title" in s or "headline" in s else "text"
+
+
+def _pred_arrays(item, class_of, min_width=0.0):
+    # Pred boxes in px, as parse_pred, with their scores and classes
+    if not item["layout"]:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=object)
+
+    layout = list(zip(*item["layout"]))
+    boxes = np.array(layout[:4], dtype=np.float64).T
+    scores = np.array(layout[5], dtype=np.float64)
+    classes = np.array([class_of(t) for t in layout[4]], dtype=object)
+
+    k = (boxes[:, 2] - boxes[:, 0]) >= min_width
+    boxes = boxes[k] * [item["w"], item["h"], item["w"], item["h"]]
+
+    return boxes, scores[k], classes[k]
+
+
+def _match(overlap, iou_thresholds):
+    """ Greedy matching of score-sorted preds (rows) to gts (cols), for each threshold.
+
+    Returns a len(iou_thresholds) x N boolean array of true positives.
+    """
+    n, m = overlap.shape
+    tp = np.zeros((len(iou_thresholds), n), dtype=bool)
+    if n == 0 or m == 0:
+        return tp
+
+    # Candidate gts of each pred, best first; a pred only needs to look until the first free one
+    order = np.argsort(-overlap, axis=1)
+    for k, t in enumerate(iou_thresholds):
+        taken = np.zeros(m, dtype=bool)
+        for i in range(n):
+            for j in order[i]:
+                if overlap[i, j] < t:
+                    break
+                if not taken[j]:
+                    taken[j] = True
+                    tp[k, i] = True
+                    break
+
+    return tp
+
+
+def average_precision(tp, scores, n_gt):
+    """ All-point interpolated AP (VOC 2010+) of a ranked list of detections """
+    if n_gt == 0:
+        return np.nan
+    if len(scores) == 0:
+        return 0.0
+
+    order = np.argsort(-scores, kind="stable")
+    tp = tp[order]
+    ctp = np.cumsum(tp)
+    recall = ctp / n_gt
+    precision = ctp / np.arange(1, len(tp) + 1)
+
+    precision = np.concatenate([[0.0], precision, [0.0]])
+    recall = np.concatenate([[0.0], recall, [recall[-1]]])
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+
+    return float(np.sum((recall[1:] - recall[:-1]) * precision[1:]))
+
+
+def evaluate_dataset(items, labels, iou_thresholds=np.arange(0.5, 0.96, 0.05), score_thresholds=(0.2, 0.5, 0.8),
+                     metric="iou", class_of=default_class_of, min_width=0.0):
+    """ Precision, recall and AP of layout items against labels, per class and over all classes.
+
+    items: results of batch_detect (or LayoutStore.items()), labels: output of load_labels.
+    metric: "iou" or "ioa" (intersection over gt area, as cal_max_iox) for matching.
+    Classes are the gt classes, and the "all" entry ignores classes. Returns
+    {class: {"n_gt", "ap" {iou: ap}, "mAP", "precision" and "recall" {iou: [one per score thresh]}}}.
+    """
+    iou_thresholds = np.round(np.asarray(iou_thresholds, dtype=np.float64), 4)
+    score_thresholds = np.asarray(score_thresholds, dtype=np.float64)
+
+    # Per class: list of (scores, tp) per image and the number of gts
+    collected = {}
+
+    def add(cls, overlap, scores):
+        entry = collected.setdefault(cls, {"scores": [], "tp": [], "n_gt": 0})
+        entry["scores"].append(scores)
+        entry["tp"].append(_match(overlap, iou_thresholds))
+        entry["n_gt"] += overlap.shape[1]
+
+    for item in items:
+        name = os.path.basename(item["path"])
+        if name not in labels:
+            continue
+
+        boxes, scores, classes = _pred_arrays(item, class_of, min_width)
+        order = np.argsort(-scores, kind="stable")
+        boxes, scores, classes = boxes[order], scores[order], classes[order]
+
+        gt_classes = np.array([cls for cls, _ in labels[name]], dtype=object)
+        gt_boxes = np.array([rect for _, rect in labels[name]], dtype=np.float64).reshape(-1, 4)
+
+        iou, ioa = iox_matrix(boxes, gt_boxes)
+        overlap = iou if metric == "iou" else ioa
+
+        add("all", overlap, scores)
+        for cls in set(gt_classes) | set(classes):
+            rows, cols = classes == cls, gt_classes == cls
+            add(cls, overlap[np.ix_(rows, cols)], scores[rows])
+
+    report = {}
+    for cls, entry in collected.items():
+        scores = np.concatenate(entry["scores"])
+        tp = np.concatenate(entry["tp"], axis=1)
+        n_gt = entry["n_gt"]
+
+        ap = {float(t): average_precision(tp[k], scores, n_gt) for k, t in enumerate(iou_thresholds)}
+
+        # Precision / recall of the detections kept at each score threshold
+        kept = scores[None, :] >= score_thresholds[:, None]
+        n_kept = kept.sum(axis=1)
+        n_tp = kept.astype(np.int64) @ tp.T.astype(np.int64)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            precision = n_tp / n_kept[:, None]
+            recall = n_tp / n_gt if n_gt else np.full(n_tp.shape, np.nan)
+
+        report[cls] = {
+            "n_gt": n_gt,
+            "n_pred": len(scores),
+            "ap": ap,
+            "mAP": float(np.nanmean(list(ap.values()))) if n_gt else np.nan,
+            "score_thresholds": score_thresholds.tolist(),
+            "precision": {float(t): precision[:, k].tolist() for k, t in enumerate(iou_thresholds)},
+            "recall": {float(t): recall[:, k].tolist() for k, t in enumerate(iou_thresholds)},
+        }
+
+    return report
+
+
+def evaluate_models(layout_paths, labels, **kwargs):
+    """ evaluate_dataset for each model output (layout store or pickle), keyed by its file name """
+    from layout_store import load_items
+
+    return {os.path.basename(p.rstrip("/")): evaluate_dataset(load_items(p), labels, **kwargs)
+            for p in sorted(layout_paths)}
+
+
+def print_report(reports, iou=0.5):
+    print(f"{'model':40s} {'class':8s} {'n_gt':>6s} {'AP@' + str(iou):>8s} {'mAP':>6s}")
+    for model, report in reports.items():
+        for cls, r in sorted(report.items()):
+            print(f"{model:40s} {cls:8s} {r['n_gt']:6d} {r['ap'].get(iou, np.nan):8.3f} {r['mAP']:6.3f}")
+
+
+if __name__ == '__main__':
+    labels_dir = "../../data/labels/test"
+    layout_dir = "../../data/layout"
+
+    labels = load_labels(sorted(glob.glob(os.path.join(labels_dir, "*.xml"))),
+                         cache_path=os.path.join(labels_dir, ".labels.pkl"))
+    print(f"Found {len(labels)} labeled images.")
+
+    layout_paths = [p for p in glob.glob(os.path.join(layout_dir, "*")) if not p.endswith(".pkl")]
+    print_report(evaluate_models(layout_paths, labels))
@@ -0,0 +1,72 @@
+import os
+import sys
+import pickle
+import hashlib
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.sqlite_cache import SQLiteCache
+
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class LayoutCache(object):
+    """ Per-image detection results of one model, keyed by the content of the image.
+
+    The key also covers the model name, a hash of its config, the weights file (path, size and
+    mtime, hashing hundreds of MB on every start is not worth it) and the score threshold, so a
+    changed model never reads results of another one. Entries live in a shared SQLiteCache.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, parser, max_bytes=1 << 30):
+        self.cache = SQLiteCache(path, max_bytes=max_bytes)
+        self.prefix = self.model_signature(parser)
+
+    @classmethod
+    def model_signature(cls, parser):
+        config_hash = file_digest(parser.config_path) if parser.config_path else None
+
+        weights = None
+        if parser.model_path and os.path.exists(parser.model_path):
+            st = os.stat(parser.model_path)
+            weights = f"{os.path.abspath(parser.model_path)}:{st.st_size}:{st.st_mtime_ns}"
+
+        h = hashlib.sha1(f"{cls.VERSION}|{parser.model_name}|{config_hash}|{weights}".encode("utf-8"))
+        return f"{parser.model_name}:{h.hexdigest()[:16]}:{parser.score_thresh}"
+
+    def key(self, im_bytes):
+        return self.key_of(hashlib.sha1(im_bytes).hexdigest())
+
+    def key_of(self, digest):
+        # Same key from the sha1 hex digest of the image, hashed once for several models
+        return f"{self.prefix}:{digest}"
+
+    def get_many(self, keys):
+        # Returns (h, w, layout) or None for each key
+        return [None if v is None else pickle.loads(v) for v in self.cache.get_many(keys)]
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put_many(self, entries):
+        # entries: [(key, h, w, layout)], written in one transaction
+        self.cache.put_many([(k, pickle.dumps((h, w, layout), protocol=pickle.HIGHEST_PROTOCOL))
+                             for k, h, w, layout in entries])
+
+    @property
+    def hits(self):
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        return self.cache.misses
+
+    def stats(self):
+        return self.cache.stats()
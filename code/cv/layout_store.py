@@ -0,0 +1,230 @@
+"""
+Columnar on-disk store of layout detections, one directory per model.
+
+    meta.json    type names (codes index into it), number of pages and boxes
+    paths.txt    image path of each page, one per line
+    pages.bin    per page: first box, number of boxes, image h and w
+    boxes.f32    left, top, right, bottom (in % of the image size, as returned by dump())
+    scores.f32   score of each box
+    types.u8     type code of each box
+
+The arrays are memory-mapped, so one page can be read without loading the others. Pages are
+appended in place, meta.json is rewritten last and acts as the commit: rows past its counts are
+the leftovers of an interrupted append and are overwritten by the next one.
+"""
+import os
+import json
+import pickle
+
+import numpy as np
+
+PAGE_DTYPE = np.dtype([("start", "<i8"), ("count", "<i4"), ("h", "<i4"), ("w", "<i4")])
+
+COLUMNS = {
+    "pages.bin": PAGE_DTYPE,
+    "boxes.f32": np.dtype(("<f4", 4)),
+    "scores.f32": np.dtype("<f4"),
+    "types.u8": np.dtype("u1"),
+}
+
+
+class LayoutStore(object):
+
+    def __init__(self, root, mode="r"):
+        # mode "r" opens an existing store read-only, "a" also creates it and allows append(),
+        # "w" is "a" on an emptied store, the pages of an existing one are dropped
+        self.root = root
+        self.mode = mode
+
+        if mode == "w":
+            for filename in ["meta.json", "paths.txt"] + list(COLUMNS):
+                if os.path.exists(os.path.join(root, filename)):
+                    os.remove(os.path.join(root, filename))
+
+        if not os.path.exists(os.path.join(root, "meta.json")):
+            if mode == "r":
+                raise FileNotFoundError(f"No layout store in {root}")
+
+            os.makedirs(root, exist_ok=True)
+            open(os.path.join(root, "paths.txt"), "wb").close()
+            self.meta = {"version": 1, "types": [], "n_pages": 0, "n_boxes": 0, "paths_nbytes": 0}
+            self._write_meta()
+
+        self._load()
+
+    def _load(self):
+        with open(os.path.join(self.root, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+        self.type_names = self.meta["types"]
+        self._type_codes = {t: i for i, t in enumerate(self.type_names)}
+
+        with open(os.path.join(self.root, "paths.txt"), encoding="utf-8") as f:
+            self._paths = [line.rstrip("\n") for _, line in zip(range(self.meta["n_pages"]), f)]
+        self._index = {p: i for i, p in enumerate(self._paths)}
+
+        self.pages = self._map("pages.bin", self.meta["n_pages"])
+        self.boxes = self._map("boxes.f32", self.meta["n_boxes"])
+        self.scores = self._map("scores.f32", self.meta["n_boxes"])
+        self.types = self._map("types.u8", self.meta["n_boxes"])
+        self._box_page = None
+
+    def _map(self, filename, n):
+        dtype = COLUMNS[filename]
+        if n == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.root, filename), dtype=dtype, mode="r", shape=(n,))
+
+    def _write_meta(self):
+        tmp = os.path.join(self.root, "meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(self.root, "meta.json"))
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, path):
+        return path in self._index
+
+    def paths(self):
+        return list(self._paths)
+
+    def page_index(self, key):
+        return key if isinstance(key, (int, np.integer)) else self._index[key]
+
+    def page(self, key, score_thresh=None):
+        # Returns (boxes, scores, type codes) of one page, as views of the mapped columns
+        start, count, _, _ = self.pages[self.page_index(key)]
+        s = slice(start, start + count)
+        boxes, scores, types = self.boxes[s], self.scores[s], self.types[s]
+
+        if score_thresh is not None:
+            k = scores >= score_thresh
+            boxes, scores, types = boxes[k], scores[k], types[k]
+
+        return boxes, scores, types
+
+    def item(self, key, score_thresh=None):
+        # One page in the format of LayoutBaseParser.batch_detect, for the existing consumers
+        i = self.page_index(key)
+        boxes, scores, types = self.page(i, score_thresh)
+
+        layout = [(l, t, r, b, self.type_names[c], s)
+                  for (l, t, r, b), c, s in zip(boxes.tolist(), types.tolist(), scores.tolist())]
+
+        return {
+            "path": self._paths[i],
+            "h": int(self.pages[i]["h"]),
+            "w": int(self.pages[i]["w"]),
+            "layout": layout
+        }
+
+    def items(self, score_thresh=None):
+        for i in range(len(self)):
+            yield self.item(i, score_thresh)
+
+    @property
+    def box_page(self):
+        # Page index of every box
+        if self._box_page is None:
+            self._box_page = np.repeat(np.arange(len(self)), self.pages["count"])
+        return self._box_page
+
+    def select(self, score_thresh=0.0, types=None):
+        """ Boolean mask over all boxes with score >= score_thresh and, optionally, one of types """
+        mask = self.scores >= score_thresh
+        if types is not None:
+            codes = [self._type_codes[t] for t in types if t in self._type_codes]
+            mask &= np.isin(self.types, codes)
+        return mask
+
+    def count_per_page(self, score_thresh=0.0, types=None):
+        return np.bincount(self.box_page[self.select(score_thresh, types)], minlength=len(self))
+
+    def append(self, items):
+        """ Append items in the format of LayoutBaseParser.batch_detect (layout may be None).
+
+        A path which is already in the store points to its latest version afterwards.
+        """
+        if self.mode == "r":
+            raise IOError("Layout store is opened read-only")
+
+        items = list(items)
+        n_pages, n_boxes = self.meta["n_pages"], self.meta["n_boxes"]
+
+        pages = np.zeros(len(items), dtype=PAGE_DTYPE)
+        boxes, scores, types = [], [], []
+
+        for i, item in enumerate(items):
+            layout = item["layout"] or []
+            pages[i] = (n_boxes, len(layout), item["h"], item["w"])
+            n_boxes += len(layout)
+
+            for l, t, r, b, c, s in layout:
+                if c not in self._type_codes:
+                    self._type_codes[c] = len(self.type_names)
+                    self.type_names.append(c)
+
+                boxes.append((l, t, r, b))
+                scores.append(s)
+                types.append(self._type_codes[c])
+
+        columns = {
+            "pages.bin": pages,
+            "boxes.f32": np.array(boxes, dtype="<f4").reshape(-1, 4),
+            "scores.f32": np.array(scores, dtype="<f4"),
+            "types.u8": np.array(types, dtype="u1"),
+        }
+        committed = {"pages.bin": self.meta["n_pages"], "boxes.f32": self.meta["n_boxes"],
+                     "scores.f32": self.meta["n_boxes"], "types.u8": self.meta["n_boxes"]}
+
+        for filename, arr in columns.items():
+            self._append_file(filename, committed[filename] * COLUMNS[filename].itemsize, arr.tobytes())
+
+        text = "".join(item["path"] + "\n" for item in items).encode("utf-8")
+        self._append_file("paths.txt", self.meta["paths_nbytes"], text)
+
+        self.meta.update(types=self.type_names, n_pages=n_pages + len(items), n_boxes=n_boxes,
+                         paths_nbytes=self.meta["paths_nbytes"] + len(text))
+        self._write_meta()
+        self._load()
+
+    def _append_file(self, filename, offset, data):
+        # Drop whatever an interrupted append left after the committed rows, then append
+        path = os.path.join(self.root, filename)
+        with open(path, "ab") as f:
+            f.truncate(offset)
+            f.write(data)
+
+
+def load_items(layout_path, score_thresh=None):
+    """ Items of a layout store directory, or of a pickle written by older versions """
+    if os.path.isdir(layout_path):
+        return list(LayoutStore(layout_path).items(score_thresh))
+
+    with open(layout_path, "rb") as f:
+        return pickle.load(f)
+
+
+def convert_pickle(pickle_path, store_dir):
+    with open(pickle_path, "rb") as f:
+        results = pickle.load(f)
+
+    store = LayoutStore(store_dir, mode="a")
+    store.append(results)
+    return store
+
+
+if __name__ == '__main__':
+    # Convert the pickled results of parse_layout.py, the pickles are kept as <name>.pkl
+    layout_dir = "../../data/layout"
+
+    for name in sorted(os.listdir(layout_dir)):
+        path = os.path.join(layout_dir, name)
+        if os.path.isdir(path) or name.endswith(".pkl"):
+            continue
+
+        os.rename(path, path + ".pkl")
+        store = convert_pickle(path + ".pkl", path)
+        print(f"Converted {name}: {len(store)} pages, {len(store.scores)} boxes")
@@ -0,0 +1,194 @@
+import os
+import sys
+import gc
+import glob
+import time
+import hashlib
+from collections import OrderedDict
+from concurrent import futures
+
+from tqdm import tqdm
+
+from parse_layout import HarvardLayoutParser, DynamicBatcher, list_images, decode_image
+from layout_cache import LayoutCache
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import metrics
+
+
+class ModelRegistry(object):
+    """ Layout parsers built on first use, of which at most max_loaded are kept in memory.
+
+    Models are named "<dataset>-<config name>" as in data/layout, and the least recently used
+    one is dropped when another has to be loaded. With max_loaded=None all of them are kept.
+    """
+
+    def __init__(self, models_dir=None, score_thresh=0.5, max_loaded=2):
+        self.score_thresh = score_thresh
+        self.max_loaded = max_loaded
+        self.specs = OrderedDict()
+        self._loaded = OrderedDict()
+        self.loads = 0
+
+        if models_dir is not None:
+            self.discover(models_dir)
+
+    def discover(self, models_dir):
+        # Same layout as download_models.py: <models_dir>/<dataset>/<name>.yaml and <name>.pth
+        for dataset in sorted(os.listdir(models_dir)):
+            subdir = os.path.join(models_dir, dataset)
+            for conf in sorted(glob.glob(os.path.join(subdir, "*.yaml"))):
+                name = f"{dataset}-{os.path.basename(conf).split('.')[0]}"
+                self.register(name, dataset, conf.replace("yaml", "pth"), conf)
+
+    def register(self, name, dataset, model_path, config_path, **kwargs):
+        self.specs[name] = dict(model_name=dataset, model_path=model_path, config_path=config_path, **kwargs)
+
+    def names(self):
+        return list(self.specs)
+
+    def loaded(self):
+        return list(self._loaded)
+
+    def get(self, name):
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            return self._loaded[name]
+
+        while self.max_loaded is not None and len(self._loaded) >= self.max_loaded:
+            self.evict()
+
+        parser = self.build(name)
+        self._loaded[name] = parser
+        self.loads += 1
+
+        return parser
+
+    def build(self, name):
+        spec = dict(self.specs[name])
+        spec.setdefault("score_thresh", self.score_thresh)
+        return HarvardLayoutParser(**spec)
+
+    def evict(self):
+        name, _ = self._loaded.popitem(last=False)
+        gc.collect()
+        # Models on the gpu were built with torch, which is not imported otherwise
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        return name
+
+
+def sweep_detect(registry, img_folder, names=None, start=-1, end=-1, chunk_size=64, max_batch_size=8,
+                 max_latency=2.0, n_prefetch=4, cache_path=None, commit_every=64):
+    """ Run several models over the same images, decoding each image only once.
+
+    Models run in groups of at most registry.max_loaded, and each group goes over all the images a
+    chunk at a time, so every model is built once per sweep. With room for all the models there is
+    a single group and each image is decoded once. In a chunk, models with the same
+    preprocess_key() run one after the other on shared inputs, which are dropped after the last
+    of them.
+
+    With cache_path, every model has its LayoutCache in that file: the sha1 of each image is
+    looked up before decoding, only the misses of a model are detected, and new results are
+    committed every commit_every images so an interrupted sweep resumes where it stopped.
+    Returns {name: results} with items in the format of LayoutBaseParser.batch_detect.
+    """
+    names = names or registry.names()
+    impaths = list_images(img_folder, start, end)
+
+    group_size = registry.max_loaded or len(names)
+    groups = [names[i: i + group_size] for i in range(0, len(names), group_size)]
+    print(f"Process {len(impaths)} images with {len(names)} models in {len(groups)} pass(es).")
+
+    results = {name: [] for name in names}
+    batchers = {name: DynamicBatcher(max_batch_size, max_latency) for name in names}
+    caches = {}
+
+    def load(impath):
+        with open(impath, "rb") as f:
+            data = f.read()
+        return data, hashlib.sha1(data).hexdigest()
+
+    def decode(j):
+        im = decode_image(datas[j])
+        if im is None:
+            metrics.record_error("decode", "can not read", chunk[j], cause="DecodeError")
+        return im
+
+    with futures.ThreadPoolExecutor(n_prefetch) as executor, tqdm(total=len(impaths) * len(groups)) as pbar:
+        for group in groups:
+            by_key = OrderedDict()
+            for name in group:
+                parser = registry.get(name)
+                by_key.setdefault(parser.preprocess_key(), []).append(name)
+                if cache_path is not None:
+                    caches[name] = LayoutCache(cache_path, parser)
+            uncommitted = {name: [] for name in group}
+
+            for k in range(0, len(impaths), chunk_size):
+                chunk = impaths[k: k + chunk_size]
+                datas, digests = zip(*executor.map(load, chunk))
+
+                # (h, w, layout) of the images a model already ran on, None for the others
+                found = {name: caches[name].get_many([caches[name].key_of(d) for d in digests])
+                         if name in caches else [None] * len(chunk) for name in group}
+
+                need = [j for j in range(len(chunk)) if any(found[name][j] is None for name in group)]
+                ims = dict(zip(need, executor.map(decode, need)))
+
+                for key_names in by_key.values():
+                    todo = [j for j in need
+                            if ims[j] is not None and any(found[name][j] is None for name in key_names)]
+                    inputs = dict(zip(todo, executor.map(registry.get(key_names[0]).preprocess,
+                                                         [ims[j] for j in todo])))
+
+                    for name in key_names:
+                        misses = [j for j in todo if found[name][j] is None]
+                        layouts = detect_chunk(registry.get(name), name, [chunk[j] for j in misses],
+                                               [ims[j] for j in misses], [inputs[j] for j in misses],
+                                               batchers[name])
+
+                        for j, layout in zip(misses, layouts):
+                            h, w = ims[j].shape[:2]
+                            found[name][j] = (h, w, layout)
+                            if name in caches and layout is not None:
+                                uncommitted[name].append((caches[name].key_of(digests[j]), h, w, layout))
+                    del inputs
+
+                for name in group:
+                    # Images which can not be decoded are left out, as in batch_detect
+                    results[name].extend({"path": impath, "h": hit[0], "w": hit[1], "layout": hit[2]}
+                                         for impath, hit in zip(chunk, found[name]) if hit is not None)
+
+                    if len(uncommitted[name]) >= commit_every:
+                        caches[name].put_many(uncommitted[name])
+                        uncommitted[name] = []
+
+                pbar.update(len(chunk))
+
+            for name in group:
+                if name in caches:
+                    caches[name].put_many(uncommitted[name])
+                    print(f"Layout cache of {name}: {caches[name].hits} hits, {caches[name].misses} misses.")
+
+    return results
+
+
+def detect_chunk(parser, name, paths, ims, inputs, batcher):
+    # Layouts of ims through one model in batches, failed batches are retried one image at a time
+    layouts = []
+    for idx in batcher.batches(range(len(ims))):
+        batch_ims = [ims[i] for i in idx]
+
+        t_start = time.time()
+        try:
+            with metrics.timer("detect_batch", n=len(idx)):
+                layouts.extend(parser.detect_batch(batch_ims, [inputs[i] for i in idx]))
+        except Exception as e:
+            metrics.record_error("detect_batch", e, f"{name}: {len(idx)} images from {paths[idx[0]]}")
+            layouts.extend(parser.detect(im) for im in batch_ims)
+        batcher.update(len(idx), time.time() - t_start)
+
+    return layouts
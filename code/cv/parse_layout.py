@@ -1,17 +1,38 @@
 import os
-import glob
-import pickle
+import sys
+import time
+from collections import deque
 from functools import wraps
 from concurrent import futures
 
 import cv2
 import numpy as np
 from PIL import Image
-import yaml
 from matplotlib import pyplot as plt
-import layoutparser as lp
 from tqdm import tqdm
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import metrics
+
+
+def read_image(impath):
+    # Returns the image in RGB order, or None if it can not be decoded
+    with metrics.timer("decode"):
+        im = cv2.imread(impath)
+    if im is None:
+        metrics.record_error("decode", "can not read", impath, cause="DecodeError")
+        return None
+    return im[:, :, ::-1]
+
+
+def decode_image(data):
+    # Same as read_image, from the encoded bytes of the file
+    with metrics.timer("decode"):
+        im = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if im is None:
+        return None
+    return im[:, :, ::-1]
+
 
 def detect_wrapper(fn):
     @wraps(fn)
@@ -20,15 +41,18 @@ def detect_wrapper(fn):
             impath = None
             if isinstance(im, str):
                 impath = im
-                im = cv2.imread(im)
-                im = im[:, :, ::-1]
+                im = read_image(im)
+                if im is None:
+                    return None
             elif isinstance(im, Image.Image):
-                im = np.ndarray(im)
+                im = np.asarray(im)
 
-            return fn(parser, im, *args, **kwargs)
+            with metrics.timer("detect"):
+                return fn(parser, im, *args, **kwargs)
 
         except Exception as e:
-            print(f"Error: {e} {impath}")
+            # The caller gets None, the error is counted under its cause
+            metrics.record_error("detect", e, impath)
 
     return wrap
 
@@ -79,44 +103,170 @@ class LayoutBaseParser(object):
         # left(%), top(%), right(%), bottom(%), bbx_type(str)
         raise NotImplementedError
 
-    def batch_detect(self, img_folder, start=-1, end=-1):
-        def fn(impath):
-            x = cv2.imread(impath)
-            r = self.detect(impath)
+    @staticmethod
+    def crop(im, bbx):
+        # bbx: left, top, right, bottom in % of the image size
+        h, w = im.shape[:2]
+        left, top, right, bottom = bbx[:4]
+        return im[int(top * h): int(bottom * h), int(left * w): int(right * w)]
+
+    def preprocess(self, im):
+        # Model input of one RGB image, computed ahead of detect_batch in the prefetch threads
+        return im
+
+    def preprocess_key(self):
+        # Parsers with equal keys produce equal preprocess() outputs, which can then be shared
+        return None
+
+    def detect_batch(self, ims, inputs=None, **kwargs):
+        # Parsers which can not run a batch in one pass fall back to one image at a time
+        return [self.detect(im, **kwargs) for im in ims]
+
+    def batch_detect(self, img_folder, start=-1, end=-1, max_batch_size=8, max_latency=2.0, n_prefetch=4,
+                     cache=None, commit_every=64):
+        # cache: a LayoutCache of this parser, only cache misses are detected and new results are
+        # committed every commit_every images, so an interrupted run resumes where it stopped
+        def load(i):
+            # Each image is read and decoded once, here, and its size is taken from the decoded array
+            impath = impaths[i]
+            with open(impath, "rb") as f:
+                data = f.read()
+
+            key = None
+            if cache is not None:
+                key = cache.key(data)
+                hit = cache.get(key)
+                if hit is not None:
+                    return i, None, None, key, hit
+
+            im = decode_image(data)
+            if im is None:
+                metrics.record_error("decode", "can not read", impath, cause="DecodeError")
+                return i, None, None, key, None
+
+            return i, im, self.preprocess(im), key, None
+
+        def misses(loaded):
+            for i, im, inputs, key, hit in loaded:
+                if hit is not None:
+                    h, w, layout = hit
+                    results[i] = {"path": impaths[i], "h": h, "w": w, "layout": layout}
+                    pbar.update(1)
+                elif im is None:
+                    pbar.update(1)
+                else:
+                    yield i, im, inputs, key
+
+        impaths = list_images(img_folder, start, end)
+        print(f"Process {len(impaths)} images.")
 
-            return {
-                "path": impath,
-                "h": x.shape[0],
-                "w": x.shape[1],
-                "layout": r
-            }
+        results = [None] * len(impaths)
+        uncommitted = []
+        batcher = DynamicBatcher(max_batch_size, max_latency)
 
-        impaths = []
+        with futures.ThreadPoolExecutor(n_prefetch) as executor, tqdm(total=len(impaths)) as pbar:
+            loaded = prefetch(executor, load, range(len(impaths)), depth=2 * max_batch_size)
 
-        for dirpath, dirnames, filenames in os.walk(img_folder):
-            valids = filter(lambda x: x.endswith(".jpg"), filenames)
-            files = map(lambda f: os.path.join(dirpath, f), valids)
-            impaths.extend(files)
+            for batch in batcher.batches(misses(loaded)):
+                ims = [x[1] for x in batch]
 
-        impaths = list(sorted(impaths))
-        if end > start >= 0:
-            impaths = impaths[start: end]
-        print(f"Process {len(impaths)} images.")
+                t_start = time.time()
+                try:
+                    with metrics.timer("detect_batch", n=len(ims)):
+                        layouts = self.detect_batch(ims, [x[2] for x in batch])
+                except Exception as e:
+                    # Retried one by one
+                    metrics.record_error("detect_batch", e, f"{len(ims)} images from {impaths[batch[0][0]]}")
+                    layouts = [self.detect(im) for im in ims]
+                batcher.update(len(ims), time.time() - t_start)
+
+                for (i, im, _, key), layout in zip(batch, layouts):
+                    h, w = im.shape[:2]
+                    results[i] = {
+                        "path": impaths[i],
+                        "h": h,
+                        "w": w,
+                        "layout": layout
+                    }
+
+                    if cache is not None and layout is not None:
+                        uncommitted.append((key, h, w, layout))
+
+                if len(uncommitted) >= commit_every:
+                    cache.put_many(uncommitted)
+                    uncommitted = []
+
+                pbar.update(len(batch))
+
+        if cache is not None:
+            cache.put_many(uncommitted)
+            print(f"Layout cache: {cache.hits} hits, {cache.misses} misses.")
+
+        return [r for r in results if r is not None]
+
+
+def list_images(img_folder, start=-1, end=-1):
+    impaths = []
+
+    for dirpath, dirnames, filenames in os.walk(img_folder):
+        valids = filter(lambda x: x.endswith(".jpg"), filenames)
+        files = map(lambda f: os.path.join(dirpath, f), valids)
+        impaths.extend(files)
+
+    impaths = list(sorted(impaths))
+    if end > start >= 0:
+        impaths = impaths[start: end]
+
+    return impaths
 
-        with futures.ThreadPoolExecutor() as executor:
-            # results = list(tqdm(executor.map(self.detect, impaths), total=len(impaths)))
-            results = list(tqdm(executor.map(fn, impaths), total=len(impaths)))
 
-        # if not img_folder.endswith("/"):
-        #     img_folder += "/"
-        # return list(zip(map(lambda x: x.replace(img_folder, ""), impaths), results))
-        # return list(zip(impaths, results))
-        return results
+def prefetch(executor, fn, items, depth):
+    # Like executor.map, but keeps at most depth items in flight so decoded images do not pile up
+    pending = deque()
+    for item in items:
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+
+    while pending:
+        yield pending.popleft().result()
+
+
+class DynamicBatcher(object):
+    """ Groups a stream of items into batches whose size follows the measured latency.
+
+    The batch size doubles while a batch takes less than half of max_latency, and halves when a
+    batch takes longer than max_latency, always between 1 and max_batch_size.
+    """
+
+    def __init__(self, max_batch_size=8, max_latency=2.0):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.size = 1
+
+    def update(self, n, elapsed):
+        if elapsed > self.max_latency:
+            self.size = max(1, self.size // 2)
+        elif elapsed < self.max_latency / 2 and n >= self.size:
+            self.size = min(self.max_batch_size, self.size * 2)
+
+    def batches(self, items):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= self.size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
 
 
 class HarvardLayoutParser(LayoutBaseParser):
     # Source code: https://github.com/Layout-Parser/layout-parser
     # Model zoo: https://layout-parser.readthedocs.io/en/latest/notes/modelzoo.html
+    # torch and layoutparser are imported by the methods which need them, so that the rest of
+    # this module (reading images, batch_detect of other parsers) works without them
 
     PresetLabels = {
         "HJDataset": {1: "Page Frame", 2: "Row", 3: "Title Region", 4: "Text Region", 5: "Title", 6: "Subtitle",
@@ -134,6 +284,12 @@ class HarvardLayoutParser(LayoutBaseParser):
         if label_map is None:
             label_map = HarvardLayoutParser.PresetLabels.get(model_name, None)
 
+        self.model_name = model_name
+        self.model_path = model_path
+        self.config_path = config_path
+        self.score_thresh = score_thresh
+
+        import layoutparser as lp
         self.model = lp.Detectron2LayoutModel(config_path,
                                               model_path=model_path,
                                               extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", score_thresh],
@@ -150,7 +306,40 @@ class HarvardLayoutParser(LayoutBaseParser):
     @detect_wrapper
     def detect(self, im, keep_text_only=True, dump_to_tuples=True, **kwargs):
         layout = self.model.detect(im)
+        return self.postprocess(im, layout, keep_text_only, dump_to_tuples)
+
+    def preprocess(self, im):
+        # Same steps as detectron2's DefaultPredictor, kept apart so that images can be stacked
+        import torch
+        predictor = self.model.model
+        if predictor.input_format == "RGB":
+            im = im[:, :, ::-1]
+
+        h, w = im.shape[:2]
+        x = predictor.aug.get_transform(im).apply_image(im)
+        x = torch.as_tensor(x.astype("float32").transpose(2, 0, 1))
+
+        return {"image": x, "height": h, "width": w}
+
+    def preprocess_key(self):
+        predictor = self.model.model
+        return predictor.input_format, tuple(predictor.aug.short_edge_length), predictor.aug.max_size
+
+    def detect_batch(self, ims, inputs=None, keep_text_only=True, dump_to_tuples=True, **kwargs):
+        # One forward pass over all images, ims are RGB arrays and inputs their preprocess() outputs
+        import torch
+        if inputs is None:
+            inputs = [self.preprocess(im) for im in ims]
+
+        with torch.no_grad():
+            outputs = self.model.model.model(inputs)
+
+        return [self.postprocess(im, self.model.gather_output(out), keep_text_only, dump_to_tuples)
+                for im, out in zip(ims, outputs)]
+
+    def postprocess(self, im, layout, keep_text_only=True, dump_to_tuples=True):
         if keep_text_only:
+            import layoutparser as lp
             layout = lp.Layout([b for b in layout if self.is_text(b.type)])
 
         if dump_to_tuples:
@@ -159,6 +348,7 @@ class HarvardLayoutParser(LayoutBaseParser):
         return layout
 
     def draw(self, im, layout, **kwargs):
+        import layoutparser as lp
         return lp.draw_box(im, layout, box_width=5, show_element_id=True)
 
     def dump(self, im, layout):
@@ -180,54 +370,56 @@ class HarvardLayoutParser(LayoutBaseParser):
 
 
 if __name__ == '__main__':
+    from model_registry import ModelRegistry, sweep_detect
+    from layout_store import LayoutStore
+
     models_dir = "../../models"
     jpgs_dir = "../../data/jpgs"
     layout_output_dir = "../../data/layout"
     vis_output_dir = "../../data/vis"
+    # Per-image results of every model, only new or changed images are detected again
+    layout_cache_path = "../../data/cache/layout.sqlite"
     score_thresh = 0.2
+    # Models kept in memory, all of them by default so that each image is decoded once
+    max_loaded = None
+    # Detect every image again instead of reading the cache
     override = False
     vis = True
+    # metrics.prom and summary.json of the run
+    metrics_dir = "../../results/metrics/parse_layout"
 
-    for dataset in os.listdir(models_dir):
-        subdir = os.path.join(models_dir, dataset)
-        configs = glob.glob(os.path.join(subdir, "*.yaml"))
-
-        for conf in configs:
-            pth = conf.replace("yaml", "pth")
-            name = f"{dataset}-{os.path.basename(conf).split('.')[0]}"
-            print(f"===={name}====")
+    metrics.configure(metrics_dir)
+    registry = ModelRegistry(models_dir, score_thresh=score_thresh, max_loaded=max_loaded)
 
-            parser = HarvardLayoutParser(dataset,
-                                         model_path=pth,
-                                         config_path=conf,
-                                         score_thresh=score_thresh)
+    print(f"===={', '.join(registry.names())}====")
+    results_by_model = sweep_detect(registry, jpgs_dir, cache_path=None if override else layout_cache_path)
+    for name, results in results_by_model.items():
+        if results:
+            print(results[0])
+        # The store is rewritten from the cache, appending would keep both versions of every page
+        LayoutStore(os.path.join(layout_output_dir, name), mode="w").append(results)
+    print(f"Metrics written to {metrics.export(metrics_dir)}")
 
-            layout_outpath = os.path.join(layout_output_dir, f"{name}")
-            if override or not os.path.exists(layout_outpath):
-                results = parser.batch_detect(jpgs_dir)
-                print(results[0])
-                pickle.dump(results, open(layout_outpath, "wb"), protocol=pickle.HIGHEST_PROTOCOL)
-            else:
-                results = None
+    for name in registry.names():
+        layout_outpath = os.path.join(layout_output_dir, f"{name}")
 
-            if vis:
-                if results is None:
-                    results = pickle.load(open(layout_outpath, "rb"))
+        if vis:
+            results = list(LayoutStore(layout_outpath).items())
 
-                this_dir = os.path.join(vis_output_dir, name)
-                if os.path.exists(this_dir):
-                    continue
+            this_dir = os.path.join(vis_output_dir, name)
+            if os.path.exists(this_dir):
+                continue
 
-                os.makedirs(this_dir, exist_ok=False)
+            os.makedirs(this_dir, exist_ok=False)
 
 
-                def draw_and_save(item):
-                    impath = item["path"]
-                    layout = item["layout"]
-                    x = cv2.imread(impath)
-                    show_bbxes_on(x, layout)
-                    cv2.imwrite(os.path.join(this_dir, os.path.basename(impath)), x)
+            def draw_and_save(item):
+                impath = item["path"]
+                layout = item["layout"]
+                x = cv2.imread(impath)
+                show_bbxes_on(x, layout)
+                cv2.imwrite(os.path.join(this_dir, os.path.basename(impath)), x)
 
 
-                with futures.ThreadPoolExecutor() as executor:
-                    results = list(tqdm(executor.map(draw_and_save, results), total=len(results)))
+            with futures.ThreadPoolExecutor() as executor:
+                results = list(tqdm(executor.map(draw_and_save, results), total=len(results)))
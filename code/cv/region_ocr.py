@@ -0,0 +1,187 @@
+"""
+OCR of the text regions found by the layout parser, instead of whole pages.
+
+The text / title / headline boxes of one or several pages are cropped and stacked into a few
+canvases, one request each, and the returned lines are mapped back to their boxes by their
+location. Canvases are re-encoded with a lower jpg quality, or downscaled, until they fit in
+the size limit of the API, which applies to the image once base64 and url-encoded.
+"""
+import os
+
+import cv2
+import numpy as np
+import yaml
+
+from OCR import BaiduOCR, encoded_size
+from parse_layout import HarvardLayoutParser, LayoutBaseParser
+
+
+def encode_under_limit(im, max_bytes=BaiduOCR.MAX_IMAGE_BYTES, max_side=4096, qualities=(95, 85, 75, 60, 45)):
+    """ Encode a cv2 image as jpg under max_side, and under max_bytes once encoded for the request.
+
+    Lower qualities are tried first, then the image is downscaled. Returns (bytes, scale) where
+    scale maps canvas coordinates to the coordinates of the encoded image.
+    """
+    scale = min(1.0, max_side / max(im.shape[:2]))
+
+    while True:
+        x = im if scale == 1.0 else cv2.resize(im, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        for q in qualities:
+            _, buf = cv2.imencode(".jpg", x, [cv2.IMWRITE_JPEG_QUALITY, q])
+            if encoded_size(buf) <= max_bytes:
+                return buf.tobytes(), scale
+
+        scale *= 0.75
+
+
+class RegionOCR(object):
+    """ OCR of layout boxes through stitched canvases.
+
+    Crops are stacked vertically, separated by `gap` white rows, so that a line never spans two
+    crops. The "general" / "accurate" endpoints are used because they return word locations.
+    """
+
+    def __init__(self, ocr, endpoint="general", max_side=4096, max_bytes=BaiduOCR.MAX_IMAGE_BYTES, gap=32,
+                 pad=0.01, min_width=0.0):
+        self.ocr = ocr
+        self.endpoint = endpoint
+        self.max_side = max_side
+        # Of the base64 and url-encoded canvas, not of the jpg
+        self.max_bytes = max_bytes
+        self.gap = gap
+        self.pad = pad
+        self.min_width = min_width
+
+    def crops(self, im, layout):
+        # Text boxes of a page in reading order, with their crops (cv2 images)
+        boxes = [b for b in layout if HarvardLayoutParser.is_text(b[4]) and (b[2] - b[0]) >= self.min_width]
+        boxes.sort(key=lambda b: (b[1], b[0]))
+
+        out = []
+        for b in boxes:
+            l, t, r, bottom = b[:4]
+            c = LayoutBaseParser.crop(im, [max(l - self.pad, 0), t, min(r + self.pad, 1), bottom])
+            if c.size == 0:
+                continue
+
+            # A crop larger than a canvas is downscaled, cutting it would lose its text
+            if max(c.shape[:2]) > self.max_side:
+                f = self.max_side / max(c.shape[:2])
+                c = cv2.resize(c, None, fx=f, fy=f, interpolation=cv2.INTER_AREA)
+            out.append((b, c))
+
+        return out
+
+    def pack(self, crops):
+        """ Stack crops, at most max_side in both dimensions (see crops()), into canvases no taller
+        than max_side.
+
+        Returns [(canvas, [(crop index, y0, y1)])].
+        """
+        canvases = []
+        bands, height, width = [], 0, 0
+
+        def flush():
+            canvas = np.full((height - self.gap, width, 3), 255, dtype=np.uint8)
+            for i, y0, y1 in bands:
+                canvas[y0: y1, :crops[i].shape[1]] = crops[i]
+            canvases.append((canvas, bands))
+
+        for i, c in enumerate(crops):
+            h = c.shape[0]
+            if bands and height + h > self.max_side:
+                flush()
+                bands, height, width = [], 0, 0
+
+            bands.append((i, height, height + h))
+            height += h + self.gap
+            width = max(width, c.shape[1])
+
+        if bands:
+            flush()
+
+        return canvases
+
+    @staticmethod
+    def assign(words_result, bands, scale):
+        # Lines of each band, each word goes to the band holding its vertical center
+        lines = {i: [] for i, _, _ in bands}
+        starts = np.array([y0 for _, y0, _ in bands])
+
+        for w in words_result:
+            loc = w["location"]
+            y = (loc["top"] + loc["height"] / 2) / scale
+            k = max(0, np.searchsorted(starts, y, side="right") - 1)
+            lines[bands[k][0]].append(w["words"])
+
+        return lines
+
+    def ocr_pages(self, pages):
+        """ OCR of the text boxes of several pages (e.g. one report) with as few requests as possible.
+
+        pages: [(cv2 image, layout)] where layout is the output of HarvardLayoutParser.detect.
+        Returns, for each page, [(box, lines)] in reading order.
+        """
+        boxes, crops, owners = [], [], []
+        for k, (im, layout) in enumerate(pages):
+            for b, c in self.crops(im, layout):
+                boxes.append(b)
+                crops.append(c)
+                owners.append(k)
+
+        canvases = self.pack(crops)
+        payloads = [encode_under_limit(canvas, self.max_bytes, self.max_side) for canvas, _ in canvases]
+        resps = self.ocr.batch_query([data for data, _ in payloads], endpoint=self.endpoint, raw=True)
+
+        lines = {}
+        for (canvas, bands), (_, scale), resp in zip(canvases, payloads, resps):
+            if resp is None:
+                continue
+            lines.update(self.assign(resp["words_result"], bands, scale))
+
+        results = [[] for _ in pages]
+        for i, b in enumerate(boxes):
+            results[owners[i]].append((b, lines.get(i)))
+
+        return results
+
+    def ocr_page(self, im, layout):
+        return self.ocr_pages([(im, layout)])[0]
+
+
+if __name__ == '__main__':
+    from layout_store import LayoutStore
+
+    with open("../config.yaml") as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    layout_path = "../../data/layout/PrimaLayout-mask_rcnn_R_50_FPN_3x"
+    output_dir = "../../data/OCR"
+    os.makedirs(output_dir, exist_ok=True)
+
+    ocr = BaiduOCR(config["OCR"]["APIKey"], config["OCR"]["SecretKey"], qps=config["OCR"].get("QPS"))
+    region_ocr = RegionOCR(ocr)
+
+    # One report at a time, so that the crops of all its pages share canvases
+    store = LayoutStore(layout_path)
+    reports = {}
+    for path in store.paths():
+        reports.setdefault(os.path.basename(path).rsplit("-", 1)[0], []).append(path)
+
+    for name, paths in sorted(reports.items()):
+        out_paths = [os.path.join(output_dir, os.path.basename(p).replace(".jpg", ".txt")) for p in paths]
+        if all(map(os.path.exists, out_paths)):
+            continue
+
+        pages = [(cv2.imread(p), store.item(p)["layout"]) for p in paths]
+        results = region_ocr.ocr_pages(pages)
+        if any(lines is None for page in results for _, lines in page):
+            # Some requests failed, the report is left for the next run
+            print(f"{name}: some text regions got no response")
+            continue
+
+        for out_path, page in zip(out_paths, results):
+            with open(out_path, "w", encoding="utf-8") as f:
+                for box, lines in page:
+                    if lines:
+                        f.write("".join(lines) + "\n")
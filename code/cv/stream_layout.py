@@ -0,0 +1,261 @@
+"""
+Stream rendered pdf pages straight into a layout parser.
+
+Pages are rendered by worker processes and handed to the parser process through shared memory,
+so there is no jpg encode / write / read / decode round-trip, and no jpg recompression before
+detection. Writing jpgs is kept as an optional side output of the render workers.
+"""
+import os
+import sys
+import glob
+import time
+import uuid
+import queue
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import yaml
+from tqdm import tqdm
+
+from convert_pdf_to_jpg import convert_pdf_to_jpg, page_filename
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import metrics
+
+
+class SharedPage(object):
+    """ A page image stored in a shared memory block, sent between processes by name.
+
+    The block belongs to whoever calls release(). The creating process does not keep it registered
+    with its resource tracker, which would otherwise unlink it again (or warn about a leak) when
+    that process exits.
+    """
+
+    def __init__(self, name, shape, dtype, pdf_path, page_index):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.pdf_path = pdf_path
+        self.page_index = page_index
+        self._shm = None
+
+    @classmethod
+    def create(cls, im, pdf_path, page_index, name=None):
+        im = np.asarray(im)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=im.nbytes)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        np.ndarray(im.shape, dtype=im.dtype, buffer=shm.buf)[:] = im
+        shm.close()
+
+        return cls(shm.name, im.shape, im.dtype.str, pdf_path, page_index)
+
+    def open(self):
+        # Zero-copy view, it must be dropped before release(). Attaching registers the block with
+        # the tracker of this process, which unlink() in release() unregisters.
+        self._shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def release(self):
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shm"] = None
+        return state
+
+
+def release_leftovers(names):
+    # Blocks which may have been created but were never received, e.g. by a killed worker
+    n = 0
+    for name in names:
+        try:
+            SharedPage(name, None, None, None, None).release()
+            n += 1
+        except FileNotFoundError:
+            pass
+    return n
+
+
+def _render_worker(worker_id, task_q, page_q, stop, current, n_created, jpg_dir, render_kwargs, prefix):
+    # current: shared buffer with the pdf being rendered, read by the parent if this process dies.
+    # n_created: shared count of the blocks named so far, counted before the block is created
+    while not stop.is_set():
+        pdf_path = task_q.get()
+        if pdf_path is None:
+            break
+
+        current.value = pdf_path.encode("utf-8")[:len(current) - 1]
+        images = convert_pdf_to_jpg(pdf_path, jpg_dir, fmt="ppm", **render_kwargs)
+        if images is None:
+            page_q.put(("error", worker_id, pdf_path))
+            continue
+
+        offset = (render_kwargs.get("first_page") or 1) - 1
+        for i, x in enumerate(images):
+            if stop.is_set():
+                break
+            # Blocks while the parser is behind, which bounds the pages held in shared memory
+            name = f"{prefix}{worker_id}_{n_created.value}"
+            n_created.value += 1
+            page_q.put(SharedPage.create(x, pdf_path, offset + i, name=name))
+
+    metrics.flush()
+    page_q.put(("done", worker_id, None))
+
+
+def stream_detect(parser, pdf_paths, jpg_dir=None, n_workers=None, max_pages=16,
+                  first_page_only=True, dpi=200, first_page=None, last_page=None, poll_interval=5.0,
+                  stop_timeout=10.0, **detect_kwargs):
+    """ Render pdfs in worker processes and run parser.detect on the pages as they arrive.
+
+    A render worker which dies (poppler can segfault or be OOM-killed on a bad pdf) is counted as
+    a WorkerDied render error, checked every poll_interval seconds without pages, and the run
+    goes on with the others.
+
+    Returns the same items as LayoutBaseParser.batch_detect, where "path" is the jpg path of the
+    page under jpg_dir (written only if jpg_dir is given) or next to the pdf otherwise.
+    """
+    n_workers = n_workers or max(1, os.cpu_count() - 1)
+    render_kwargs = dict(first_page_only=first_page_only, dpi=dpi, n_thread=1,
+                         first_page=first_page, last_page=last_page)
+
+    if jpg_dir is not None:
+        os.makedirs(jpg_dir, exist_ok=True)
+
+    task_q = mp.Queue()
+    page_q = mp.Queue(maxsize=max_pages)
+    stop = mp.Event()
+    for pdf_path in pdf_paths:
+        task_q.put(pdf_path)
+    for _ in range(n_workers):
+        task_q.put(None)
+
+    # Blocks are named <prefix><worker>_<n>, so the names of those a dead worker never sent are known
+    prefix = f"pdl{os.getpid()}_{uuid.uuid4().hex[:8]}_"
+    current = [mp.RawArray("c", 4096) for _ in range(n_workers)]
+    n_created = [mp.RawValue("q", 0) for _ in range(n_workers)]
+    workers = [mp.Process(target=_render_worker,
+                          args=(i, task_q, page_q, stop, current[i], n_created[i], jpg_dir, render_kwargs, prefix),
+                          daemon=True)
+               for i in range(n_workers)]
+    for w in workers:
+        w.start()
+
+    results = []
+    finished = set()
+    released = set()
+
+    def release(page):
+        page.release()
+        released.add(page.name)
+    pbar = tqdm(total=len(pdf_paths))
+
+    def check_workers():
+        # A worker killed by a signal (segfault or OOM in poppler) never sends "done"
+        for i, w in enumerate(workers):
+            if i not in finished and w.exitcode not in (None, 0):
+                finished.add(i)
+                metrics.record_error("render", f"render worker exited with {w.exitcode}",
+                                     current[i].value.decode("utf-8", "replace"), cause="WorkerDied")
+
+    try:
+        while len(finished) < n_workers:
+            try:
+                page = page_q.get(timeout=poll_interval)
+            except queue.Empty:
+                check_workers()
+                continue
+
+            if isinstance(page, tuple):
+                kind, i, pdf_path = page
+                if kind == "error":
+                    pbar.update(1)
+                else:
+                    finished.add(i)
+                continue
+
+            im = page.open()
+            try:
+                layout = parser.detect(im, **detect_kwargs)
+                h, w = im.shape[:2]
+            finally:
+                del im
+                release(page)
+
+            out_dir = jpg_dir if jpg_dir is not None else os.path.dirname(page.pdf_path)
+            results.append({
+                "path": os.path.join(out_dir, page_filename(page.pdf_path, page.page_index)),
+                "h": h,
+                "w": w,
+                "layout": layout
+            })
+
+            if page.page_index == (first_page or 1) - 1:
+                pbar.update(1)
+
+    finally:
+        pbar.close()
+
+        if len(finished) < n_workers:
+            # Stopped early: the workers stop at their next page, free what they still send, and
+            # terminate those which are still rendering after stop_timeout seconds
+            stop.set()
+            deadline = time.time() + stop_timeout
+            while any(w.is_alive() for w in workers) and time.time() < deadline:
+                try:
+                    page = page_q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if isinstance(page, SharedPage):
+                    release(page)
+
+            for w in workers:
+                w.terminate()
+
+        for w in workers:
+            w.join()
+
+        # Blocks still queued, or created by a worker which died before sending them
+        while True:
+            try:
+                page = page_q.get(timeout=0.1)
+            except queue.Empty:
+                break
+            if isinstance(page, SharedPage):
+                release(page)
+        release_leftovers(f"{prefix}{i}_{k}" for i in range(n_workers) for k in range(n_created[i].value)
+                          if f"{prefix}{i}_{k}" not in released)
+
+    return results
+
+
+if __name__ == '__main__':
+    with open("../config.yaml") as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    from parse_layout import HarvardLayoutParser
+    from layout_store import LayoutStore
+
+    pdfs_dir = os.path.join(config["ROOT"], config["PDF"]["InputDir"])
+    jpgs_dir = None  # Set to config["PDF"]["OutputDir"] to also keep the jpgs
+    layout_output_dir = "../../data/layout"
+
+    dataset = "PrimaLayout"
+    conf = "../../models/PrimaLayout/mask_rcnn_R_50_FPN_3x.yaml"
+    score_thresh = 0.2
+
+    parser = HarvardLayoutParser(dataset,
+                                 model_path=conf.replace("yaml", "pth"),
+                                 config_path=conf,
+                                 score_thresh=score_thresh)
+
+    pdf_paths = sorted(glob.glob(os.path.join(pdfs_dir, "**", "*.pdf"), recursive=True))
+    results = stream_detect(parser, pdf_paths, jpg_dir=jpgs_dir)
+
+    name = f"{dataset}-{os.path.basename(conf).split('.')[0]}"
+    LayoutStore(os.path.join(layout_output_dir, name), mode="w").append(results)
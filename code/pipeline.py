@@ -0,0 +1,553 @@
+"""
+End-to-end run over the pdf reports: render, layout, OCR, near-duplicate filter, translation,
+FinBERT scoring, then the sentiment features and their returns.
+
+Stages are connected by bounded queues, so a report goes through the whole chain while others
+are still rendering, and a slow stage holds back the ones before it instead of piling up pages.
+Each stage has its own workers: process pools for rendering, layout detection and FinBERT,
+threads for the OCR and translation requests, which spend their time waiting on the network.
+
+A SQLite manifest records the last stage each document completed and what it produced (page
+paths, layouts, text files). A rerun, after a crash or with new pdfs, starts every document at
+its next stage, failed documents are retried from the stage which failed.
+
+Stage latencies, errors by cause, queue depths and worker utilization are written to
+PIPELINE.MetricsDir as a Prometheus text file and a JSON summary (see common/metrics.py).
+
+All paths come from config.yaml (see config_template.yaml), relative to ROOT.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import sqlite3
+import logging
+import threading
+from concurrent import futures
+from optparse import OptionParser
+
+import yaml
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from common import metrics
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("render", "layout", "ocr", "dedup", "translate", "score")
+
+
+class Manifest(object):
+    """ Per-document state: last completed stage, status (ok / failed / duplicate) and outputs. """
+
+    def __init__(self, path, timeout=60):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        # Shared by the threads of the runner, writes are serialized by the lock
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS documents "
+                              "(doc TEXT PRIMARY KEY, stage TEXT, status TEXT, data TEXT, error TEXT, updated REAL)")
+
+    def register(self, doc, **data):
+        # New documents only, a known one keeps its state
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO documents VALUES (?, '', 'ok', ?, NULL, ?)",
+                              (doc, json.dumps(data), time.time()))
+
+    def get(self, doc):
+        row = self.conn.execute("SELECT stage, status, data, error FROM documents WHERE doc = ?", (doc,)).fetchone()
+        if row is None:
+            return None
+        return {"stage": row[0], "status": row[1], "data": json.loads(row[2]), "error": row[3]}
+
+    def documents(self):
+        rows = self.conn.execute("SELECT doc, stage, status, data FROM documents ORDER BY doc").fetchall()
+        return [(doc, stage, status, json.loads(data)) for doc, stage, status, data in rows]
+
+    def _update(self, doc, stage, status, data=None, error=None):
+        with self.lock, self.conn:
+            if data is None:
+                self.conn.execute("UPDATE documents SET status = ?, error = ?, updated = ? WHERE doc = ?",
+                                  (status, error, time.time(), doc))
+            else:
+                self.conn.execute("UPDATE documents SET stage = ?, status = ?, data = ?, error = ?, updated = ? "
+                                  "WHERE doc = ?", (stage, status, json.dumps(data), error, time.time(), doc))
+
+    def done(self, doc, stage, data):
+        self._update(doc, stage, "ok", data)
+
+    def duplicate(self, doc, stage, data):
+        self._update(doc, stage, "duplicate", data)
+
+    def fail(self, doc, stage, error):
+        # The stage stays the last completed one, so a rerun tries this stage again
+        self._update(doc, stage, "failed", error=f"{stage}: {error}")
+
+    def summary(self):
+        # {(stage, status): number of documents}
+        rows = self.conn.execute("SELECT stage, status, COUNT(*) FROM documents GROUP BY stage, status").fetchall()
+        return {(stage, status): n for stage, status, n in rows}
+
+    def close(self):
+        self.conn.close()
+
+
+class Stage(object):
+    """ A step of the pipeline, fn(doc, data) returns the outputs to add to data.
+
+    n_workers threads take documents from the queue. fn can do the work itself (I/O) or submit it
+    to a process pool and wait. If the outputs hold "duplicate_of", the document stops here.
+    """
+
+    def __init__(self, name, fn, n_workers=1, maxsize=4, pool=None):
+        self.name = name
+        self.fn = fn
+        self.n_workers = n_workers
+        self.queue = queue.Queue(maxsize)
+        self.pool = pool
+        self.running = n_workers
+        self.n_done = 0
+        self.n_failed = 0
+        self.busy = 0.0
+
+
+class Pipeline(object):
+
+    def __init__(self, manifest, stages):
+        self.manifest = manifest
+        self.stages = stages
+        self._lock = threading.Lock()
+        # (stage, doc, exception) of the documents whose outcome could not be recorded
+        self.errors = []
+
+    def _work(self, k):
+        stage = self.stages[k]
+        nxt = self.stages[k + 1] if k + 1 < len(self.stages) else None
+
+        try:
+            while True:
+                item = stage.queue.get()
+                if item is None:
+                    return
+
+                doc, data = item
+                try:
+                    data = self._process(stage, doc, data)
+                except Exception as e:
+                    # The manifest or metrics update failed (e.g. "database is locked"), the document
+                    # stays at its last recorded stage and the worker goes on with the next one
+                    self._record_failure(stage, doc, e)
+                    continue
+
+                if data is not None and nxt is not None:
+                    # Blocks while the next stage is behind
+                    nxt.queue.put((doc, data))
+        finally:
+            # The last worker of a stage to stop lets the next stage stop once it is drained, even if
+            # this one stopped on an error
+            with self._lock:
+                stage.running -= 1
+                last = stage.running == 0
+            if last and nxt is not None:
+                for _ in range(nxt.n_workers):
+                    nxt.queue.put(None)
+
+    def _process(self, stage, doc, data):
+        # Runs the stage on one document and records the outcome, returns the data to pass on or None
+        t_start = time.time()
+        error = ValueError("stage returned no output")
+        try:
+            out = stage.fn(doc, data)
+        except Exception as e:
+            out = None
+            error = e
+
+        elapsed = time.time() - t_start
+        metrics.count("worker_busy_seconds_total", elapsed, stage=stage.name)
+        with self._lock:
+            stage.busy += elapsed
+
+        if out is None:
+            metrics.record_error(stage.name, error, doc)
+            self.manifest.fail(doc, stage.name, error)
+            self._count(stage, "failed")
+            return None
+
+        data = dict(data, **out)
+
+        if out.get("duplicate_of") is not None:
+            self.manifest.duplicate(doc, stage.name, data)
+            self._count(stage, "duplicate")
+            return None
+
+        self.manifest.done(doc, stage.name, data)
+        self._count(stage, "ok")
+        return data
+
+    def _count(self, stage, status):
+        metrics.count("documents_total", stage=stage.name, status=status)
+        with self._lock:
+            if status == "failed":
+                stage.n_failed += 1
+            else:
+                stage.n_done += 1
+
+    def _record_failure(self, stage, doc, error):
+        logger.exception(f"{stage.name}: could not record the outcome of {doc}")
+        with self._lock:
+            stage.n_failed += 1
+            self.errors.append((stage.name, doc, error))
+        metrics.record_error(stage.name, error, doc, cause="Bookkeeping")
+        try:
+            self.manifest.fail(doc, stage.name, error)
+        except Exception:
+            logger.exception(f"{stage.name}: could not mark {doc} as failed")
+
+    def _feed(self, jobs):
+        # Documents resuming further down the chain go first, they free the queues
+        for k, doc, data in sorted(jobs, key=lambda x: -x[0]):
+            self.stages[k].queue.put((doc, data))
+        for _ in range(self.stages[0].n_workers):
+            self.stages[0].queue.put(None)
+
+    def pending(self):
+        # (index of the next stage, doc, data) of the documents which did not reach the last stage
+        names = [s.name for s in self.stages]
+        jobs = []
+        for doc, stage, status, data in self.manifest.documents():
+            if status == "duplicate":
+                continue
+            k = 0 if stage == "" else STAGES.index(stage) + 1
+            if k < len(STAGES) and STAGES[k] in names:
+                jobs.append((names.index(STAGES[k]), doc, data))
+        return jobs
+
+    def sample(self):
+        for stage in self.stages:
+            depth = stage.queue.qsize()
+            metrics.gauge("queue_depth", depth, stage=stage.name)
+            metrics.REGISTRY.max("queue_depth_max", depth, stage=stage.name)
+
+    def run(self, sample_every=1.0):
+        jobs = self.pending()
+        logger.info(f"{len(jobs)} documents to process, "
+                    + ", ".join(f"{s.name}: {sum(1 for k, _, _ in jobs if k == i)}" for i, s in enumerate(self.stages)))
+
+        t_start = time.time()
+        threads = [threading.Thread(target=self._feed, args=(jobs,), daemon=True)]
+        for k, stage in enumerate(self.stages):
+            threads.extend(threading.Thread(target=self._work, args=(k,), daemon=True) for _ in range(stage.n_workers))
+
+        for stage in self.stages:
+            metrics.gauge("workers", stage.n_workers, stage=stage.name)
+        for t in threads:
+            t.start()
+        try:
+            while any(t.is_alive() for t in threads):
+                self.sample()
+                threads[-1].join(sample_every)
+            self.sample()
+        finally:
+            for stage in self.stages:
+                if stage.pool is not None:
+                    stage.pool.shutdown(wait=False, cancel_futures=True)
+
+        elapsed = time.time() - t_start
+        metrics.gauge("run_seconds", elapsed)
+        for stage in self.stages:
+            util = stage.busy / max(elapsed * stage.n_workers, 1e-9)
+            logger.info(f"{stage.name}: {stage.n_done} done, {stage.n_failed} failed, {util:.0%} busy")
+        logger.info(f"Finished in {elapsed:.1f}s")
+        if self.errors:
+            logger.error(f"{len(self.errors)} documents could not be recorded in the manifest, "
+                         f"they are retried by the next run")
+
+        return {s.name: (s.n_done, s.n_failed) for s in self.stages}
+
+
+# Functions run in the worker processes, the models are built once per process by the initializers
+
+_parser = None
+_scorer = None
+
+
+def render_pdf(pdf_path, jpg_dir, options):
+    from cv.convert_pdf_to_jpg import convert_pdf_to_jpg, page_filename
+
+    os.makedirs(jpg_dir, exist_ok=True)
+    images = convert_pdf_to_jpg(pdf_path, jpg_dir, n_thread=1, **options)
+    metrics.flush()
+    if images is None:
+        raise RuntimeError("rendering failed")
+
+    offset = (options.get("first_page") or 1) - 1
+    return [os.path.join(jpg_dir, page_filename(pdf_path, offset + i)) for i in range(len(images))]
+
+
+def init_layout_worker(dataset, config_path, score_thresh):
+    global _parser
+    from cv.parse_layout import HarvardLayoutParser
+
+    _parser = HarvardLayoutParser(dataset, model_path=config_path.replace("yaml", "pth"), config_path=config_path,
+                                  score_thresh=score_thresh)
+
+
+def detect_pages(paths):
+    layouts = []
+    try:
+        for p in paths:
+            layout = _parser.detect(p)
+            if layout is None:
+                raise RuntimeError(f"layout detection failed on {p}")
+            # json friendly (x1, y1, x2, y2, type, score)
+            layouts.append([[float(x) for x in b[:4]] + [b[4], float(b[5])] for b in layout])
+    finally:
+        metrics.flush()
+    return layouts
+
+
+def init_score_worker(model_path, batch_size, memo_path):
+    global _scorer
+    from NLP.finbert_infer import FinBertScorer
+
+    _scorer = FinBertScorer(model_path, batch_size=batch_size)
+    if memo_path:
+        from NLP.sentiment_memo import SentimentMemo
+        _scorer = SentimentMemo(_scorer, memo_path)
+
+
+def score_texts(paths, out_path):
+    from NLP.finbert_infer import read_sentences, to_frame
+
+    items = [(os.path.basename(p), i, s) for p in paths for i, s in enumerate(read_sentences(p))]
+    try:
+        df = to_frame([(f, i) for f, i, _ in items], _scorer.score([s for _, _, s in items]))
+    finally:
+        metrics.flush()
+
+    tmp = out_path + ".tmp"
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, out_path)
+    return len(items)
+
+
+def write_text(path, text):
+    # Complete or absent, a crash never leaves half a file behind
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def read_texts(paths):
+    texts = []
+    for p in paths:
+        with open(p, encoding="utf-8") as f:
+            texts.append(f.read())
+    return "\n".join(texts)
+
+
+def build_stages(config, manifest, until=None):
+    """ The stages of config["PIPELINE"], up to and including `until` """
+    root = config["ROOT"]
+    cfg = config["PIPELINE"]
+    maxsize = cfg.get("QueueSize", 4)
+    names = STAGES[:STAGES.index(until) + 1] if until else STAGES
+
+    def path(p):
+        return os.path.join(root, p)
+
+    def out_paths(out_dir, txt_paths):
+        os.makedirs(out_dir, exist_ok=True)
+        return [os.path.join(out_dir, os.path.basename(p)) for p in txt_paths]
+
+    stages = []
+
+    if "render" in names:
+        c = cfg["Render"]
+        pool = futures.ProcessPoolExecutor(c["Workers"])
+        options = dict(first_page_only=c.get("FirstPageOnly", True), dpi=c.get("DPI", 200))
+        jpg_root = path(config["PDF"]["OutputDir"])
+
+        def render(doc, data):
+            jpg_dir = os.path.join(jpg_root, os.path.dirname(doc))
+            return {"pages": pool.submit(render_pdf, data["pdf"], jpg_dir, options).result()}
+
+        stages.append(Stage("render", render, c["Workers"], maxsize, pool))
+
+    if "layout" in names:
+        c = cfg["Layout"]
+        pool = futures.ProcessPoolExecutor(c["Workers"], initializer=init_layout_worker,
+                                           initargs=(c["Dataset"], path(c["Config"]), c.get("ScoreThresh", 0.5)))
+
+        def layout(doc, data):
+            return {"layouts": pool.submit(detect_pages, data["pages"]).result()}
+
+        stages.append(Stage("layout", layout, c["Workers"], maxsize, pool))
+
+    if "ocr" in names:
+        import cv2
+        from cv.OCR import BaiduOCR
+        from cv.region_ocr import RegionOCR
+
+        c = cfg["OCR"]
+        ocr_cfg = config["OCR"]
+        cache_path = ocr_cfg.get("CachePath")
+        ocr = BaiduOCR(ocr_cfg["APIKey"], ocr_cfg["SecretKey"], qps=ocr_cfg.get("QPS"),
+                       cache=path(cache_path) if cache_path else None)
+        region_ocr = RegionOCR(ocr)
+        out_dir = path(c["OutputDir"])
+
+        def run_ocr(doc, data):
+            pages = [(cv2.imread(p), layout) for p, layout in zip(data["pages"], data["layouts"])]
+            results = region_ocr.ocr_pages(pages)
+            if any(page for page in results) and not any(lines for page in results for _, lines in page):
+                raise RuntimeError("no text came back")
+            # Regions of a canvas whose request failed have no lines, the document is retried by the next run
+            missing = sum(lines is None for page in results for _, lines in page)
+            if missing:
+                raise RuntimeError(f"{missing} of {sum(map(len, results))} text regions got no response")
+
+            texts = out_paths(out_dir, [p.replace(".jpg", ".txt") for p in data["pages"]])
+            for out_path, page in zip(texts, results):
+                write_text(out_path, "".join("".join(lines) + "\n" for box, lines in page if lines))
+            return {"texts": texts}
+
+        stages.append(Stage("ocr", run_ocr, c["Workers"], maxsize))
+
+    if "dedup" in names:
+        from common.near_dup import NearDupIndex
+
+        index = NearDupIndex(threshold=cfg["NearDup"].get("Threshold", 0.8))
+        # Documents kept by an earlier run, so that their reissues are still caught
+        kept = [(doc, data) for doc, stage, status, data in manifest.documents()
+                if stage in STAGES[STAGES.index("dedup"):] and status != "duplicate"]
+        for doc, data in kept:
+            index.add([doc], [read_texts(data["texts"])])
+        index_lock = threading.Lock()
+
+        def dedup(doc, data):
+            text = read_texts(data["texts"])
+            with index_lock:
+                dups = index.add([doc], [text], skip_duplicates=True)[0]
+            if dups:
+                return {"duplicate_of": max(dups, key=lambda d: d[1])[0]}
+            return {}
+
+        stages.append(Stage("dedup", dedup, 1, maxsize))
+
+    if "translate" in names:
+        from NLP.translation import BatchTranslator
+
+        c = cfg["Translation"]
+        cache_path = c.get("CachePath")
+        translator = BatchTranslator(cache=path(cache_path) if cache_path else None, qps=c.get("QPS"),
+                                     n_workers=c["Workers"])
+        out_dir = path(c["OutputDir"])
+
+        def translate(doc, data):
+            translated = out_paths(out_dir, data["texts"])
+            for in_path, out_path in zip(data["texts"], translated):
+                translator.translate_file(in_path, out_path)
+            return {"translated": translated}
+
+        stages.append(Stage("translate", translate, c["Workers"], maxsize))
+
+    if "score" in names:
+        c = cfg["Score"]
+        memo = c.get("Memo")
+        pool = futures.ProcessPoolExecutor(c["Workers"], initializer=init_score_worker,
+                                           initargs=(path(c["Model"]), c.get("BatchSize", 128),
+                                                     path(memo) if memo else None))
+        out_dir = path(c["OutputDir"])
+        os.makedirs(out_dir, exist_ok=True)
+
+        def score(doc, data):
+            out_path = os.path.join(out_dir, os.path.basename(doc) + ".csv")
+            n = pool.submit(score_texts, data["translated"], out_path).result()
+            return {"sentiment": out_path, "n_sentences": n}
+
+        stages.append(Stage("score", score, c["Workers"], maxsize, pool))
+
+    return stages
+
+
+def register_pdfs(manifest, input_dir):
+    # Documents are named by their path under input_dir, without .pdf
+    n = 0
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        dirnames.sort()
+        for f in sorted(filenames):
+            if f.endswith(".pdf"):
+                pdf_path = os.path.join(dirpath, f)
+                manifest.register(os.path.relpath(pdf_path, input_dir)[:-4], pdf=pdf_path)
+                n += 1
+    return n
+
+
+def update_features(config, manifest):
+    """ Add the scored documents to the feature store and fill the returns which have matured """
+    import pandas as pd
+    from NLP.event_study import price_loader
+    from NLP.feature_store import FeatureStore
+    from NLP.performance import EventReturns
+
+    c = config["PIPELINE"]["Features"]
+    paths = [data["sentiment"] for doc, stage, status, data in manifest.documents() if stage == "score" and status == "ok"]
+    if not paths:
+        return 0, 0
+
+    store = FeatureStore(os.path.join(config["ROOT"], c["Path"]))
+    try:
+        # Documents already in the store are skipped by ingest
+        n_reports = store.ingest(pd.concat([pd.read_csv(p) for p in paths], ignore_index=True))
+        n_values = store.update_returns(EventReturns(loader=price_loader(os.path.join(config["ROOT"], c["PriceDir"]))))
+    finally:
+        store.close()
+    return n_reports, n_values
+
+
+if __name__ == '__main__':
+    program = os.path.basename(sys.argv[0])
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger(program)
+
+    parser = OptionParser()
+    parser.add_option('-c', '--config', dest='config_path',
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'))
+    parser.add_option('-u', '--until', dest='until', default=None, help='last stage to run, one of ' + ', '.join(STAGES))
+    parser.add_option('--status', dest='status', action='store_true', default=False, help='print the manifest and exit')
+    (options, args) = parser.parse_args()
+
+    with open(options.config_path) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    manifest = Manifest(os.path.join(config["ROOT"], config["PIPELINE"]["Manifest"]))
+    if not options.status:
+        # Set before the worker processes start, they flush their metrics there
+        metrics_dir = os.path.join(config["ROOT"], config["PIPELINE"].get("MetricsDir", "results/metrics"))
+        metrics.configure(metrics_dir)
+
+        n = register_pdfs(manifest, os.path.join(config["ROOT"], config["PDF"]["InputDir"]))
+        logger.info(f"running {program}: {n} pdfs")
+
+        pipeline = Pipeline(manifest, build_stages(config, manifest, options.until))
+        pipeline.run()
+        if options.until is None:
+            n_reports, n_values = update_features(config, manifest)
+            logger.info(f"features: {n_reports} new reports, {n_values} returns filled")
+
+        metrics.export(metrics_dir)
+        logger.info(f"metrics written to {metrics_dir}")
+
+    for (stage, status), n in sorted(manifest.summary().items()):
+        print(f"{stage or 'new':>10} {status:>10} {n}")
+    manifest.close()
+
+    if not options.status and pipeline.errors:
+        sys.exit(1)
@@ -0,0 +1,88 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code", "cv"))
+from parse_layout import LayoutBaseParser
+from model_registry import ModelRegistry, sweep_detect
+
+
+class FakeParser(LayoutBaseParser):
+
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+        self.model_name = name
+        self.model_path = None
+        self.config_path = None
+        self.score_thresh = 0.5
+        self.n_detected = 0
+
+    def preprocess_key(self):
+        return self.key
+
+    def detect(self, im, **kwargs):
+        self.n_detected += 1
+        return [(0.1, 0.1, 0.5, 0.5, self.name, 0.9)]
+
+
+class CountingRegistry(ModelRegistry):
+
+    def build(self, name):
+        return FakeParser(name, key=self.specs[name]["model_name"])
+
+
+@pytest.fixture
+def img_folder(tmp_path):
+    for i in range(10):
+        cv2.imwrite(str(tmp_path / f"page-{i}.jpg"), np.full((40, 30, 3), 20 * i, dtype=np.uint8))
+    return str(tmp_path)
+
+
+def make_registry(n_models, max_loaded):
+    registry = CountingRegistry(max_loaded=max_loaded)
+    for i in range(n_models):
+        registry.register(f"model-{i}", f"dataset-{i % 2}", None, None)
+    return registry
+
+
+@pytest.mark.parametrize("max_loaded", [None, 2, 5])
+def test_each_model_loaded_once_per_sweep(img_folder, max_loaded):
+    registry = make_registry(5, max_loaded)
+    results = sweep_detect(registry, img_folder, chunk_size=3, max_batch_size=2)
+
+    assert registry.loads == 5
+    assert sorted(results) == registry.names()
+    for name, items in results.items():
+        assert len(items) == 10
+        assert all(item["layout"][0][4] == name for item in items)
+
+
+def test_registry_evicts_least_recently_used():
+    registry = make_registry(3, max_loaded=2)
+    registry.get("model-0")
+    registry.get("model-1")
+    registry.get("model-0")
+    registry.get("model-2")
+
+    assert registry.loaded() == ["model-0", "model-2"]
+    assert registry.loads == 3
+
+
+def test_sweep_detects_only_cache_misses(img_folder, tmp_path):
+    cache_path = str(tmp_path / "cache" / "layout.sqlite")
+    registry = make_registry(3, None)
+    first = sweep_detect(registry, img_folder, cache_path=cache_path, chunk_size=4, commit_every=3)
+    assert [p.n_detected for p in map(registry.get, registry.names())] == [10, 10, 10]
+
+    cv2.imwrite(os.path.join(img_folder, "page-new.jpg"), np.full((40, 30, 3), 250, dtype=np.uint8))
+    registry = make_registry(3, None)
+    second = sweep_detect(registry, img_folder, cache_path=cache_path, chunk_size=4)
+
+    assert [p.n_detected for p in map(registry.get, registry.names())] == [1, 1, 1]
+    for name in registry.names():
+        assert len(second[name]) == 11
+        assert [x for x in second[name] if not x["path"].endswith("page-new.jpg")] == first[name]
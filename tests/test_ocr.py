@@ -0,0 +1,88 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "code", "cv"))
+sys.path.append(os.path.join(ROOT, "benchmarks"))
+import OCR
+from OCR import BaiduOCR, BaiduOCRError
+from mock_ocr import MockOCRServer
+
+IM = b"\xff\xd8 not really a jpg"
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(OCR, "backoff", lambda attempt: 0)
+
+
+def client(server, **kwargs):
+    kwargs.setdefault("API_KEY", "key")
+    kwargs.setdefault("SECRET_KEY", "secret")
+    return BaiduOCR(base_url=server.base_url, token_url=server.token_url, **kwargs)
+
+
+def test_retry_codes_are_retried():
+    with MockOCRServer(n_lines=3, error_every=2) as server:
+        ocr = client(server)
+        try:
+            results = [ocr.request(IM) for _ in range(4)]
+        finally:
+            ocr.pool.close()
+
+    assert results == [["第0行文字", "第1行文字", "第2行文字"]] * 4
+    # Requests 2, 4 and 6 got a QPS limit error and were sent again
+    assert server.requests == 7
+
+
+def test_retries_give_up():
+    with MockOCRServer(error_every=1) as server:
+        ocr = client(server, max_retries=2)
+        try:
+            with pytest.raises(BaiduOCRError) as e:
+                ocr.request(IM)
+        finally:
+            ocr.pool.close()
+
+    assert e.value.code == 18
+    assert server.requests == 3
+
+
+def test_expired_token_is_refreshed():
+    with MockOCRServer(n_lines=1, expire_after=2) as server:
+        ocr = client(server)
+        try:
+            results = [ocr.request(IM) for _ in range(5)]
+        finally:
+            ocr.pool.close()
+
+    assert results == [["第0行文字"]] * 5
+    # One token at start, then a new one each time the last one expired
+    assert server.tokens == 3
+    assert ocr.token == "mock3"
+    assert server.requests == 7
+
+
+def test_expired_token_without_key():
+    with MockOCRServer(n_lines=1, expire_after=1) as server:
+        ocr = client(server, API_KEY=None, SECRET_KEY=None, token="mock0")
+        try:
+            assert ocr.request(IM) == ["第0行文字"]
+            with pytest.raises(BaiduOCRError) as e:
+                ocr.request(IM)
+        finally:
+            ocr.pool.close()
+
+    assert e.value.code == 111
+    assert server.tokens == 0
+
+
+def test_deprecated_static_request(monkeypatch):
+    with MockOCRServer(n_lines=2) as server:
+        monkeypatch.setattr(BaiduOCR, "OCR_BASE_URL", server.base_url)
+        with pytest.warns(DeprecationWarning):
+            assert BaiduOCR.request("mock", IM) == ["第0行文字", "第1行文字"]
+        with pytest.warns(DeprecationWarning):
+            assert OCR.request("mock", IM) == ["第0行文字", "第1行文字"]
@@ -0,0 +1,45 @@
+import os
+import sys
+import subprocess
+
+CV_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code", "cv")
+
+# A page is created in a forked process, which starts its own resource tracker as none is
+# running yet, then opened, read and released in the parent
+ROUND_TRIP = """
+import sys
+import multiprocessing as mp
+import numpy as np
+sys.path.append(%r)
+from stream_layout import SharedPage
+
+
+def produce(q):
+    for i in range(3):
+        q.put(SharedPage.create(np.full((20, 10, 3), i, dtype=np.uint8), "report.pdf", i))
+
+
+if __name__ == "__main__":
+    ctx = mp.get_context("fork")
+    q = ctx.Queue()
+    p = ctx.Process(target=produce, args=(q,))
+    p.start()
+    for i in range(3):
+        page = q.get()
+        im = page.open()
+        assert im.shape == (20, 10, 3) and int(im[0, 0, 0]) == i
+        del im
+        page.release()
+    p.join()
+    assert p.exitcode == 0
+"""
+
+
+def test_shared_page_round_trip_has_no_warnings(tmp_path):
+    # In a fresh interpreter, so that no resource tracker is running before the fork
+    script = tmp_path / "round_trip.py"
+    script.write_text(ROUND_TRIP % CV_DIR)
+    out = subprocess.run([sys.executable, str(script)], capture_output=True, text=True, timeout=60)
+
+    assert out.returncode == 0, out.stderr
+    assert out.stderr == ""
@@ -0,0 +1,62 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code", "NLP"))
+from translation import BatchTranslator, StubBackend, chunk_sentences, split_sentences
+from common.sqlite_cache import SQLiteCache
+
+TEXT = "公司发布年报。营业收入同比增长百分之二十，净利润同比增长百分之十五！维持买入评级。\n风险提示：需求不及预期。"
+
+
+def test_chunks_fit_the_limit():
+    sentences = split_sentences(TEXT.replace("\n", "")) + ["短句。", "一二三四五六七八九十" * 3]
+    for max_chars in (8, 12, 40):
+        chunks = chunk_sentences(sentences, max_chars)
+        assert all(len("\n".join(chunk)) <= max_chars for chunk in chunks)
+        # Nothing is lost or reordered
+        assert "".join(p for chunk in chunks for p in chunk) == "".join(sentences)
+
+
+def test_short_sentences_are_kept_whole():
+    sentences = ["甲乙。", "丙丁。", "戊己庚。"]
+    assert chunk_sentences(sentences, 8) == [["甲乙。", "丙丁。"], ["戊己庚。"]]
+
+
+class SmallBackend(StubBackend):
+    # Keeps the requests, with a limit which forces long sentences to be split
+    max_chars = 8
+
+    def __init__(self, fn=None):
+        super().__init__(fn)
+        self.sent = []
+
+    def translate(self, text, src, dest):
+        self.sent.append(text)
+        return super().translate(text, src, dest)
+
+
+def test_long_sentence_is_reassembled():
+    backend = SmallBackend(lambda line: f"<{line}>")
+    long_sentence = "一二三四五六七八九十甲乙丙丁，戊己庚辛。"
+    out = BatchTranslator(backend).translate_sentences(["短句。", long_sentence])
+
+    pieces = [p for chunk in chunk_sentences([long_sentence], 8) for p in chunk]
+    assert len(pieces) > 1
+    assert out == ["<短句。>", " ".join(f"<{p}>" for p in pieces)]
+    assert all(len(text) <= 8 for text in backend.sent)
+
+
+def test_sentence_cache_hits_on_second_run(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "translation.sqlite"))
+
+    first = StubBackend(lambda line: "en " + line)
+    out = BatchTranslator(first, cache=cache).translate(TEXT)
+    assert first.calls > 0
+    assert out.count("\n") == TEXT.count("\n")
+
+    second = StubBackend(lambda line: "other " + line)
+    assert BatchTranslator(second, cache=cache).translate(TEXT) == out
+    assert second.calls == 0
+    n_sentences = sum(len(split_sentences(line)) for line in TEXT.split("\n"))
+    assert cache.hits == n_sentences
+    assert cache.stats()["hits"] == n_sentences